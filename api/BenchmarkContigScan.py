@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput of the contig scans of Gaea on synthetic bgzipped vcfs
+
+usage: python BenchmarkContigScan.py --Size 2 --Workers 1 2 4 8
+"""
+
+import os
+import time
+import zlib
+import struct
+import argparse
+import tempfile
+from Gaea import ScanVcfContigs, ScanBgzfContigs
+
+
+# empty block marking the end of a BGZF file
+BgzfEOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+# use this function to write a BGZF block
+def WriteBgzfBlock(newfile, data, Level):
+    '''
+    (file, bytes, int) -> None
+    Compress data in a single BGZF block and write it to newfile
+    '''
+
+    compressor = zlib.compressobj(Level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    newfile.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+    newfile.write(cdata)
+    newfile.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+# use this function to write a synthetic vcf compressed with bgzip
+def WriteSyntheticVcf(file, Size, Level=1):
+    '''
+    (str, int, int) -> int
+    Write a bgzipped vcf with about Size uncompressed bytes of records spread
+    over 24 chromosomes and a few alternate contigs and return the number of
+    uncompressed bytes written
+    '''
+
+    contigs = [str(i) for i in range(1, 23)] + ['X', 'Y', '1_KI270706v1_random', 'chrUn_GL000195v1']
+    header = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n'
+    buffer, written = header.encode('utf-8'), 0
+    with open(file, 'wb') as newfile:
+        for contig in contigs:
+            record = '{0}\t{1}\t.\tA\tG\t50\tPASS\tDP=30;AF=0.5\tGT:AD\t0/1:15,15\n'
+            lines = ''.join([record.format(contig, i) for i in range(1, 10001)]).encode('utf-8')
+            for i in range(max(1, Size // len(contigs) // len(lines))):
+                buffer += lines
+                # blocks are cut at fixed sizes so lines span blocks and chunks
+                while len(buffer) >= 65280:
+                    WriteBgzfBlock(newfile, buffer[:65280], Level)
+                    written += 65280
+                    buffer = buffer[65280:]
+        if buffer:
+            WriteBgzfBlock(newfile, buffer, Level)
+            written += len(buffer)
+        newfile.write(BgzfEOF)
+    return written
+
+
+# use this function to time a contig scan
+def TimeScan(Scan, *Params):
+    '''
+    (function, *) -> tuple
+    Return a tuple with the result of Scan called with Params and its duration in seconds
+    '''
+
+    start = time.time()
+    contigs = Scan(*Params)
+    return contigs, time.time() - start
+
+
+def RunBenchmark(args):
+    '''
+    (list) -> None
+    Take the list of command line arguments, write a synthetic vcf and print
+    the throughput of the streaming scan and of the parallel BGZF scan
+    '''
+
+    fd, file = tempfile.mkstemp(suffix='.vcf.gz', dir=args.workdir)
+    os.close(fd)
+    try:
+        Size = WriteSyntheticVcf(file, int(args.size * 1024**3))
+        print('file\tuncompressed_GB\tcompressed_GB')
+        print('{0}\t{1:.2f}\t{2:.2f}'.format(file, Size / 1024**3, os.path.getsize(file) / 1024**3))
+        print('scan\tworkers\tseconds\tMB/s\tidentical')
+        expected, duration = TimeScan(ScanVcfContigs, file)
+        print('gzip\t1\t{0:.2f}\t{1:.1f}\t{2}'.format(duration, Size / 1024**2 / duration, True))
+        for Workers in args.workers:
+            contigs, duration = TimeScan(ScanBgzfContigs, file, 'vcf', Workers)
+            print('bgzf\t{0}\t{1:.2f}\t{2:.1f}\t{3}'.format(Workers, duration, Size / 1024**2 / duration, contigs == expected))
+    finally:
+        os.remove(file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog = 'BenchmarkContigScan.py', description='Benchmark the contig scans of bgzipped vcfs')
+    parser.add_argument('-s', '--Size', dest='size', type=float, default=2, help='Uncompressed size of the synthetic vcf in GB. Default is 2')
+    parser.add_argument('-w', '--Workers', dest='workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Numbers of workers of the parallel scan. Default is 1 2 4 8')
+    parser.add_argument('-d', '--WorkDir', dest='workdir', default=None, help='Directory where the synthetic vcf is written. Default is the system temporary directory')
+    args = parser.parse_args()
+    RunBenchmark(args)
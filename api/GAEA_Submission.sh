@@ -13,13 +13,27 @@ portal=https://ega.crg.eu/submitterportal/v1
 PythonPath=/.mounts/labs/PDE/Modules/sw/python/Python-3.6.4/bin/python3.6
 
 
+#### 1b. REFRESH EGA ENUMERATIONS CACHE ####
+
+# fetch the enumerations once so that forming json makes no calls to the EGA API
+module load python-gsi/3.6.4; python3.6 $SubmissionScript Enums --refresh --MyScript $SubmissionScript --MyPython $PythonPath --MaxAge 43200;
+
+
+#### 1c. START THE WATCHER ####
+
+# finished jobs notify the watcher, which checks encryption and upload of their aliases
+# the watcher runs as its own job so that it outlives this submission job
+if ! qstat -r | grep -q "Full jobname: *EGA.Gaea.Watcher$"; then
+    echo "starting the watcher for "${boxes[@]}""
+    qsub -b y -cwd -q production -N EGA.Gaea.Watcher -l h_vmem=4g "$PythonPath $SubmissionScript Watch -b ${boxes[@]} -c $credentials -s EGASUB -at Analyses -rt Runs --Attributes AnalysesAttributes";
+fi
+
+
 #### 2. LIST FILES ON STAGING SERVERS ####
 
-# list files on the staging server of available boxes
-for boxname in "${boxes[@]}"; do
-    echo "listing files on staging server for "$boxname""
-    module load python-gsi/3.6.4; python3.6 $SubmissionScript StagingServer -b "$boxname" -c $credentials -s EGASUB -m EGA --RunsTable Runs --AnalysesTable Analyses --StagingTable StagingServer --FootprintTable FootPrint;
-done;
+# list files on the staging servers of all available boxes at once
+echo "listing files on staging servers for "${boxes[@]}""
+module load python-gsi/3.6.4; python3.6 $SubmissionScript StagingServer -b "${boxes[@]}" -c $credentials -s EGASUB -m EGA --RunsTable Runs --AnalysesTable Analyses --StagingTable StagingServer --FootprintTable FootPrint --MaxConnections 8 --MaxPerBox 4;
 
 #### 3. FORM JSON FOR EACH OBJECT #### 
 
@@ -28,7 +42,7 @@ for boxname in "${boxes[@]}"; do
     echo "forming json for "$boxname""
     
     # form analyses json in EGASUb db
-    module load python-gsi/3.6.4; python3.6 $SubmissionScript FormJson -c $credentials -t Analyses -m EGA -s EGASUB -b "$boxname" -p AnalysesProjects -a AnalysesAttributes -k $EncryptionKeys -f FootPrint -o analyses -q production -u aspera -d 10 --Mem 10 --Max 10 --MaxFootPrint 15 --Remove;
+    module load python-gsi/3.6.4; python3.6 $SubmissionScript FormJson -c $credentials -t Analyses -m EGA -s EGASUB -b "$boxname" -p AnalysesProjects -a AnalysesAttributes -k $EncryptionKeys -f FootPrint -o analyses -q production -u aspera -d 10 --Mem 10 --EncryptPerAlias 4 --EncryptMax 40 --Max 10 --MaxFootPrint 15 --Remove;
 
     # form datasets json in EGASUB db
     module load python-gsi/3.6.4; python3.6 $SubmissionScript FormJson -c $credentials -t Datasets -m EGA -s EGASUB -b "$boxname" -o datasets;
@@ -43,7 +57,7 @@ for boxname in "${boxes[@]}"; do
     module load python-gsi/3.6.4; python3.6 $SubmissionScript FormJson -c $credentials -t Experiments -m EGA -s EGASUB -b "$boxname" -o experiments;
 
     # form runs json in EGASUb db
-    module load python-gsi/3.6.4; python3.6 $SubmissionScript FormJson -c $credentials -t Runs -m EGA -s EGASUB -b "$boxname" -k $EncryptionKeys -f FootPrint -o runs -q production -u aspera -d 10 --Mem 10 --Max 10 --MaxFootPrint 15 --Remove;
+    module load python-gsi/3.6.4; python3.6 $SubmissionScript FormJson -c $credentials -t Runs -m EGA -s EGASUB -b "$boxname" -k $EncryptionKeys -f FootPrint -o runs -q production -u aspera -d 10 --Mem 10 --EncryptPerAlias 4 --EncryptMax 40 --Max 10 --MaxFootPrint 15 --Remove;
 
     # form dacs json in EGASUB db
     module load python-gsi/3.6.4; python3.6 $SubmissionScript FormJson -c $credentials -t Dacs -m EGA -s EGASUB -b "$boxname" -o dacs;
@@ -17,6 +17,28 @@ import requests
 import uuid
 import xml.etree.ElementTree as ET
 import gzip
+import struct
+import hashlib
+import sys
+import zlib
+import threading
+import atexit
+import contextlib
+import fcntl
+import tempfile
+import multiprocessing
+import signal
+import sqlite3
+import glob
+import concurrent.futures
+import getpass
+import math
+import ftplib
+import calendar
+import collections
+import abc
+import socket
+import select
 
 
 # use this function to extract credentials from file
@@ -55,22 +77,252 @@ def ParseCredentials(CredentialFile, Box):
     return UserName, MyPassword
 
 
+# use this class to keep connections to a database open for the lifetime of the process
+class ConnectionPool(object):
+    '''
+    Pool of connections to a single database of the gsi MySQL server.
+    Connections are checked for health before being handed out, re-opened
+    if the server dropped them, and kept idle for reuse after release
+    '''
+    
+    def __init__(self, CredentialFile, DataBase, MaxIdle=4):
+        '''
+        (str, str, int) -> None
+        Parse the credential file once and set up an empty pool for DataBase
+        keeping at most MaxIdle connections open between uses
+        '''
+        
+        self.Credentials = ExtractCredentials(CredentialFile)
+        # get the database name
+        assert DataBase in [self.Credentials['DbMet'], self.Credentials['DbSub']]
+        self.DataBase = DataBase
+        self.MaxIdle = MaxIdle
+        self.Idle = []
+        self.Lock = threading.Lock()
+    
+    def Connect(self):
+        '''
+        (ConnectionPool) -> pymysql.connections.Connection
+        Open a new connection to the database
+        '''
+        
+        return pymysql.connect(host = self.Credentials['DbHost'], user = self.Credentials['DbUser'],
+                               password = self.Credentials['DbPasswd'], db = self.DataBase, charset = "utf8",
+                               port=3306, unix_socket='/var/run/mysqld/mysqld.sock')
+    
+    def Acquire(self):
+        '''
+        (ConnectionPool) -> PooledConnection
+        Return a healthy connection, reusing an idle one if available
+        '''
+        
+        while True:
+            with self.Lock:
+                conn = self.Idle.pop() if len(self.Idle) != 0 else None
+            if conn is None:
+                # no idle connection, open a new one
+                return PooledConnection(self.Connect(), self)
+            try:
+                # check that connection is alive, reconnect if server closed it
+                conn.ping(reconnect=True)
+            except:
+                # connection cannot be revived, discard it and try the next one
+                try:
+                    conn.close()
+                except:
+                    pass
+            else:
+                return PooledConnection(conn, self)
+    
+    def Release(self, conn):
+        '''
+        (ConnectionPool, pymysql.connections.Connection) -> None
+        Return a connection to the pool. Any transaction left open is rolled back
+        like pymysql does when closing, so that reused connections do not see a stale snapshot
+        '''
+        
+        try:
+            conn.rollback()
+        except:
+            # broken connection, do not keep it
+            try:
+                conn.close()
+            except:
+                pass
+            return
+        with self.Lock:
+            if len(self.Idle) < self.MaxIdle:
+                self.Idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        
+    def CloseAll(self):
+        '''
+        (ConnectionPool) -> None
+        Close all idle connections
+        '''
+        
+        with self.Lock:
+            Idle, self.Idle = self.Idle, []
+        for conn in Idle:
+            try:
+                conn.close()
+            except:
+                pass
+
+
+# use this class to hand out pooled connections with the same interface as pymysql connections
+class PooledConnection(object):
+    '''
+    Thin wrapper around a pymysql connection. close() returns the connection
+    to its pool instead of closing the socket
+    '''
+    
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+    
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise pymysql.err.InterfaceError('connection already returned to the pool')
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.Release(conn)
+
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# pools are shared by all functions of the process {(pid, CredentialFile, DataBase): pool}
+# the pid is part of the key so that forked processes never share sockets with their parent
+_Pools = {}
+_PoolsLock = threading.Lock()
+
+
+# use this function to get the connection pool of a given database
+def GetConnectionPool(CredentialFile, DataBase):
+    '''
+    (str, str) -> ConnectionPool
+    Return the process-wide connection pool for DataBase, creating it on first use
+    '''
+    
+    key = (os.getpid(), os.path.abspath(CredentialFile), DataBase)
+    with _PoolsLock:
+        if key not in _Pools:
+            _Pools[key] = ConnectionPool(CredentialFile, DataBase)
+        return _Pools[key]
+
+
+# use this function to close all pooled connections when the process exits
+@atexit.register
+def CloseConnectionPools():
+    '''
+    () -> None
+    Close the idle connections of all pools opened by this process
+    '''
+    
+    with _PoolsLock:
+        Pools = [_Pools[key] for key in _Pools if key[0] == os.getpid()]
+    for pool in Pools:
+        pool.CloseAll()
+
+
 # use this function to connect to the gsi database
 def EstablishConnection(CredentialFile, database):
     '''
-    (list, str) -> connection object    
-    Take a file with database credentials and the name of the database
+    (list, str) -> PooledConnection    
+    Take a file with database credentials and the name of the database and
+    return a connection from the process-wide pool. Calling close() on the
+    connection returns it to the pool
     '''
     
-    # extract database credentials from the command
-    Credentials = ExtractCredentials(CredentialFile)
-    # get the database name
-    assert database in [Credentials['DbMet'], Credentials['DbSub']]
-    # connnect to the database
-    conn = pymysql.connect(host = Credentials['DbHost'], user = Credentials['DbUser'],
-                           password = Credentials['DbPasswd'], db = database, charset = "utf8",
-                           port=3306, unix_socket='/var/run/mysqld/mysqld.sock')
-    return conn 
+    return GetConnectionPool(CredentialFile, database).Acquire()
+
+
+# use this function to open a pooled connection as a context manager
+@contextlib.contextmanager
+def DatabaseConnection(CredentialFile, DataBase):
+    '''
+    (str, str) -> PooledConnection
+    Yield a pooled connection to DataBase and return it to the pool on exit.
+    Uncommitted changes are rolled back when the connection is released
+    '''
+    
+    conn = EstablishConnection(CredentialFile, DataBase)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+# use this class to record status changes of many aliases in a single transaction
+class StatusTransitions(object):
+    '''
+    Collect the column updates (Status, errorMessages, Json...) of aliases in
+    Table for a given Box and write them with parameterized executemany
+    batches committed as a single transaction
+    '''
+    
+    def __init__(self, CredentialFile, DataBase, Table, Box, BatchSize=1000):
+        '''
+        (str, str, str, str, int) -> None
+        Set up an empty set of transitions for aliases of Box in Table of DataBase.
+        Rows are sent to the server in batches of at most BatchSize
+        '''
+        
+        self.CredentialFile = CredentialFile
+        self.DataBase = DataBase
+        self.Table = Table
+        self.Box = Box
+        self.BatchSize = BatchSize
+        # group updates by the set of columns modified {(columns): [(values, alias)]}
+        self.Updates = {}
+        
+    def Add(self, alias, **Columns):
+        '''
+        (StatusTransitions, str, dict) -> None
+        Record an update of Columns (column: value) for alias. Values are converted
+        to strings, None is stored as the string NULL like FormatData does
+        '''
+        
+        columns = tuple(sorted(Columns))
+        values = tuple('NULL' if Columns[i] is None else str(Columns[i]) for i in columns)
+        self.Updates.setdefault(columns, []).append(values + (alias, self.Box))
+
+    def __len__(self):
+        return sum([len(self.Updates[i]) for i in self.Updates])
+
+    def Flush(self):
+        '''
+        (StatusTransitions) -> int
+        Write all recorded updates in a single transaction and return the number
+        of aliases updated. The transaction is rolled back if any statement fails
+        '''
+        
+        Count = len(self)
+        if Count == 0:
+            return 0
+        with DatabaseConnection(self.CredentialFile, self.DataBase) as conn:
+            cur = conn.cursor()
+            try:
+                for columns in self.Updates:
+                    Cmd = 'UPDATE {0} SET {1} WHERE {0}.alias=%s AND {0}.egaBox=%s'.format(self.Table, ', '.join(['{0}.{1}=%s'.format(self.Table, i) for i in columns]))
+                    Rows = self.Updates[columns]
+                    for i in range(0, len(Rows), self.BatchSize):
+                        cur.executemany(Cmd, Rows[i: i + self.BatchSize])
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        self.Updates = {}
+        return Count
 
 
 # use this function to list tables in the database
@@ -82,11 +334,10 @@ def ListTables(CredentialFile, DataBase):
     '''
     
     # connect to database
-    conn = EstablishConnection(CredentialFile, DataBase)
-    cur = conn.cursor()
-    cur.execute('SHOW TABLES')
-    Tables = [i[0] for i in cur]
-    conn.close()
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        cur.execute('SHOW TABLES')
+        Tables = [i[0] for i in cur]
     return Tables
 
 
@@ -113,32 +364,34 @@ def AddWorkingDirectory(CredentialFile, DataBase, Table, Box):
     Tables = ListTables(CredentialFile, DataBase)
     
     if Table in Tables:
-        # connect to db
-        conn = EstablishConnection(CredentialFile, DataBase)
-        cur = conn.cursor()
-        # get the alias with valid status
-        cur.execute('SELECT {0}.alias FROM {0} WHERE {0}.Status=\"valid\" and {0}.egaBox=\"{1}\"'.format(Table, Box))
-        Data = cur.fetchall()
-        if len(Data) != 0:
+        # collect working directories of all aliases and record them in a single transaction
+        Transitions = StatusTransitions(CredentialFile, DataBase, Table, Box)
+        with DatabaseConnection(CredentialFile, DataBase) as conn:
+            cur = conn.cursor()
+            # get the alias with valid status
+            cur.execute('SELECT {0}.alias FROM {0} WHERE {0}.Status=\"valid\" and {0}.egaBox=\"{1}\"'.format(Table, Box))
+            Data = cur.fetchall()
+        try:
             # loop over alias
             for i in Data:
                 alias = i[0]
                 # create working directory with random unique identifier
                 UID = str(uuid.uuid4())             
-                # record identifier in table, create working directory in file system
-                cur.execute('UPDATE {0} SET {0}.WorkingDirectory=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, UID, alias, Box))  
-                conn.commit()
                 # create working directories
                 WorkingDir = GetWorkingDirectory(UID, WorkingDir = '/scratch2/groups/gsi/bis/EGA_Submissions')
                 os.makedirs(WorkingDir)
-        conn.close()
+                # record identifier in table
+                Transitions.Add(alias, WorkingDirectory=UID)
+        finally:
+            # record the directories created so far even if creating the next one fails
+            Transitions.Flush()
         
         # check that working directory was recorded and created
-        conn = EstablishConnection(CredentialFile, DataBase)
-        cur = conn.cursor()
-        # get the alias and working directory with valid status
-        cur.execute('SELECT {0}.alias, {0}.WorkingDirectory FROM {0} WHERE {0}.Status=\"valid\" and {0}.egaBox=\"{1}\"'.format(Table, Box))
-        Data = cur.fetchall()
+        with DatabaseConnection(CredentialFile, DataBase) as conn:
+            cur = conn.cursor()
+            # get the alias and working directory with valid status
+            cur.execute('SELECT {0}.alias, {0}.WorkingDirectory FROM {0} WHERE {0}.Status=\"valid\" and {0}.egaBox=\"{1}\"'.format(Table, Box))
+            Data = cur.fetchall()
         if len(Data) != 0:
             for i in Data:
                 Error = []
@@ -151,13 +404,11 @@ def AddWorkingDirectory(CredentialFile, DataBase, Table, Box):
                 # check if error message
                 if len(Error) != 0:
                     # error is found, record error message, keep status valid --> valid
-                    cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, ';'.join(Error), alias, Box))  
-                    conn.commit()
+                    Transitions.Add(alias, errorMessages=';'.join(Error))
                 else:
-                    # no error, update Status valid --> start
-                    cur.execute('UPDATE {0} SET {0}.Status=\"encrypt\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{1}\" AND {0}.egaBox=\"{2}\"'.format(Table, alias, Box))  
-                    conn.commit()
-        conn.close()            
+                    # no error, update Status valid --> encrypt
+                    Transitions.Add(alias, Status='encrypt', errorMessages='None')
+        Transitions.Flush()
 
 
 # use this function convert data into data to be instered in a database table
@@ -178,21 +429,93 @@ def FormatData(L):
     return tuple(Values)
 
 
-# use this function to list enumerations
-def ListEnumerations(MyScript, MyPython):
+# use this function to replace all rows of a box in a table in a single transaction
+def ReplaceBoxRows(CredentialFile, DataBase, Table, Fields, Box, Rows, BatchSize=5000):
     '''
-    (str, str) -> list
+    (str, str, str, list, str, list, int) -> int
+    Delete all rows of Box in Table of DataBase and insert Rows (lists of values
+    ordered as in Fields) with multi-row INSERT statements of up to BatchSize rows.
+    Deletion and insertion are committed as a single transaction so that readers
+    see either the previous or the new rows of Box, never a partial table.
+    Return the number of inserted rows
+    '''
+    
+    # convert data to strings, converting missing values to NULL
+    Values = [FormatData(L) for L in Rows]
+    # pymysql rewrites executemany of INSERT ... VALUES into multi-row inserts
+    Cmd = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(Table, ', '.join(Fields), ', '.join(['%s'] * len(Fields)))
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        try:
+            # drop all entries for that Box
+            cur.execute('DELETE FROM {0} WHERE {0}.egaBox=%s'.format(Table), (Box,))
+            for i in range(0, len(Values), BatchSize):
+                cur.executemany(Cmd, Values[i: i + BatchSize])
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    return len(Values)
+
+
+# use this function to update the rows of a box in a table in a single transaction
+def UpdateBoxRows(CredentialFile, DataBase, Table, Fields, Box, Rows, Key, BatchSize=5000):
+    '''
+    (str, str, str, list, str, list, str, int) -> tuple
+    Update the rows of Box in Table of DataBase to match Rows (lists of values
+    ordered as in Fields) identified by the field Key. Only rows that are no
+    longer in Rows or whose values changed are deleted and only new or changed
+    rows are inserted, in a single transaction. Return a tuple with the number
+    of deleted and inserted rows
+    '''
+    
+    # convert data to strings, converting missing values to NULL {key: values}
+    k = Fields.index(Key)
+    Values = {}
+    for L in Rows:
+        L = FormatData(L)
+        Values[L[k]] = L
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT {1} FROM {0} WHERE {0}.egaBox=%s'.format(Table, ', '.join(Fields)), (Box,))
+            Current = {}
+            for row in cur.fetchall():
+                row = tuple(['NULL' if i is None else str(i) for i in row])
+                Current.setdefault(row[k], set()).add(row)
+            Deleted = [i for i in Current if i not in Values or Current[i] != set([Values[i]])]
+            Inserted = [Values[i] for i in Values if i not in Current or Current[i] != set([Values[i]])]
+            Cmd = 'DELETE FROM {0} WHERE {0}.egaBox=%s AND {0}.{1}=%s'.format(Table, Key)
+            for i in range(0, len(Deleted), BatchSize):
+                cur.executemany(Cmd, [(Box, j) for j in Deleted[i: i + BatchSize]])
+            Cmd = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(Table, ', '.join(Fields), ', '.join(['%s'] * len(Fields)))
+            for i in range(0, len(Inserted), BatchSize):
+                cur.executemany(Cmd, Inserted[i: i + BatchSize])
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    return len(Deleted), len(Inserted)
+
+
+# list all enumerations available from EGA
+EnumNames = ['analysis_file_types', 'analysis_types', 'case_control', 'dataset_types', 'experiment_types',
+             'file_types', 'genders', 'instrument_models', 'library_selections', 'library_sources',
+             'library_strategies', 'reference_chromosomes', 'reference_genomes', 'study_types']
+
+
+# use this function to fetch enumerations from EGA
+def FetchEnumerations(MyScript, MyPython):
+    '''
+    (str, str) -> dict
     Take a the path to the python program, and the path to the python script and
     return a dictionary with enumeration as key and corresponding dictionary of metadata as value
+    by querying the EGA API from xfer4
     Precondition: the list of enumerations available from EGA is hard-coded
     '''
         
-    # list all enumerations available from EGA
     url = 'https://ega-archive.org/submission-api/v1/enums/'
-    L = ['analysis_file_types', 'analysis_types', 'case_control', 'dataset_types', 'experiment_types',
-         'file_types', 'genders', 'instrument_models', 'library_selections', 'library_sources',
-         'library_strategies', 'reference_chromosomes', 'reference_genomes', 'study_types']
-    URLs = [os.path.join(url, i) for i in L]
+    URLs = [os.path.join(url, i) for i in EnumNames]
     
     # create a dictionary to store each enumeration
     Enums = {}
@@ -201,6 +524,176 @@ def ListEnumerations(MyScript, MyPython):
     return Enums
 
 
+# version of the format of the enumeration cache file
+EnumCacheVersion = 1
+
+
+# use this function to get the path to the enumeration cache
+def GetEnumCacheFile(MyScript, EnumCache=None):
+    '''
+    (str, str) -> str
+    Return the path to the file caching EGA enumerations. Use EnumCache if
+    provided or a file in the state directory otherwise, as the directory
+    of the submission script MyScript may not be writable
+    '''
+    
+    if EnumCache:
+        return EnumCache
+    return os.path.join(GetStateDir(), '.ega_enumerations.json')
+
+
+# use this function to read the enumeration cache
+def ReadEnumCache(CacheFile):
+    '''
+    (str) -> dict
+    Return the content of the enumeration cache {version, timestamp, enums}
+    or None if the file doesn't exist, can't be parsed or has a different version
+    '''
+    
+    try:
+        with open(CacheFile) as infile:
+            Cache = json.load(infile)
+    except:
+        return None
+    if Cache.get('version') != EnumCacheVersion or 'enums' not in Cache:
+        return None
+    return Cache
+
+
+# use this function to check that all enumerations were fetched
+def AreEnumerationsComplete(Enums):
+    '''
+    (dict) -> bool
+    Return True if Enums has a non-empty dictionary for each enumeration available from EGA
+    '''
+    
+    for i in EnumNames:
+        name = i.title().replace('_', '')
+        if not isinstance(Enums.get(name), dict) or len(Enums[name]) == 0:
+            return False
+    return True
+
+
+# use this function to write the enumeration cache
+def RefreshEnumerations(MyScript, MyPython, EnumCache=None, Blocking=True, MaxAge=None):
+    '''
+    (str, str, str, bool, int) -> dict
+    Fetch the enumerations from EGA and save them in the cache file. Only one
+    process refreshes the cache at a time. If Blocking is False and another
+    process is already refreshing, return None without fetching. If MaxAge is
+    set and the cache became younger than MaxAge seconds while waiting for the
+    lock, return the cached enumerations without fetching. Readers are never
+    exposed to a partially written file. Incomplete enumerations are not
+    cached and the enumerations of the current cache are returned instead if any.
+    Enumerations are fetched without the cache if the cache can't be written
+    '''
+    
+    try:
+        CacheFile = GetEnumCacheFile(MyScript, EnumCache)
+        lock = open(CacheFile + '.lock', 'a')
+    except OSError as e:
+        print('Could not use the enumeration cache: {0}'.format(e), file=sys.stderr)
+        return FetchEnumerations(MyScript, MyPython)
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if Blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            if MaxAge is not None:
+                # another process may have refreshed the cache
+                Cache = ReadEnumCache(CacheFile)
+                if Cache is not None and time.time() - Cache['timestamp'] <= MaxAge:
+                    return Cache['enums']
+            Enums = FetchEnumerations(MyScript, MyPython)
+            if AreEnumerationsComplete(Enums) == False:
+                # keep the current cache rather than caching a partial fetch
+                print('Could not fetch all enumerations from EGA, keeping the current cache', file=sys.stderr)
+                Cache = ReadEnumCache(CacheFile)
+                return Enums if Cache is None else Cache['enums']
+            Cache = {'version': EnumCacheVersion, 'timestamp': time.time(), 'enums': Enums}
+            # write to a temporary file in the same directory and swap it in
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CacheFile), prefix='.ega_enumerations.')
+            except OSError as e:
+                print('Could not save the enumeration cache: {0}'.format(e), file=sys.stderr)
+                return Enums
+            try:
+                with os.fdopen(fd, 'w') as newfile:
+                    json.dump(Cache, newfile)
+                os.chmod(tmp, 0o664)
+                os.replace(tmp, CacheFile)
+            except OSError as e:
+                print('Could not save the enumeration cache: {0}'.format(e), file=sys.stderr)
+                os.remove(tmp)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return Enums
+
+
+# enumeration cache files refreshed in the background by this process
+EnumRefreshes = set()
+
+
+# use this function to check if the enumeration cache is being refreshed
+def IsRefreshingEnumerations(CacheFile):
+    '''
+    (str) -> bool
+    Return True if a process holds the lock of the enumeration cache CacheFile
+    '''
+    
+    with open(CacheFile + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return False
+
+
+# use this function to list enumerations
+def ListEnumerations(MyScript, MyPython, EnumCache=None, TTL=7*24*3600):
+    '''
+    (str, str, str, int) -> dict
+    Take a the path to the python program, and the path to the python script and
+    return a dictionary with enumeration as key and corresponding dictionary of metadata as value.
+    Enumerations are read from the cache file. A cache older than TTL seconds
+    is used as is while a refresh is launched in the background, at most once
+    per process and only if no other process is refreshing the cache.
+    Enumerations are fetched from EGA only if no cache exists
+    '''
+    
+    try:
+        CacheFile = GetEnumCacheFile(MyScript, EnumCache)
+    except OSError:
+        # no state directory, fetch without the cache
+        return RefreshEnumerations(MyScript, MyPython, EnumCache)
+    Cache = ReadEnumCache(CacheFile)
+    if Cache is None:
+        # no usable cache. fetch or wait for the process already fetching
+        return RefreshEnumerations(MyScript, MyPython, EnumCache, Blocking=True, MaxAge=TTL)
+    if time.time() - Cache['timestamp'] > TTL and CacheFile not in EnumRefreshes:
+        # serve stale enumerations and refresh in a detached process
+        EnumRefreshes.add(CacheFile)
+        Cmd = [MyPython, MyScript, 'Enums', '--refresh', '--MyScript', MyScript, '--MyPython', MyPython,
+               '--EnumCache', CacheFile, '--MaxAge', str(TTL)]
+        try:
+            if IsRefreshingEnumerations(CacheFile) == False:
+                subprocess.Popen(Cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError:
+            pass
+    return Cache['enums']
+
+
+# map typeId with enumerations
+MapEnum = {"experimentTypeId": "ExperimentTypes", "analysisTypeId": "AnalysisTypes",
+           "caseOrControlId": "CaseControl", "genderId": "Genders", "datasetTypeIds": "DatasetTypes",
+           "instrumentModelId": "InstrumentModels", "librarySourceId": "LibrarySources",
+           "librarySelectionId": "LibrarySelections",  "libraryStrategyId": "LibraryStrategies",
+           "studyTypeId": "StudyTypes", "chromosomeReferences": "ReferenceChromosomes",
+           "genomeId": "ReferenceGenomes", "fileTypeId": "AnalysisFileTypes", "runFileTypeId": "FileTypes"}
+
+
 # use this function to record an error message for a given alias
 def RecordMessage(CredentialFile, DataBase, Table, Box, Alias, Message, Status):
     '''
@@ -209,16 +702,15 @@ def RecordMessage(CredentialFile, DataBase, Table, Box, Alias, Message, Status):
     of the status for a given Alias and Box in Table if Status is respectively Error or Status
     '''
     
-    conn = EstablishConnection(CredentialFile, DataBase)
-    cur = conn.cursor()
-    if Status == 'Error':
-        # record error message
-        cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" and {0}.egaBox=\"{3}\"'.format(Table, Message, Alias, Box))
-    elif Status == 'Status':
-        # record submission status
-        cur.execute('UPDATE {0} SET {0}.submissionStatus=\"{1}\" WHERE {0}.alias="\{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Message, Alias, Box))
-    conn.commit()
-    conn.close()
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        if Status == 'Error':
+            # record error message
+            cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" and {0}.egaBox=\"{3}\"'.format(Table, Message, Alias, Box))
+        elif Status == 'Status':
+            # record submission status
+            cur.execute('UPDATE {0} SET {0}.submissionStatus=\"{1}\" WHERE {0}.alias="\{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Message, Alias, Box))
+        conn.commit()
  
     
 # use this function to delete objects with VALIDATED_WITH_ERRORS status    
@@ -406,11 +898,12 @@ def RegisterObjects(CredentialFile, DataBase, Table, Box, Object, Portal):
                                             # store the date it was submitted
                                             Time = time.strftime('%Y-%m-%d', time.localtime(time.time()))
                                             # add Receipt, accession and time to table and change status
-                                            conn = EstablishConnection(CredentialFile, DataBase)
-                                            cur = conn.cursor()
-                                            cur.execute('UPDATE {0} SET {0}.Receipt=\"{1}\", {0}.egaAccessionId=\"{2}\", {0}.Status=\"{3}\", {0}.submissionStatus=\"{3}\", {0}.CreationTime=\"{4}\" WHERE {0}.alias=\"{5}\" AND {0}.egaBox=\"{6}\"'.format(Table, Receipt, egaAccessionId, ObjectStatus, Time, J["alias"], Box))
-                                            conn.commit()
-                                            conn.close()
+                                            with DatabaseConnection(CredentialFile, DataBase) as conn:
+                                                cur = conn.cursor()
+                                                cur.execute('UPDATE {0} SET {0}.Receipt=\"{1}\", {0}.egaAccessionId=\"{2}\", {0}.Status=\"{3}\", {0}.submissionStatus=\"{3}\", {0}.CreationTime=\"{4}\" WHERE {0}.alias=\"{5}\" AND {0}.egaBox=\"{6}\"'.format(Table, Receipt, egaAccessionId, ObjectStatus, Time, J["alias"], Box))
+                                                conn.commit()
+                                            # accessions of this object and box have changed
+                                            InvalidateAccessions(Table=Table, Box=Box)
                                     else:
                                         # delete object
                                         requests.delete(URL + '/{0}/{1}'.format(Object, ObjectId), headers=headers)
@@ -422,26 +915,47 @@ def RegisterObjects(CredentialFile, DataBase, Table, Box, Object, Portal):
 
 
 
+# accessions extracted during this run {(DataBase, Table, Box): {alias: accession}}
+_Accessions = {}
+
+
 # use this function to extract ega accessions from metadata database
 def ExtractAccessions(CredentialFile, DataBase, Box, Table):
     '''
     (file, str, str, str) -> dict
     Take a file with credentials to connect to DataBase and return a dictionary
-    with alias: accessions registered in Box for the given object/Table
+    with alias: accessions registered in Box for the given object/Table.
+    The dictionary is pulled once per run and shared by all callers until
+    InvalidateAccessions is called. It should not be modified
     '''
     
-    # connect to metadata database
-    conn = EstablishConnection(CredentialFile, DataBase)
-    cur = conn.cursor()
-    # pull down analysis alias and egaId from metadata db, alias should be unique
-    cur.execute('SELECT {0}.alias, {0}.egaAccessionId from {0} WHERE {0}.egaBox=\"{1}\"'.format(Table, Box)) 
-    # create a dict {alias: accession}
-    # some PCSI aliases are not unique, 1 sample is chosen arbitrarily
-    Registered = {}
-    for i in cur:
-        Registered[i[0]] = i[1]
-    conn.close()
-    return Registered
+    key = (DataBase, Table, Box)
+    if key not in _Accessions:
+        # connect to metadata database
+        with DatabaseConnection(CredentialFile, DataBase) as conn:
+            cur = conn.cursor()
+            # pull down analysis alias and egaId from metadata db, alias should be unique
+            cur.execute('SELECT {0}.alias, {0}.egaAccessionId from {0} WHERE {0}.egaBox=\"{1}\"'.format(Table, Box)) 
+            # create a dict {alias: accession}
+            # some PCSI aliases are not unique, 1 sample is chosen arbitrarily
+            Registered = {}
+            for i in cur:
+                Registered[i[0]] = i[1]
+        _Accessions[key] = Registered
+    return _Accessions[key]
+
+
+# use this function to drop accessions cached by ExtractAccessions
+def InvalidateAccessions(DataBase=None, Table=None, Box=None):
+    '''
+    (str, str, str) -> None
+    Remove the accessions cached for DataBase, Table and Box so that they are
+    pulled again on next use. Any of DataBase, Table or Box left to None matches all
+    '''
+    
+    for key in list(_Accessions.keys()):
+        if DataBase in [None, key[0]] and Table in [None, key[1]] and Box in [None, key[2]]:
+            del _Accessions[key]
 
 
 # use this function to check information in Tables    
@@ -540,16 +1054,10 @@ def IsInfoValid(CredentialFile, MetadataDataBase, SubDataBase, Table, Box, Objec
         Data = []
     conn.close()
     
-    # map typeId with enumerations
-    MapEnum = {"experimentTypeId": "ExperimentTypes", "analysisTypeId": "AnalysisTypes",
-               "caseOrControlId": "CaseControl", "genderId": "Genders", "datasetTypeIds": "DatasetTypes",
-               "instrumentModelId": "InstrumentModels", "librarySourceId": "LibrarySources",
-               "librarySelectionId": "LibrarySelections",  "libraryStrategyId": "LibraryStrategies",
-               "studyTypeId": "StudyTypes", "chromosomeReferences": "ReferenceChromosomes",
-               "genomeId": "ReferenceGenomes", "fileTypeId": "AnalysisFileTypes", "runFileTypeId": "FileTypes"}
-
     # check info
     if len(Data) != 0:
+        # extract alias and accessions from table once for all aliases
+        Registered = ExtractAccessions(CredentialFile, MetadataDataBase, Box, Table)
         for i in range(len(Data)):
             # set up boolean. update if missing values
             Missing = False
@@ -565,8 +1073,6 @@ def IsInfoValid(CredentialFile, MetadataDataBase, SubDataBase, Table, Box, Objec
                         Error.append('Missing required key {0}'.format(key))
                 # check that alias is not already used
                 if key == 'alias':
-                    # extract alias and accessions from table
-                    Registered = ExtractAccessions(CredentialFile, MetadataDataBase, Box, Table)
                     if d[key] in Registered:
                         # alias already used for the same table and box
                         Missing = True
@@ -693,20 +1199,131 @@ def CheckTableInformation(CredentialFile, MetadataDataBase, SubDataBase, Table,
         else:
             K[alias] = 'No information. Possible issues with table keys or database connection'
                   
-    # update status and record errorMessage
-    conn = EstablishConnection(CredentialFile, SubDataBase)
-    cur = conn.cursor()    
+    # update status and record errorMessage in a single transaction
+    Transitions = StatusTransitions(CredentialFile, SubDataBase, Table, Box)
     for alias in K:
         # record error message and/or update status
         if K[alias] == 'NoError':
-            # update status
-            cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\", {0}.Status=\"clean\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, K[alias], alias, Box))
-            conn.commit()
+            # update status start --> clean
+            Transitions.Add(alias, errorMessages=K[alias], Status='clean')
         else:
             # record error
-            cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, K[alias], alias, Box))
-            conn.commit()
-    conn.close()
+            Transitions.Add(alias, errorMessages=K[alias])
+    Transitions.Flush()
+
+
+# use this function to normalize contig names extracted from a vcf
+def NormalizeVcfContigs(names):
+    '''
+    (iterable) -> list
+    Take contig names from a vcf and return a list of unique names with the
+    suffix after the first underscore removed and prefixed with chr
+    '''
+    
+    chromos = []
+    for contig in names:
+        if '_' in contig:
+            contig = contig[:contig.index('_')]
+        if not contig.lower().startswith('chr'):
+            contig = 'chr' + contig
+        chromos.append(contig)
+    # remove duplicate names
+    return list(set(chromos))
+
+
+# use this function to normalize contig names extracted from a tsv
+def NormalizeTsvContigs(names):
+    '''
+    (iterable) -> list
+    Take contig names from a tsv and return a list of unique names prefixed
+    with chr or converted to lower case if they already contain chr
+    '''
+    
+    chromos = []
+    for contig in names:
+        if 'chr' not in contig.lower():
+            contig = 'chr' + contig
+        else:
+            contig = contig.lower()
+        chromos.append(contig)
+    return list(set(chromos))
+
+
+# use this function to extract the sequence names from a tabix or csi index
+def ReadIndexContigs(file):
+    '''
+    (str) -> list
+    Take the path to a bgzipped file and return the list of sequence names
+    stored in its .tbi or .csi index, or None if the file has no usable index.
+    Indexes older than the file are ignored
+    '''
+    
+    if file[-3:] != '.gz':
+        return None
+    for suffix in ['.tbi', '.csi']:
+        index = file + suffix
+        if not os.path.isfile(index) or os.path.getmtime(index) < os.path.getmtime(file):
+            continue
+        try:
+            # indexes are bgzipped, names are stored right after the header
+            with gzip.open(index, 'rb') as infile:
+                magic = infile.read(4)
+                if magic == b'TBI\x01':
+                    # n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm
+                    header = struct.unpack('<8i', infile.read(32))
+                    l_nm = header[-1]
+                elif magic == b'CSI\x01':
+                    # min_shift, depth, l_aux
+                    l_aux = struct.unpack('<3i', infile.read(12))[-1]
+                    # names are only recorded in the tabix-style auxiliary data
+                    if l_aux < 28:
+                        continue
+                    # format, col_seq, col_beg, col_end, meta, skip, l_nm
+                    l_nm = struct.unpack('<7i', infile.read(28))[-1]
+                else:
+                    continue
+                names = infile.read(l_nm)
+        except (OSError, EOFError, struct.error):
+            continue
+        if len(names) != l_nm:
+            continue
+        return [i.decode('utf-8') for i in names.split(b'\x00') if i != b'']
+    return None
+
+
+# use this function to read the contig names saved after a full scan of a file
+def ReadSavedContigs(file, FileType):
+    '''
+    (str, str) -> list
+    Return the list of raw contig names saved for file of FileType (vcf or tsv)
+    or None if no names were saved or if the file changed since they were saved
+    '''
+    
+    Ledger = ContigLedger.Open()
+    if Ledger is None:
+        return None
+    try:
+        return Ledger.Lookup(file, FileType)
+    except (sqlite3.Error, OSError):
+        return None
+
+
+# use this function to save the contig names found by a full scan of a file
+def SaveContigs(file, FileType, names):
+    '''
+    (str, str, iterable) -> None
+    Save the raw contig names of file of FileType (vcf or tsv) in the contig
+    ledger of the state directory, so that the next runs don't scan the file
+    again. Nothing is saved if the ledger can't be written
+    '''
+    
+    Ledger = ContigLedger.Open()
+    if Ledger is None:
+        return
+    try:
+        Ledger.Record(file, FileType, os.stat(file), names)
+    except (sqlite3.Error, OSError):
+        pass
 
 
 # use this function to extract the chromosome names from the vcf
@@ -733,62 +1350,225 @@ def GetContigNamesFromVcfHeader(file):
             break
     infile.close()
     
-    chromos = [i for i in contigs if i.startswith('##contig')]
-    for i in range(len(chromos)):
-        contig = chromos[i].split(',')[0].split('=')[-1]
-        if '_' in contig:
-            contig = contig[:contig.index('_')]
-        if not contig.lower().startswith('chr'):
-            contig = 'chr' + contig
-        chromos[i] = contig
-    # remove duplicate names
-    chromos = list(set(chromos))
-           
-    return chromos        
+    chromos = [i.split(',')[0].split('=')[-1] for i in contigs if i.startswith('##contig')]
+    return NormalizeVcfContigs(chromos)
 
 
-def ExtractContigNamesFromVcf(file):
+# use this function to read the header of a BGZF block
+def ParseBgzfHeader(data):
+    '''
+    (bytes) -> tuple
+    Take the bytes at the start of a BGZF block and return a tuple with the
+    length of the block header and the total size of the block.
+    Raise ValueError if data doesn't start with a BGZF block
     '''
-    (str) -> list
     
-    Take the path to a vcf file (compressed or not) and return a list of contigs
-    specified in the vcf body
+    if len(data) < 12 or data[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError('Not a BGZF block')
+    xlen = struct.unpack('<H', data[10:12])[0]
+    # look for the BC subfield holding the block size
+    i = 12
+    while i + 4 <= 12 + xlen:
+        slen = struct.unpack('<H', data[i+2:i+4])[0]
+        if data[i:i+2] == b'BC' and slen == 2 and i + 6 <= len(data):
+            return 12 + xlen, struct.unpack('<H', data[i+4:i+6])[0] + 1
+        i += 4 + slen
+    raise ValueError('Not a BGZF block')
+
+
+# use this function to check if a file is compressed with bgzip
+def IsBgzf(file):
+    '''
+    (str) -> bool
+    Return True if file starts with a BGZF block
     '''
     
-    # get the chromosomes
-    contigs = set()
-    if file[-4:] == '.vcf':
-        infile = open(file)
-    elif file[-7:] == '.vcf.gz':
-        infile = gzip.open(file, 'rt')
-    # read vcf file  
-    for line in infile:
-        # skip header
-        if not line.startswith('#'):
-            line = line.rstrip().split('\t')
-            contigs.add(line[0])
-    infile.close()
-    # make a list of contigs
-    chromos = list(contigs)
-    for i in range(len(chromos)):
-        if '_' in chromos[i]:
-            chromos[i] = chromos[i][:chromos[i].index('_')]
-        if not chromos[i].lower().startswith('chr'):
-            chromos[i] = 'chr' + chromos[i]
-    # remove duplicate names
-    chromos = list(set(chromos))
-    return chromos        
+    try:
+        with open(file, 'rb') as infile:
+            ParseBgzfHeader(infile.read(1024))
+    except (OSError, ValueError):
+        return False
+    return True
 
 
-def ExtractContigNamesFromTSV(file):
+# use this function to split a bgzipped file in chunks of whole blocks
+def ListBgzfChunks(file, ChunkSize=8*1024*1024):
+    '''
+    (str, int) -> list
+    Return a list of (offset, length) tuples of chunks of consecutive BGZF
+    blocks of file, each chunk spanning about ChunkSize compressed bytes.
+    Only the block headers are read. Raise ValueError if file isn't BGZF compressed
     '''
-    (str) -> list
     
-    Take the path to a tsv file (compressed or not) and return a list of contigs
+    chunks = []
+    with open(file, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        start, offset = 0, 0
+        while offset < size:
+            infile.seek(offset)
+            BlockSize = ParseBgzfHeader(infile.read(1024))[1]
+            offset += BlockSize
+            if offset - start >= ChunkSize:
+                chunks.append((start, offset - start))
+                start = offset
+        if offset != size:
+            raise ValueError('{0} is truncated'.format(file))
+        if offset > start:
+            chunks.append((start, offset - start))
+    return chunks
+
+
+# use this function to get the contig name from a line of a vcf or a tsv
+def GetContigFromLine(line, FileType):
+    '''
+    (bytes, str) -> bytes
+    Return the contig in the first column of line from a file of FileType
+    (vcf or tsv) or None if the line has no contig, using the same rules
+    as ScanVcfContigs and ScanTsvContigs
+    '''
+    
+    line = line.rstrip()
+    if FileType == 'vcf':
+        if line.startswith(b'#'):
+            return None
+        i = line.find(b'\t')
+        return line if i == -1 else line[:i]
+    elif line != b'':
+        i = line.find(b'\t')
+        return (line if i == -1 else line[:i]).strip()
+    return None
+
+
+# use this function to list the contigs in a chunk of a bgzipped file
+def ScanBgzfChunk(Params):
+    '''
+    (tuple) -> tuple
+    Take a tuple with the path to a bgzipped file, the offset and length of a
+    chunk of whole BGZF blocks and the file type (vcf or tsv), decompress the
+    chunk and return a tuple with the bytes before the first newline, the set
+    of contigs of the complete lines and the bytes after the last newline.
+    The bytes before the first newline are None if the chunk has no newline
+    '''
+    
+    file, offset, length, FileType = Params
+    with open(file, 'rb') as infile:
+        infile.seek(offset)
+        data = memoryview(infile.read(length))
+    # decompress the raw deflate payload of each block
+    blocks, i = [], 0
+    while i < len(data):
+        HeaderSize, BlockSize = ParseBgzfHeader(data[i:i+1024].tobytes())
+        # the block ends with the crc32 and the size of the uncompressed data
+        blocks.append(zlib.decompress(data[i+HeaderSize:i+BlockSize-8], -15))
+        i += BlockSize
+    lines = b''.join(blocks).split(b'\n')
+    if len(lines) == 1:
+        return None, set(), lines[0]
+    contigs = set()
+    for j in range(1, len(lines) - 1):
+        contigs.add(GetContigFromLine(lines[j], FileType))
+    contigs.discard(None)
+    return lines[0], contigs, lines[-1]
+
+
+# use this function to list the contigs of a bgzipped file in parallel
+def ScanBgzfContigs(file, FileType, Workers=None, ChunkSize=8*1024*1024):
+    '''
+    (str, str, int | None, int) -> set
+    Take the path to a bgzipped vcf or tsv file and its FileType (vcf or tsv)
+    and return the set of contigs found by decompressing chunks of BGZF blocks
+    on Workers processes (all cpus by default). The result is identical to
+    ScanVcfContigs and ScanTsvContigs
+    '''
+    
+    Params = [(file, offset, length, FileType) for offset, length in ListBgzfChunks(file, ChunkSize)]
+    if Workers is None:
+        Workers = os.cpu_count() or 1
+    # daemonic processes, such as json formatting workers, can't have children
+    if multiprocessing.current_process().daemon:
+        Workers = 1
+    Workers = min(Workers, len(Params))
+    pool = None
+    if Workers > 1:
+        pool = multiprocessing.Pool(Workers)
+        results = pool.imap(ScanBgzfChunk, Params)
+    else:
+        results = map(ScanBgzfChunk, Params)
+    
+    contigs, carry = set(), b''
+    try:
+        # lines spanning chunks are put back together in file order
+        for head, names, tail in results:
+            if head is None:
+                carry += tail
+            else:
+                contigs.add(GetContigFromLine(carry + head, FileType))
+                contigs.update(names)
+                carry = tail
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if carry != b'':
+        contigs.add(GetContigFromLine(carry, FileType))
+    contigs.discard(None)
+    return set(map(lambda x: x.decode('utf-8'), contigs))
+
+
+# use this function to list the contigs in the body of a vcf
+def ScanVcfContigs(file):
+    '''
+    (str) -> set
+    Take the path to a vcf file (compressed or not) and return the set of
+    contig names found in the first column of the vcf body
     '''
     
     # get the chromosomes
-    chromos = []
+    contigs = set()
+    if file[-4:] == '.vcf':
+        infile = open(file)
+    elif file[-7:] == '.vcf.gz':
+        infile = gzip.open(file, 'rt')
+    # read vcf file  
+    for line in infile:
+        # skip header
+        if not line.startswith('#'):
+            line = line.rstrip().split('\t')
+            contigs.add(line[0])
+    infile.close()
+    return contigs
+
+
+def ExtractContigNamesFromVcf(file):
+    '''
+    (str) -> list
+    
+    Take the path to a vcf file (compressed or not) and return a list of contigs
+    specified in the vcf body. The body is scanned only if the names of a
+    previous scan are not saved
+    '''
+    
+    contigs = ReadSavedContigs(file, 'vcf')
+    if contigs is None:
+        # decompress bgzipped files in parallel
+        if IsBgzf(file):
+            contigs = ScanBgzfContigs(file, 'vcf')
+        else:
+            contigs = ScanVcfContigs(file)
+        SaveContigs(file, 'vcf', contigs)
+    return NormalizeVcfContigs(contigs)
+
+
+# use this function to list the contigs in a tsv
+def ScanTsvContigs(file):
+    '''
+    (str) -> set
+    Take the path to a tsv file (compressed or not) and return the set of
+    names found in the first column of all non-empty lines
+    '''
+    
+    # get the chromosomes
+    contigs = set()
     if file[-4:] == '.tsv':    
         infile = open(file)    
     elif file[-7:] == '.tsv.gz':
@@ -797,267 +1577,396 @@ def ExtractContigNamesFromTSV(file):
     for line in infile:
         line = line.rstrip()
         if line != '':
-            line = line.split('\t')
-            line = list(map(lambda x: x.strip(), line))
-            contig = line[0]
-            if 'chr' not in contig.lower():
-                contig = 'chr' + contig
-            else:
-                contig = contig.lower()
-            chromos.append(contig)
+            contigs.add(line.split('\t')[0].strip())
     infile.close()
-    chromos = list(set(chromos))
-    return chromos
+    return contigs
+
+
+def ExtractContigNamesFromTSV(file):
+    '''
+    (str) -> list
     
+    Take the path to a tsv file (compressed or not) and return a list of contigs.
+    The file is scanned only if the names of a previous scan are not saved
+    '''
     
-# use this function to format the analysis json
-def FormatJson(D, Object, MyScript, MyPython):
+    contigs = ReadSavedContigs(file, 'tsv')
+    if contigs is None:
+        # decompress bgzipped files in parallel
+        if IsBgzf(file):
+            contigs = ScanBgzfContigs(file, 'tsv')
+        else:
+            contigs = ScanTsvContigs(file)
+        SaveContigs(file, 'tsv', contigs)
+    return NormalizeTsvContigs(contigs)
+
+
+# use this function to get the contigs of a vcf
+def GetVcfContigs(file):
     '''
-    (dict, str, str, str) -> dict
-    Take a dictionary with information for an object, the path to the script to fetch 
-    the EGA enumerations, and return a dictionary with the expected format or
-    a dictionary with the alias only if required fields are missing
-    Precondition: strings in D have double-quotes
+    (str) -> list
+    Take the path to a vcf file (compressed or not) and return a list of contigs
+    from the tabix/csi index if available, or from the ##contig header lines,
+    or from a scan of the vcf body as a last resort
     '''
     
-    Enums = ListEnumerations(MyScript, MyPython)
-        
-    # create a dict to be strored as a json. note: strings should have double quotes
-    J = {}
+    contigs = ReadIndexContigs(file)
+    if contigs is not None:
+        return NormalizeVcfContigs(contigs)
+    contigs = GetContigNamesFromVcfHeader(file)
+    if len(contigs) == 0:
+        # if contig names not in VCF header, extract contigs from VCF file
+        contigs = ExtractContigNamesFromVcf(file)
+    return contigs
+
+
+# use this function to get the contigs of a tsv
+def GetTsvContigs(file):
+    '''
+    (str) -> list
+    Take the path to a tsv file (compressed or not) and return a list of contigs
+    from the tabix/csi index if available or from a scan of the file otherwise
+    '''
     
-    if Object == 'analyses':
-        JsonKeys = ["alias", "title", "description", "studyId", "sampleReferences",
-                    "analysisCenter", "analysisDate", "analysisTypeId", "files",
-                    "attributes", "genomeId", "chromosomeReferences", "experimentTypeId", "platform"]
-        Required = ["alias", "title", "description", "studyId", "sampleReferences", "analysisCenter",
-                    "analysisTypeId", "files", "genomeId", "experimentTypeId", "StagePath"]
-    elif Object == 'samples':
-        JsonKeys = ["alias", "title", "description", "caseOrControlId", "genderId",
-                    "organismPart", "cellLine", "region", "phenotype", "subjectId",
-                    "anonymizedName", "bioSampleId", "sampleAge", "sampleDetail", "attributes"]
-        Required = ["alias", "title", "description", "caseOrControlId", "genderId", "phenotype"] 
-    elif Object == 'datasets':
-        JsonKeys = ["alias", "datasetTypeIds", "policyId", "runsReferences", "analysisReferences",
-                    "title", "description", "datasetLinks", "attributes"]
-        Required = ['alias', 'datasetTypeIds', 'policyId', 'title', 'description', 'egaBox']
-    elif Object == 'experiments':
-        JsonKeys = ["alias", "title", "instrumentModelId", "librarySourceId", "librarySelectionId",
-                    "libraryStrategyId", "designDescription", "libraryName", "libraryConstructionProtocol",
-                    "libraryLayoutId", "pairedNominalLength", "pairedNominalSdev", "sampleId", "studyId", "egaBox"]
-        Required = ["alias", "title", "instrumentModelId", "librarySourceId", "librarySelectionId",
-                    "libraryStrategyId", "designDescription", "libraryName", "libraryLayoutId",
-                    "pairedNominalLength", "pairedNominalSdev", "sampleId", "studyId", "egaBox"]
-    elif Object == 'studies':
-        JsonKeys = ["alias", "studyTypeId", "shortName", "title", "studyAbstract", "ownTerm", "pubMedIds", "customTags", "egaBox"]
-        Required = ["alias", "studyTypeId", "title", "studyAbstract", "egaBox"]
-    elif Object == 'policies':
-        JsonKeys = ["alias", "dacId", "title", "policyText", "url", "egaBox"]
-        Required = ["alias", "dacId", "title", "policyText", "egaBox"]
-    elif Object == 'dacs':
-        JsonKeys = ["alias", "title", "contacts", "egaBox"]
-        Required = ["alias", "title", "contacts", "egaBox"]    
-    elif Object == 'runs':
-        JsonKeys = ["alias", "sampleId", "runFileTypeId", "experimentId", "files", "egaBox"]
-        Required = ["alias", "sampleId", "runFileTypeId", "experimentId", "files", "egaBox"]
+    contigs = ReadIndexContigs(file)
+    if contigs is not None:
+        return NormalizeTsvContigs(contigs)
+    return ExtractContigNamesFromTSV(file)
+    
+    
+# use this exception to abort the formatting of a json
+class JsonFormatError(Exception):
+    '''
+    Raised when the json of an alias cannot be formed. The message gives the reason
+    '''
+    pass
 
-       
-    # map typeId with enumerations
-    MapEnum = {"experimentTypeId": "ExperimentTypes", "analysisTypeId": "AnalysisTypes",
-               "caseOrControlId": "CaseControl", "genderId": "Genders", "datasetTypeIds": "DatasetTypes",
-               "instrumentModelId": "InstrumentModels", "librarySourceId": "LibrarySources",
-               "librarySelectionId": "LibrarySelections",  "libraryStrategyId": "LibraryStrategies",
-               "studyTypeId": "StudyTypes", "chromosomeReferences": "ReferenceChromosomes",
-               "genomeId": "ReferenceGenomes", "fileTypeId": "AnalysisFileTypes", "runFileTypeId": "FileTypes"}
 
+# use this class to format the jsons of many objects
+class JsonFormatter(object):
+    '''
+    Format submission jsons of a given Object. Enumerations and lookup tables
+    are loaded once when the formatter is created and shared by all aliases
+    '''
+    
+    # json keys and required fields for each object {object: [json keys, required]}
+    Keys = {'analyses': [["alias", "title", "description", "studyId", "sampleReferences",
+                          "analysisCenter", "analysisDate", "analysisTypeId", "files",
+                          "attributes", "genomeId", "chromosomeReferences", "experimentTypeId", "platform"],
+                         ["alias", "title", "description", "studyId", "sampleReferences", "analysisCenter",
+                          "analysisTypeId", "files", "genomeId", "experimentTypeId", "StagePath"]],
+            'samples': [["alias", "title", "description", "caseOrControlId", "genderId",
+                         "organismPart", "cellLine", "region", "phenotype", "subjectId",
+                         "anonymizedName", "bioSampleId", "sampleAge", "sampleDetail", "attributes"],
+                        ["alias", "title", "description", "caseOrControlId", "genderId", "phenotype"]],
+            'datasets': [["alias", "datasetTypeIds", "policyId", "runsReferences", "analysisReferences",
+                          "title", "description", "datasetLinks", "attributes"],
+                         ['alias', 'datasetTypeIds', 'policyId', 'title', 'description', 'egaBox']],
+            'experiments': [["alias", "title", "instrumentModelId", "librarySourceId", "librarySelectionId",
+                             "libraryStrategyId", "designDescription", "libraryName", "libraryConstructionProtocol",
+                             "libraryLayoutId", "pairedNominalLength", "pairedNominalSdev", "sampleId", "studyId", "egaBox"],
+                            ["alias", "title", "instrumentModelId", "librarySourceId", "librarySelectionId",
+                             "libraryStrategyId", "designDescription", "libraryName", "libraryLayoutId",
+                             "pairedNominalLength", "pairedNominalSdev", "sampleId", "studyId", "egaBox"]],
+            'studies': [["alias", "studyTypeId", "shortName", "title", "studyAbstract", "ownTerm", "pubMedIds", "customTags", "egaBox"],
+                        ["alias", "studyTypeId", "title", "studyAbstract", "egaBox"]],
+            'policies': [["alias", "dacId", "title", "policyText", "url", "egaBox"],
+                         ["alias", "dacId", "title", "policyText", "egaBox"]],
+            'dacs': [["alias", "title", "contacts", "egaBox"],
+                     ["alias", "title", "contacts", "egaBox"]],
+            'runs': [["alias", "sampleId", "runFileTypeId", "experimentId", "files", "egaBox"],
+                     ["alias", "sampleId", "runFileTypeId", "experimentId", "files", "egaBox"]]}
+    
     # map chromosome names for vcf
     chromoTonames = {'chr1': 'CM000663', 'chr2': 'CM000664', 'chr3': 'CM000665',
-                   'chr4': 'CM000666', 'chr5': 'CM000667', 'chr6': 'CM000668',
-                   'chr7': 'CM000669', 'chr8': 'CM000670', 'chr9': 'CM000671',
-                   'chr10': 'CM000672', 'chr11': 'CM000673', 'chr12': 'CM000674',
-                   'chr13': 'CM000675', 'chr14': 'CM000676', 'chr15': 'CM000677',
-                   'chr16': 'CM000678', 'chr17': 'CM000679', 'chr18': 'CM000680',
-                   'chr19': 'CM000681', 'chr20': 'CM000682', 'chr21': 'CM000683',
-                   'chr22': 'CM000684', 'chrX': 'CM000685', 'chrY': 'CM000686'}
-                      
+                     'chr4': 'CM000666', 'chr5': 'CM000667', 'chr6': 'CM000668',
+                     'chr7': 'CM000669', 'chr8': 'CM000670', 'chr9': 'CM000671',
+                     'chr10': 'CM000672', 'chr11': 'CM000673', 'chr12': 'CM000674',
+                     'chr13': 'CM000675', 'chr14': 'CM000676', 'chr15': 'CM000677',
+                     'chr16': 'CM000678', 'chr17': 'CM000679', 'chr18': 'CM000680',
+                     'chr19': 'CM000681', 'chr20': 'CM000682', 'chr21': 'CM000683',
+                     'chr22': 'CM000684', 'chrX': 'CM000685', 'chrY': 'CM000686'}
     # reverse dictionary
-    namesTochromo = {}
-    for i in chromoTonames:
-        namesTochromo[chromoTonames[i]] = i
-
-    # loop over required json keys
-    for field in JsonKeys:
-        if field in D:
-            if D[field] in ['NULL', '', None]:
-                # some fields are required, return empty dict if field is empty
-                if field in Required:
-                    # erase dict and add alias
-                    J = {}
-                    J["alias"] = D["alias"]
-                    # return dict with alias only if required fields are missing
-                    return J
-                # other fields can be missing, either as empty list or string
+    namesTochromo = dict(zip(chromoTonames.values(), chromoTonames.keys()))
+    
+    def __init__(self, Object, Enums):
+        '''
+        (str, dict) -> None
+        Set up a formatter for Object using the EGA enumerations Enums
+        '''
+        
+        self.Object = Object
+        self.Enums = Enums
+        self.JsonKeys, self.Required = self.Keys[Object]
+    
+    def Format(self, D):
+        '''
+        (JsonFormatter, dict) -> dict
+        Take a dictionary with information for an object and return a dictionary
+        with the expected format or a dictionary with the alias only if required
+        fields are missing
+        Precondition: strings in D have double-quotes
+        '''
+        
+        try:
+            return self.FormatOrRaise(D)
+        except JsonFormatError:
+            return {"alias": D["alias"]}
+    
+    def FormatBatch(self, Rows):
+        '''
+        (JsonFormatter, iterable) -> generator
+        Take an iterable of dictionaries with information for objects and yield
+        a tuple (alias, json, error) for each of them. json is None and error
+        gives the reason if the json cannot be formed, error is None otherwise
+        '''
+        
+        for D in Rows:
+            yield self.FormatRow(D)
+    
+    def FormatRow(self, D, Timeout=0):
+        '''
+        (JsonFormatter, dict, int) -> tuple
+        Take a dictionary with information for an object and return a tuple
+        (alias, json, error). Formatting is interrupted if it takes longer
+        than Timeout seconds (no limit if 0). Unexpected errors, such as
+        unreadable files, are returned as error instead of being raised
+        Precondition: Timeout can only be used in the main thread of a process
+        '''
+        
+        if Timeout:
+            signal.signal(signal.SIGALRM, _RaiseFormatTimeout)
+            signal.alarm(Timeout)
+        try:
+            return D["alias"], self.FormatOrRaise(D), None
+        except JsonFormatError as e:
+            return D["alias"], None, str(e)
+        except Exception as e:
+            return D["alias"], None, '{0}: {1}'.format(type(e).__name__, str(e).replace('"', ''))
+        finally:
+            if Timeout:
+                signal.alarm(0)
+    
+    def FormatOrRaise(self, D):
+        '''
+        (JsonFormatter, dict) -> dict
+        Take a dictionary with information for an object and return a dictionary
+        with the expected format. Raise JsonFormatError if the json cannot be formed
+        Precondition: strings in D have double-quotes
+        '''
+        
+        Object, Enums = self.Object, self.Enums
+        
+        # create a dict to be strored as a json. note: strings should have double quotes
+        J = {}
+        
+        # loop over required json keys
+        for field in self.JsonKeys:
+            if field in D:
+                if D[field] in ['NULL', '', None]:
+                    # some fields are required, no json if field is empty
+                    if field in self.Required:
+                        raise JsonFormatError('Missing required field {0}'.format(field))
+                    # other fields can be missing, either as empty list or string
+                    else:
+                        # check if field is already recorded. eg: chromosomeReferences may be set already for vcf
+                        if field not in J:
+                            # some non-required fields need to be lists
+                            if field in ["chromosomeReferences", "attributes", "datasetLinks", "runsReferences",
+                                         "analysisReferences", "pubMedIds", "customTags"]:
+                                J[field] = []
+                            else:
+                                J[field] = ""
                 else:
-                    # check if field is already recorded. eg: chromosomeReferences may be set already for vcf
-                    if field not in J:
-                        # some non-required fields need to be lists
-                        if field in ["chromosomeReferences", "attributes", "datasetLinks", "runsReferences",
-                                     "analysisReferences", "pubMedIds", "customTags"]:
-                            J[field] = []
+                    if field == 'files':
+                        assert D[field] != 'NULL'
+                        J[field] = []
+                        # convert string to dict
+                        files = D[field].replace("'", "\"")
+                        files = json.loads(files)
+                        # file format is different for analyses and runs
+                        if Object == 'analyses':
+                            # make a list of contigs used. required for vcf, optional for bam
+                            contigs = []
+                            # loop over file name
+                            for filePath in files:
+                                # check that fileTypeId is valid
+                                if files[filePath]["fileTypeId"].lower() not in Enums[MapEnum['fileTypeId']]:
+                                    # cannot obtain fileTypeId
+                                    raise JsonFormatError('Invalid fileTypeId for {0}'.format(filePath))
+                                else:
+                                    fileTypeId = Enums[MapEnum['fileTypeId']][files[filePath]["fileTypeId"].lower()]
+                                # check if analysis object is bam or vcf
+                                # chromosomeReferences is optional for bam but required for vcf and tab
+                                if files[filePath]["fileTypeId"].lower() == 'vcf':
+                                    # make a list of contigs from the index, the vcf header or the vcf body
+                                    contigs.extend(GetVcfContigs(filePath))
+                                elif files[filePath]["fileTypeId"].lower() == 'tab':
+                                    # make a list of contigs 
+                                    contigs.extend(GetTsvContigs(filePath))
+                                # create dict with file info, add path to file names
+                                d = {"fileName": os.path.join(D['StagePath'], files[filePath]['encryptedName']),
+                                     "checksum": files[filePath]['checksum'],
+                                     "unencryptedChecksum": files[filePath]['unencryptedChecksum'],
+                                     "fileTypeId": fileTypeId}
+                                J[field].append(d)
+                        
+                            # check if chromosomes were recorded
+                            if len(contigs) != 0:
+                                J['chromosomeReferences'] = self.ChromosomeReferences(D, contigs)
+                        elif Object == 'runs':
+                            # loop over file name
+                            for filePath in files:
+                                # create a dict with file info, add stagepath to file name
+                                d = {"fileName": os.path.join(D['StagePath'], files[filePath]['encryptedName']),
+                                     "checksum": files[filePath]['checksum'], "unencryptedChecksum": files[filePath]['unencryptedChecksum'],
+                                     "checksumMethod": 'md5'}
+                                J[field].append(d)
+                    elif field in ['runsReferences', 'analysisReferences', 'pubMedIds']:
+                        J[field] = D[field].split(';')
+                    elif field in ['attributes', 'datasetLinks', 'customTags']:
+                        # ensure strings are double-quoted
+                        attributes = D[field].replace("'", "\"")
+                        # convert string to dict
+                        # loop over all attributes
+                        attributes = attributes.split(';')
+                        J[field] = [json.loads(attributes[i].strip().replace("'", "\"")) for i in range(len(attributes))]
+                    elif field == 'libraryLayoutId':
+                        try:
+                            int(D[field]) in [0, 1]
+                            J[field] = int(D[field])
+                        except:
+                            # must be coded 0 for paired end or 1 for single end
+                            raise JsonFormatError('Invalid {0}: should be 0 or 1'.format(field))
+                    elif field  in ['pairedNominalLength', 'pairedNominalSdev']:
+                        try:
+                            float(D[field])
+                            J[field] = float(D[field])
+                        except:
+                            raise JsonFormatError('Invalid type for {0}, should be a number'.format(field))
+                    # check enumerations
+                    elif field in MapEnum:
+                        # check that enumeration is valid
+                        if D[field] not in Enums[MapEnum[field]]:
+                            # cannot obtain enumeration
+                            raise JsonFormatError('Invalid enumeration for {0}'.format(field))
                         else:
-                            J[field] = ""
-            else:
-                if field == 'files':
-                    assert D[field] != 'NULL'
-                    J[field] = []
-                    # convert string to dict
-                    files = D[field].replace("'", "\"")
-                    files = json.loads(files)
-                    # file format is different for analyses and runs
-                    if Object == 'analyses':
-                        # make a list of contigs used. required for vcf, optional for bam
-                        contigs = []
-                        # loop over file name
-                        for filePath in files:
-                            # create a dict to store file info
-                            # check that fileTypeId is valid
-                            if files[filePath]["fileTypeId"].lower() not in Enums[MapEnum['fileTypeId']]:
-                                # cannot obtain fileTypeId. erase dict and add alias
-                                J = {}
-                                J["alias"] = D["alias"]
-                                # return dict with alias only if required fields are missing
-                                return J
+                            # check field to add enumeration to json
+                            if field == "experimentTypeId":
+                                J[field] = [Enums[MapEnum[field]][D[field]]]
+                            elif field == "datasetTypeIds":
+                                # multiple Ids can be stored
+                                J[field] = [Enums[MapEnum[field]][k] for k in D[field].split(';')]
                             else:
-                                fileTypeId = Enums[MapEnum['fileTypeId']][files[filePath]["fileTypeId"].lower()]
-                            # check if analysis object is bam or vcf
-                            # chromosomeReferences is optional for bam but required for vcf and tab
-                            if files[filePath]["fileTypeId"].lower() == 'vcf':
-                                 # make a list of contigs from the vcf header
-                                 contigs.extend(GetContigNamesFromVcfHeader(filePath))
-                                 if len(contigs) == 0:
-                                     # if contig names not in VCF header, extract contigs from VCF file
-                                     contigs.extend(ExtractContigNamesFromVcf(filePath))
-                            elif files[filePath]["fileTypeId"].lower() == 'tab':
-                                # make a list of contigs 
-                                contigs.extend(ExtractContigNamesFromTSV(filePath))
-                            # create dict with file info, add path to file names
-                            d = {"fileName": os.path.join(D['StagePath'], files[filePath]['encryptedName']),
-                                 "checksum": files[filePath]['checksum'],
-                                 "unencryptedChecksum": files[filePath]['unencryptedChecksum'],
-                                 "fileTypeId": fileTypeId}
-                            J[field].append(d)
+                                J[field] = Enums[MapEnum[field]][D[field]]
+                    elif field == 'sampleReferences':
+                        # populate with sample accessions
+                        J[field] = [{"value": accession.strip(), "label":""} for accession in D[field].split(';')]
+                    elif field == 'contacts':
+                        J[field] = [json.loads(contact.replace("'", "\"")) for contact in D[field].split(';')]
                     
-                        # check if chromosomes were recorded
-                        if len(contigs) != 0:
-                            # remove duplicate names
-                            contigs = list(set(contigs))
-                            # map chromosome names 
-                            if 'genomeId' not in D:
-                                # erase dict and add alias
-                                J = {}
-                                J["alias"] = D["alias"]
-                                return J
-                            else:
-                                # only GRCh37 and GRch38 are supported
-                                if D['genomeId'].lower() not in ['grch37', 'grch38']:
-                                    # erase dict and add alias
-                                    J = {}
-                                    J["alias"] = D["alias"]
-                                    return J
+                    # fields added as aliases must be replaced with accessions
+                    elif field in ['studyId', 'policyId', 'dacId', 'experimentId']:
+                        a = ['studyId', 'policyId', 'dacId', 'experimentId']
+                        b = ['EGAS', 'EGAP', 'EGAC', 'EGAX']
+                        for i in range(len(a)):
+                            if field == a[i]:
+                                if D[field].startswith(b[i]):
+                                    J[field] = D[field]
                                 else:
-                                    if D['genomeId'].lower() == 'grch37':
-                                        suffix = '.1'
-                                    elif D['genomeId'].lower() == 'grch38':
-                                        suffix = '.2'
-                                    values = [chromoTonames[i] + suffix for i in contigs if i in chromoTonames]
-                                    # add chromosome reference info
-                                    J['chromosomeReferences'] = [{"value": Enums['ReferenceChromosomes'][i], "label": namesTochromo[i.replace(suffix, '')]} for i in values if i in Enums['ReferenceChromosomes']]  
-                    elif Object == 'runs':
-                        # loop over file name
-                        for filePath in files:
-                            # create a dict with file info, add stagepath to file name
-                            d = {"fileName": os.path.join(D['StagePath'], files[filePath]['encryptedName']),
-                                 "checksum": files[filePath]['checksum'], "unencryptedChecksum": files[filePath]['unencryptedChecksum'],
-                                 "checksumMethod": 'md5'}
-                            J[field].append(d)
-                elif field in ['runsReferences', 'analysisReferences', 'pubMedIds']:
-                    J[field] = D[field].split(';')
-                elif field in ['attributes', 'datasetLinks', 'customTags']:
-                    # ensure strings are double-quoted
-                    attributes = D[field].replace("'", "\"")
-                    # convert string to dict
-                    # loop over all attributes
-                    attributes = attributes.split(';')
-                    J[field] = [json.loads(attributes[i].strip().replace("'", "\"")) for i in range(len(attributes))]
-                elif field == 'libraryLayoutId':
-                    try:
-                        int(D[field]) in [0, 1]
-                        J[field] = int(D[field])
-                    except:
-                        # must be coded 0 for paired end or 1 for single end
-                        J = {}
-                        # return dict with alias if required field is missing
-                        J["alias"] = D["alias"]
-                        return J
-                elif field  in ['pairedNominalLength', 'pairedNominalSdev']:
-                    try:
-                        float(D[field])
-                        J[field] = float(D[field])
-                    except:
-                        # must be coded 0 for paired end or 1 for single end
-                        J = {}
-                        # return dict with alias if required field is missing
-                        J["alias"] = D["alias"]
-                        return J        
-                # check enumerations
-                elif field in MapEnum:
-                    # check that enumeration is valid
-                    if D[field] not in Enums[MapEnum[field]]:
-                        # cannot obtain enumeration. erase dict and add alias
-                        J = {}
-                        J["alias"] = D["alias"]
-                        # return dict with alias only if required fields are missing
-                        return J
+                                    raise JsonFormatError('Missing accession for {0}'.format(field))
                     else:
-                        # check field to add enumeration to json
-                        if field == "experimentTypeId":
-                            J[field] = [Enums[MapEnum[field]][D[field]]]
-                        elif field == "datasetTypeIds":
-                            # multiple Ids can be stored
-                            J[field] = [Enums[MapEnum[field]][k] for k in D[field].split(';')]
-                        else:
-                            J[field] = Enums[MapEnum[field]][D[field]]
-                elif field == 'sampleReferences':
-                    # populate with sample accessions
-                    J[field] = [{"value": accession.strip(), "label":""} for accession in D[field].split(';')]
-                elif field == 'contacts':
-                    J[field] = [json.loads(contact.replace("'", "\"")) for contact in D[field].split(';')]
-                
-                # fields added as aliases must be replaced with accessions
-                elif field in ['studyId', 'policyId', 'dacId', 'experimentId']:
-                    a = ['studyId', 'policyId', 'dacId', 'experimentId']
-                    b = ['EGAS', 'EGAP', 'EGAC', 'EGAX']
-                    for i in range(len(a)):
-                        if field == a[i]:
-                            if D[field].startswith(b[i]):
-                                J[field] = D[field]
-                            else:
-                                # erase dict and add alias
-                                J = {}
-                                J["alias"] = D["alias"]
-                                return J
-                else:
-                    J[field] = D[field]
-    return J                
+                        J[field] = D[field]
+        return J
+    
+    def ChromosomeReferences(self, D, contigs):
+        '''
+        (JsonFormatter, dict, list) -> list
+        Take a dictionary with information for an analysis object and a list of
+        contig names and return the list of chromosome references for the json
+        '''
+        
+        # remove duplicate names
+        contigs = list(set(contigs))
+        # map chromosome names 
+        if 'genomeId' not in D:
+            raise JsonFormatError('Missing genomeId to map chromosome names')
+        # only GRCh37 and GRch38 are supported
+        if D['genomeId'].lower() not in ['grch37', 'grch38']:
+            raise JsonFormatError('Unsupported genomeId {0}'.format(D['genomeId']))
+        if D['genomeId'].lower() == 'grch37':
+            suffix = '.1'
+        elif D['genomeId'].lower() == 'grch38':
+            suffix = '.2'
+        values = [self.chromoTonames[i] + suffix for i in contigs if i in self.chromoTonames]
+        # add chromosome reference info
+        return [{"value": self.Enums['ReferenceChromosomes'][i], "label": self.namesTochromo[i.replace(suffix, '')]} for i in values if i in self.Enums['ReferenceChromosomes']]  
+
+
+# use this function to interrupt the formatting of a json that takes too long
+def _RaiseFormatTimeout(signum, frame):
+    raise JsonFormatError('Timed out while forming json')
+
+
+# formatter of a worker process used by FormatJsonInPool
+_WorkerFormatter = None
+
+
+def _InitFormatWorker(Object, Enums, Timeout):
+    global _WorkerFormatter
+    # workers only format, they never use the parent's database connections
+    _WorkerFormatter = (JsonFormatter(Object, Enums), Timeout)
+
+
+def _FormatRowInWorker(D):
+    Formatter, Timeout = _WorkerFormatter
+    return Formatter.FormatRow(D, Timeout)
+
+
+# use this function to form jsons on a pool of processes
+def FormatJsonInPool(Rows, Object, Enums, Workers, Timeout=0):
+    '''
+    (iterable, str, dict, int, int) -> generator
+    Take an iterable of dictionaries with information for objects and yield a
+    tuple (alias, json, error) for each object as soon as it is formed by one of
+    Workers processes. Aliases taking longer than Timeout seconds (no limit if 0)
+    are yielded with an error. The order of the results is not preserved
+    '''
+    
+    pool = multiprocessing.Pool(Workers, _InitFormatWorker, (Object, Enums, Timeout))
+    try:
+        # one alias per task so that a slow alias doesn't hold others back
+        for result in pool.imap_unordered(_FormatRowInWorker, Rows, chunksize=1):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# use this function to format the analysis json
+def FormatJson(D, Object, MyScript, MyPython):
+    '''
+    (dict, str, str, str) -> dict
+    Take a dictionary with information for an object, the path to the script to fetch 
+    the EGA enumerations, and return a dictionary with the expected format or
+    a dictionary with the alias only if required fields are missing
+    Precondition: strings in D have double-quotes
+    '''
+    
+    return JsonFormatter(Object, ListEnumerations(MyScript, MyPython)).Format(D)
 
 
 
 # use this function to form jsons and store to submission db
-def AddJsonToTable(CredentialFile, DataBase, Table, Box, Object, MyScript, MyPython, **KeyWordParams):
+def AddJsonToTable(CredentialFile, DataBase, Table, Box, Object, MyScript, MyPython, Workers=1, Timeout=0, **KeyWordParams):
     '''
-    (str, str, str, str, str, str, str, dict) -> None
+    (str, str, str, str, str, str, str, int, int, dict) -> None
     Form a json for Objects in the given Box and add it to Table by
     quering required information from Table and optional tables using the file
-    with credentials to connect to Database update the status if json is formed correctly
+    with credentials to connect to Database update the status if json is formed correctly.
+    Jsons are formed on Workers processes if Workers > 1, and aliases taking
+    longer than Timeout seconds (no limit if 0) are recorded with an error
     '''
     
     # connect to the database
@@ -1117,166 +2026,1897 @@ def AddJsonToTable(CredentialFile, DataBase, Table, Box, Object, MyScript, MyPyt
         Data = cur.fetchall()
     except:
         Data = []
+    conn.close()
         
     # check that object are with appropriate status and/or that information can be extracted
     if len(Data) != 0:
-        # create a list of dicts storing the object info
-        L = []
-        for i in Data:
-            D = {}
-            assert len(i) == len(Header)
-            for j in range(len(i)):
-                D[Header[j]] = i[j]
-            L.append(D)
-        # create object-formatted jsons from each dict 
-        Jsons = [FormatJson(D, Object, MyScript, MyPython) for D in L]
-        # add json back to table and update status
-        for D in Jsons:
+        # create dicts storing the object info
+        Rows = (dict(zip(Header, i)) for i in Data)
+        # load enumerations once and create object-formatted jsons from each dict 
+        Enums = ListEnumerations(MyScript, MyPython)
+        if Workers > 1:
+            Results = FormatJsonInPool(Rows, Object, Enums, Workers, Timeout)
+        else:
+            Formatter = JsonFormatter(Object, Enums)
+            Results = (Formatter.FormatRow(D, Timeout) for D in Rows)
+        # add json back to table and update status in a single transaction
+        Transitions = StatusTransitions(CredentialFile, DataBase, Table, Box)
+        for alias, J, Error in Results:
             # check if json is correctly formed (ie. required fields are present)
-            if len(D) == 1:
-                Error = 'Cannot form json, required field(s) missing'
+            if J is None:
                 # add error in table and keep status (uploaded --> uploaded for analyses and valid --> valid for samples)
-                alias = D['alias']
-                cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, alias, Box))
-                conn.commit()
+                Transitions.Add(alias, errorMessages='Cannot form json: {0}'.format(Error))
             else:
                 # add json back in table and update status
-                alias = D['alias']
-                cur.execute('UPDATE {0} SET {0}.Json=\"{1}\", {0}.errorMessages=\"None\", {0}.Status=\"submit\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\";'.format(Table, str(D), alias, Box))
-                conn.commit()
-    conn.close()
+                Transitions.Add(alias, Json=str(J), errorMessages='None', Status='submit')
+        Transitions.Flush()
 
 
-# use this function to check the job exit status
-def GetJobExitStatus(JobName):
+# use this function to get the directory where job exit codes and array manifests are saved
+def GetJobDir():
+    '''
+    () -> str
+    Return the directory set by GAEA_JOB_DIR or ~/.gaea/jobs, creating it if needed.
+    The directory must be shared with the cluster nodes
+    '''
+    
+    JobDir = os.environ.get('GAEA_JOB_DIR', os.path.join(os.path.expanduser('~'), '.gaea', 'jobs'))
+    os.makedirs(JobDir, exist_ok=True)
+    return JobDir
+
+
+# use this function to get the directory where the SQLite stores are saved
+def GetStateDir():
+    '''
+    () -> str
+    Return the directory set by GAEA_STATE_DIR, or .gaea in the submission scratch
+    if it exists, or the job directory, creating it if needed. SQLite needs
+    working fcntl locks on the directory across the cluster nodes, unlike NFS
+    '''
+    
+    StateDir = os.environ.get('GAEA_STATE_DIR')
+    if StateDir is None:
+        Scratch = '/scratch2/groups/gsi/bis/EGA_Submissions'
+        StateDir = os.path.join(Scratch, '.gaea') if os.path.isdir(Scratch) else GetJobDir()
+    os.makedirs(StateDir, exist_ok=True)
+    return StateDir
+
+
+# use this function to save the exit code of a job
+def WriteJobExit(JobName, ExitCode):
+    '''
+    (str, int) -> None
+    Save the exit code of JobName in the job directory
+    '''
+    
+    ExitFile = os.path.join(GetJobDir(), JobName + '.exit')
+    with open(ExitFile + '.tmp', 'w') as newfile:
+        newfile.write(str(ExitCode) + '\n')
+    os.replace(ExitFile + '.tmp', ExitFile)
+
+
+# use this function to read the exit code saved for a job
+def ReadJobExit(JobName):
     '''
     (str) -> str
-    Take a job name and return the exit code of that job after it finished running
-    ('0' indicates a normal, error-free run and '1' or another value inicates an error)
+    Return the exit code saved for JobName or None if no exit code was saved
+    '''
+    
+    try:
+        with open(os.path.join(GetJobDir(), JobName + '.exit')) as infile:
+            return infile.read().strip()
+    except OSError:
+        return None
+
+
+# use this function to remove the exit code of a previous run of a job
+def ClearJobExit(JobName):
+    '''
+    (str) -> None
+    Remove the exit code saved for JobName so that a new run isn't checked against an old exit code
+    '''
+    
+    ExitFile = os.path.join(GetJobDir(), JobName + '.exit')
+    if os.path.isfile(ExitFile):
+        os.remove(ExitFile)
+
+
+# use this function to record when a job is submitted
+def RecordJobSubmission(JobName, Parent=None):
+    '''
+    (str, str | None) -> None
+    Remove the exit code of a previous run of JobName and save the submission
+    time so that only runs ending after the submission are taken as finished.
+    Parent is the name of the job running JobName if JobName is part of a pack
+    or of an array job
+    '''
+    
+    ClearJobExit(JobName)
+    SubmitFile = os.path.join(GetJobDir(), JobName + '.submitted')
+    with open(SubmitFile + '.tmp', 'w') as newfile:
+        newfile.write(str(time.time()) + '\n')
+        if Parent is not None:
+            newfile.write(Parent + '\n')
+    os.replace(SubmitFile + '.tmp', SubmitFile)
+
+
+# use this function to read when a job was submitted
+def ReadJobSubmission(JobName):
+    '''
+    (str) -> float
+    Return the time at which JobName was last submitted or None if it wasn't recorded
+    '''
+    
+    try:
+        with open(os.path.join(GetJobDir(), JobName + '.submitted')) as infile:
+            return float(infile.readline().strip())
+    except (OSError, ValueError):
+        return None
+
+
+# use this function to get the job running a job of a pack
+def ReadJobParent(JobName):
+    '''
+    (str) -> str
+    Return the name of the job running JobName or None if JobName isn't part
+    of a pack or of an array job
+    '''
+    
+    try:
+        with open(os.path.join(GetJobDir(), JobName + '.submitted')) as infile:
+            Parent = infile.read().split('\n')[1].strip()
+    except (OSError, IndexError):
+        return None
+    return Parent if Parent != '' else None
+
+
+# line sending the name and exit code of a finished job to the watcher listening
+# at the address saved in the job directory {0}. jobs don't wait for a watcher
+# that can't be reached, the watcher then finds the exit code in its next round
+JobNotifier = '''read -r Host Port < "{0}/watcher.address" 2>/dev/null && timeout 10 bash -c 'echo "$1 $2" > "/dev/tcp/$3/$4"' _ "{1}" "$ExitCode" "$Host" "$Port" 2>/dev/null
+'''
+
+
+# script running the task of an array job listed at the line of the task index in the manifest
+ArrayDispatcher = '''Task=${{SGE_TASK_ID:-${{SLURM_ARRAY_TASK_ID:-$1}}}}
+Id=${{JOB_ID:-${{SLURM_ARRAY_JOB_ID:-$$}}}}.$Task
+IFS=$'\\t' read -r JobName BashScript LogDir < <(sed -n "${{Task}}p" {0})
+bash "$BashScript" > "$LogDir/$JobName.o$Id" 2> "$LogDir/$JobName.e$Id"
+ExitCode=$?
+echo $ExitCode > "{1}/$JobName.exit.$Id" && mv "{1}/$JobName.exit.$Id" "{1}/$JobName.exit"
+''' + JobNotifier.format('{1}', '$JobName') + '''exit $ExitCode
+'''
+
+
+# use this function to write the manifest and dispatcher script of an array job
+def WriteArrayManifest(ArrayName, Tasks):
+    '''
+    (str, list) -> str
+    Take the name of an array job and a list of (job name, bash script, log dir)
+    tasks, write the manifest with one task per line and the script dispatching
+    tasks by index and return the path to the dispatcher script
+    '''
+    
+    ArrayDir = os.path.join(GetJobDir(), 'arrays')
+    os.makedirs(ArrayDir, exist_ok=True)
+    Manifest = os.path.join(ArrayDir, ArrayName + '.manifest')
+    with open(Manifest, 'w') as newfile:
+        for JobName, BashScript, LogDir in Tasks:
+            # exit codes of previous runs must not be mistaken for the new ones.
+            # tasks killed before saving their exit code fail with their array
+            RecordJobSubmission(JobName, ArrayName)
+            newfile.write('\t'.join([JobName, BashScript, LogDir]) + '\n')
+    Dispatcher = os.path.join(ArrayDir, ArrayName + '.sh')
+    with open(Dispatcher, 'w') as newfile:
+        newfile.write(ArrayDispatcher.format(Manifest, GetJobDir()))
+    return Dispatcher
+
+
+# script running the jobs of a pack one after the other, each with its own logs and exit code
+PackRunner = '''Id=${{JOB_ID:-${{SLURM_JOB_ID:-$$}}}}
+Failed=0
+{0}exit $Failed
+'''
+
+PackMember = '''bash "{1}" > "{2}/{0}.o$Id" 2> "{2}/{0}.e$Id"
+ExitCode=$?
+[ $ExitCode -eq 0 ] || Failed=1
+echo $ExitCode > "{3}/{0}.exit.$Id" && mv "{3}/{0}.exit.$Id" "{3}/{0}.exit"
+''' + JobNotifier.format('{3}', '{0}')
+
+
+# script running a job submitted to a cluster, saving its exit code like array tasks
+# so that finished jobs are known without waiting for the accounting of the scheduler
+JobRunner = '''JobName=$1
+Id=${{JOB_ID:-${{SLURM_JOB_ID:-$$}}}}
+bash "$2"
+ExitCode=$?
+echo $ExitCode > "{0}/$JobName.exit.$Id" && mv "{0}/$JobName.exit.$Id" "{0}/$JobName.exit"
+''' + JobNotifier.format('{0}', '$JobName') + '''exit $ExitCode
+'''
+
+
+# use this function to write the script running the jobs submitted to a cluster
+def WriteJobRunner():
+    '''
+    () -> str
+    Write the script running jobs submitted to a cluster in the job directory
+    if it doesn't already exist and return its path. The script is called
+    with the job name and the bash script of the job
+    '''
+    
+    Runner = os.path.join(GetJobDir(), 'runner.sh')
+    Content = JobRunner.format(GetJobDir())
+    try:
+        with open(Runner) as infile:
+            if infile.read() == Content:
+                return Runner
+    except OSError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=GetJobDir(), prefix='.runner.')
+    with os.fdopen(fd, 'w') as newfile:
+        newfile.write(Content)
+    os.chmod(tmp, 0o755)
+    os.replace(tmp, Runner)
+    return Runner
+
+
+# use this function to tell the watcher that a job finished
+def NotifyWatcher(JobName, ExitCode):
+    '''
+    (str, int) -> None
+    Send the name and exit code of a finished job to the watcher listening at
+    the address saved in the job directory. Nothing is sent if no watcher listens
     '''
     
-    # make a sorted list of accounting files with job info archives
-    Archives = subprocess.check_output('ls -lt /oicr/cluster/ogs2011.11/default/common/accounting*', shell=True).decode('utf-8').rstrip().split('\n')
-    # keep accounting files for the current year
-    Archives = [Archives[i].split()[-1] for i in range(len(Archives)) if ':' in Archives[i].split()[-2]]
+    try:
+        with open(os.path.join(GetJobDir(), 'watcher.address')) as infile:
+            Host, Port = infile.read().split()
+        with socket.create_connection((Host, int(Port)), timeout=10) as conn:
+            conn.sendall('{0} {1}\n'.format(JobName, ExitCode).encode('utf-8'))
+    except (OSError, ValueError):
+        pass
+
+
+# use this class to wake up the watcher when jobs finish
+class JobListener:
+    '''
+    Listen on Port (any free port by default) for the notifications sent by
+    finished jobs and save the address of the watcher in the job directory.
+    Notifications only wake up the watcher, exit codes are read from the job directory
+    '''
     
-    # loop over the most recent archives and stop when job is found    
-    for AccountingFile in Archives:
+    def __init__(self, Port=0):
+        self.Server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.Server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            i = subprocess.check_output('qacct -j {0} -f {1}'.format(JobName, AccountingFile), shell=True).decode('utf-8').rstrip().split('\n')
-        except:
-            i = ''
-        else:
-            if i != '':
+            self.Server.bind(('', Port))
+            self.Server.listen(128)
+        except OSError:
+            self.Server.close()
+            raise
+        self.Address = '{0} {1}\n'.format(socket.getfqdn(), self.Server.getsockname()[1])
+        self.AddressFile = os.path.join(GetJobDir(), 'watcher.address')
+        fd, TempFile = tempfile.mkstemp(dir=GetJobDir())
+        with os.fdopen(fd, 'w') as newfile:
+            newfile.write(self.Address)
+        os.replace(TempFile, self.AddressFile)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.Close()
+    
+    def Wait(self, Timeout, Settle=5):
+        '''
+        (float, float) -> set
+        Return the names of the jobs that notified the watcher, as soon as no other
+        job notifies within Settle seconds of the last notification, or after Timeout seconds
+        '''
+        
+        JobNames, End = set(), time.time() + Timeout
+        while True:
+            Remaining = End - time.time()
+            if Remaining <= 0:
                 break
-            
-    # create a dict with months
-    Months = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
-               'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
-    
-    # check if accounting file with job has been found
-    if i == '':
-        # return error
-        return '1'        
-    else:
-        # record all exit status. the same job may have been run multiple times if re-encryption was needed
-        d = {}
-        for j in i:
-            if 'end_time' in j:
-                k = j.split()[2:]
-                if len(k) != 0:
-                    # convert date to epoch time
-                    date = '.'.join([k[1], Months[k[0]], k[-1]]) + ' ' + k[2] 
-                    p = '%d.%m.%Y %H:%M:%S'
-                    date = int(time.mktime(time.strptime(date, p)))
-                else:
-                    date = 0
-            elif 'exit_status' in j:
-                d[date] = j.split()[1]
-        # get the exit status of the most recent job    
-        EndJobs = list(d.keys())
-        EndJobs.sort()
-        if len(d) != 0:
-            # return exit code
-            return d[EndJobs[-1]]
+            Ready, _, _ = select.select([self.Server], [], [], Remaining)
+            if len(Ready) == 0:
+                break
+            try:
+                conn, _ = self.Server.accept()
+            except OSError:
+                continue
+            with conn:
+                conn.settimeout(5)
+                try:
+                    Message = conn.recv(4096).decode('utf-8', 'replace').split()
+                except OSError:
+                    Message = []
+            if len(Message) != 0:
+                JobNames.add(Message[0])
+            # jobs of an alias tend to finish together
+            End = min(End, time.time() + Settle)
+        return JobNames
+    
+    def Close(self):
+        '''
+        (None) -> None
+        Stop listening and remove the address of the watcher unless another watcher replaced it
+        '''
+        
+        self.Server.close()
+        try:
+            with open(self.AddressFile) as infile:
+                if infile.read() == self.Address:
+                    os.remove(self.AddressFile)
+        except OSError:
+            pass
+
+
+# use this function to group small files in packs run by a single job
+def PackFiles(Sizes, PackSize):
+    '''
+    (list, int) -> list
+    Take a list of file sizes and return a list of packs of indices of the files.
+    Consecutive files smaller than PackSize are grouped while the total size of
+    the pack doesn't exceed PackSize, other files are alone in their pack
+    '''
+    
+    Packs, Total = [], 0
+    for i in range(len(Sizes)):
+        if PackSize > 0 and Sizes[i] < PackSize and len(Packs) != 0 and Total != 0 and Total + Sizes[i] <= PackSize:
+            Packs[-1].append(i)
+            Total += Sizes[i]
         else:
-            # return error
-            return '1'
+            Packs.append([i])
+            # only packs of small files take more files
+            Total = Sizes[i] if PackSize > 0 and Sizes[i] < PackSize else 0
+    return Packs
+
+
+# use this function to write the script running the jobs of a pack
+def WritePackScript(BashScript, PackName, Members, LogDir):
+    '''
+    (str, str, list, str) -> str
+    Take the path to the script of the pack PackName and a list of (job name,
+    bash script) of the jobs of the pack, write the script running the jobs
+    one after the other and return its path. Each job saves its logs in LogDir
+    and its exit code under its own name so that it is checked like any other job
+    '''
     
-# use this function to grab all sub-directories of a given directory on the staging server
-def GetSubDirectories(UserName, PassWord, Directory):
+    with open(BashScript, 'w') as newfile:
+        newfile.write(PackRunner.format(''.join([PackMember.format(JobName, Script, LogDir, GetJobDir()) for JobName, Script in Members])))
+    for JobName, Script in Members:
+        RecordJobSubmission(JobName, PackName)
+    return BashScript
+
+
+# use this function to format a wallclock limit
+def FormatWallclock(Time):
+    '''
+    (int) -> str
+    Return the number of seconds Time as HH:MM:SS
+    '''
+    
+    Time = int(Time)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(Time // 3600, Time % 3600 // 60, Time % 60)
+
+
+# use this function to parse the wallclock limit of a queue from the command line
+def ParseQueue(Queue):
+    '''
+    (str) -> tuple
+    Take a queue given as name=hours and return a tuple (name, hours)
+    '''
+    
+    Name, Hours = Queue.rpartition('=')[0], Queue.rpartition('=')[-1]
+    try:
+        Hours = float(Hours)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Queue must be given as name=hours, not {0}'.format(Queue))
+    if Name == '' or Hours < 0:
+        raise argparse.ArgumentTypeError('Queue must be given as name=hours, not {0}'.format(Queue))
+    return Name, Hours
+
+
+# use this class as the interface of the job schedulers launching encryption and upload jobs
+class Scheduler(abc.ABC):
+    '''
+    Base class of the job schedulers. Jobs are bash scripts identified by
+    their name. Dependencies are given as names of jobs that must finish
+    before the job starts, whatever their exit status, like qsub -hold_jid.
+    Schedulers must implement submission, exit status, counting and
+    cancellation. Completions and Usage are optional and only available if
+    TracksCompletions and TracksUsage are True
+    '''
+    
+    # end times and exit codes of finished jobs are available from Completions
+    TracksCompletions = False
+    # memory and wallclock of finished jobs are available from Usage
+    TracksUsage = False
+    
+    @abc.abstractmethod
+    def Submit(self, JobName, BashScript, LogDir, Mem=None, Holds=None, Time=None, Queue=None):
+        '''
+        (Scheduler, str, str, str, str | None, list | None, int | None, str | None) -> int
+        Launch BashScript as JobName once all jobs named in Holds are done,
+        using Mem Gb of memory, a wallclock limit of Time seconds and Queue
+        if given and saving out and error logs as LogDir/JobName.o<id> and
+        LogDir/JobName.e<id>. Return 0 if the job was submitted or the non-zero
+        exit code of the submission
+        '''
+    
+    @abc.abstractmethod
+    def SubmitArray(self, ArrayName, Dispatcher, Size, LogDir, Mem=None, Holds=None, MaxRunning=0, Time=None, Queue=None):
+        '''
+        (Scheduler, str, str, int, str, str | None, list | None, int, int | None, str | None) -> int
+        Launch the Dispatcher script as an array job of Size tasks named ArrayName
+        once all jobs named in Holds are done, running at most MaxRunning tasks
+        at once (no limit if 0). The submission of ArrayName is recorded.
+        Return 0 if the array was submitted or the non-zero exit code of the submission
+        '''
+    
+    @abc.abstractmethod
+    def ExitStatus(self, JobName):
+        '''
+        (Scheduler, str) -> str
+        Return the exit code of the most recent run of JobName after it finished
+        ('0' indicates a normal, error-free run and '1' or another value an error)
+        '''
+    
+    def ExitStatuses(self, JobNames):
+        '''
+        (Scheduler, list) -> dict
+        Return a dictionary with the exit code of each job in JobNames
+        '''
+        return {i: self.ExitStatus(i) for i in JobNames}
+    
+    def Completions(self, JobNames):
+        '''
+        (Scheduler, list) -> dict
+        Return a dictionary with the (end time in seconds since the epoch, exit code)
+        of the most recent run of each job in JobNames. Jobs not known to have
+        finished are not in the dictionary
+        '''
+        return {}
+    
+    def Usage(self, JobNames):
+        '''
+        (Scheduler, list) -> dict
+        Return a dictionary with the (maximum memory in bytes, wallclock in seconds)
+        of the most recent successful run of each job in JobNames. Jobs without
+        usage information are not in the dictionary
+        '''
+        return {}
+    
+    @abc.abstractmethod
+    def CountJobs(self, Pattern):
+        '''
+        (Scheduler, str) -> int
+        Return the number of queued or running jobs with Pattern in their name
+        '''
+    
+    @abc.abstractmethod
+    def ActiveJobs(self):
+        '''
+        (Scheduler) -> set
+        Return the names of the queued or running jobs of the user
+        '''
+    
+    @abc.abstractmethod
+    def Cancel(self, JobName):
+        '''
+        (Scheduler, str) -> int
+        Cancel queued or running jobs named JobName and return the exit code of the cancellation
+        '''
+
+
+# use this class to share an SQLite file between processes and jobs
+class SqliteStore(object):
+    '''
+    SQLite file shared by the submission processes and the jobs, saved as FileName
+    in the state directory unless the environment variable Variable gives its path.
+    A single process writes the store at a time: writers take the lock file
+    next to the store for the whole write, readers don't wait for writers.
+    Subclasses set FileName, Variable, Description and the Schema statements
+    '''
+    
+    FileName, Variable, Description = None, None, None
+    Schema = []
+    
+    def __init__(self, StoreFile=None):
+        '''
+        (str | None) -> None
+        Set up the store in StoreFile, the file named by Variable or FileName
+        in the state directory and create its tables
+        '''
+        
+        if StoreFile is None:
+            StoreFile = os.environ.get(self.Variable) or os.path.join(GetStateDir(), self.FileName)
+        self.StoreFile = StoreFile
+        with self.Writing() as conn:
+            self.Migrate(conn)
+            for i in self.Schema:
+                conn.execute(i)
+    
+    @classmethod
+    def Open(cls, *args):
+        '''
+        (type, list) -> SqliteStore | None
+        Return the store set up with args or None if it can't be opened
+        '''
+        
+        try:
+            return cls(*args)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            print('Could not open the {0}: {1}'.format(cls.Description, e), file=sys.stderr)
+            return None
+    
+    def Migrate(self, conn):
+        '''
+        (SqliteStore, sqlite3.Connection) -> None
+        Update tables written by earlier versions before the Schema is applied
+        '''
+        
+        pass
+    
+    def Connect(self):
+        '''
+        (SqliteStore) -> sqlite3.Connection
+        Open a connection to the store
+        '''
+        
+        return sqlite3.connect(self.StoreFile, timeout=300)
+    
+    @contextlib.contextmanager
+    def Reading(self):
+        '''
+        (SqliteStore) -> sqlite3.Connection
+        Yield a connection to the store closed on exit
+        '''
+        
+        conn = self.Connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+    
+    @contextlib.contextmanager
+    def Writing(self):
+        '''
+        (SqliteStore) -> sqlite3.Connection
+        Yield a connection to the store holding the lock of the writer,
+        committed on exit unless an exception is raised
+        '''
+        
+        with open(self.StoreFile + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with self.Reading() as conn:
+                    with conn:
+                        yield conn
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# use this class to look up the accounting of SGE jobs without scanning the accounting files with qacct
+class AccountingIndex(SqliteStore):
+    '''
+    SQLite index of the SGE accounting files {job name: (end_time, exit_status,
+    maxvmem, wallclock)}. Jobs that failed with a zero exit status, like jobs
+    killed by the scheduler, take the failed code as exit status as qacct
+    reports them as errors. Accounting files are read incrementally from the
+    offset reached by the previous update, rotated files are recognized by
+    their inode and only files modified in the last History days are indexed
+    '''
+    
+    FileName, Variable, Description = 'accounting.sqlite', 'GAEA_ACCOUNTING_INDEX', 'accounting index'
+    Schema = ['CREATE TABLE IF NOT EXISTS jobs (job_name TEXT NOT NULL, job_number INTEGER, task_number INTEGER, end_time INTEGER, failed INTEGER, exit_status INTEGER, maxvmem REAL, wallclock REAL, PRIMARY KEY (job_number, task_number, end_time))',
+              'CREATE INDEX IF NOT EXISTS jobs_name ON jobs (job_name, end_time)',
+              'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, offset INTEGER)']
+    
+    def __init__(self, Pattern, IndexFile=None, History=365):
+        '''
+        (str, str | None, int) -> None
+        Set up the index of the accounting files matching Pattern in IndexFile,
+        GAEA_ACCOUNTING_INDEX or accounting.sqlite in the state directory
+        '''
+        
+        self.Pattern = Pattern
+        self.History = History
+        SqliteStore.__init__(self, IndexFile)
+    
+    def Migrate(self, conn):
+        Columns = [i[1] for i in conn.execute('PRAGMA table_info(jobs)')]
+        if len(Columns) != 0 and 'failed' not in Columns:
+            # index written before the failed codes were kept, index the files again
+            conn.execute('DROP TABLE jobs')
+            conn.execute('DROP TABLE IF EXISTS files')
+    
+    def Update(self, ChunkSize=16*1024*1024):
+        '''
+        (AccountingIndex, int) -> int
+        Index the records appended to the accounting files since the last
+        update and return the number of new records. Updates from concurrent
+        processes are serialized by the lock of the writer
+        '''
+        
+        Count = 0
+        with self.Writing() as conn:
+            Known = {i[0]: (i[1], i[2], i[3]) for i in conn.execute('SELECT path, inode, size, offset FROM files')}
+            # offsets by inode to continue reading files renamed by rotation
+            Inodes = {Known[i][0]: Known[i][2] for i in Known}
+            for AccountingFile in sorted(glob.glob(self.Pattern)):
+                stat = os.stat(AccountingFile)
+                if stat.st_mtime < time.time() - self.History * 24 * 3600:
+                    continue
+                if AccountingFile in Known and Known[AccountingFile][:2] == (stat.st_ino, stat.st_size):
+                    # no new records
+                    continue
+                Offset = 0
+                if AccountingFile[-3:] != '.gz':
+                    if AccountingFile in Known and Known[AccountingFile][0] == stat.st_ino:
+                        Offset = Known[AccountingFile][2]
+                    elif AccountingFile not in Known and stat.st_ino in Inodes:
+                        Offset = Inodes[stat.st_ino]
+                    if Offset > stat.st_size:
+                        # file was truncated
+                        Offset = 0
+                Count += self.IndexAccountingFile(conn, AccountingFile, stat, Offset, ChunkSize)
+        return Count
+    
+    def IndexAccountingFile(self, conn, AccountingFile, stat, Offset, ChunkSize):
+        '''
+        (AccountingIndex, sqlite3.Connection, str, os.stat_result, int, int) -> int
+        Index the complete records of AccountingFile after Offset with the
+        connection of the writer and return the number of records. Each chunk
+        is committed with the offset reached
+        '''
+        
+        Count, Remainder = 0, b''
+        if AccountingFile[-3:] == '.gz':
+            infile = gzip.open(AccountingFile, 'rb')
+        else:
+            infile = open(AccountingFile, 'rb')
+            infile.seek(Offset)
+        with infile:
+            while True:
+                data = infile.read(ChunkSize)
+                if not data:
+                    break
+                data = Remainder + data
+                end = data.rfind(b'\n')
+                if end == -1:
+                    Remainder = data
+                    continue
+                Records = ParseAccountingRecords(data[:end])
+                Remainder = data[end+1:]
+                Offset += end + 1
+                conn.executemany('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?)', Records)
+                if AccountingFile[-3:] != '.gz':
+                    # the size is only known to be indexed once the whole file is read
+                    conn.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?)', (AccountingFile, stat.st_ino, None, Offset))
+                conn.commit()
+                Count += len(Records)
+        # files are read again only if their size changes, a partial last record
+        # is read from the offset once the file grows. archives are indexed once
+        conn.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?)', (AccountingFile, stat.st_ino, stat.st_size, Offset if AccountingFile[-3:] != '.gz' else stat.st_size))
+        conn.commit()
+        return Count
+    
+    def Lookup(self, JobNames):
+        '''
+        (AccountingIndex, list) -> dict
+        Update the index and return a dictionary with the (end_time, exit_status,
+        maxvmem, wallclock) of the most recent run of each job in JobNames.
+        Jobs not found in the accounting files are not in the dictionary
+        '''
+        
+        self.Update()
+        JobNames = list(set(JobNames))
+        D = {}
+        with self.Reading() as conn:
+            # stay below the maximum number of sqlite parameters
+            for i in range(0, len(JobNames), 500):
+                Names = JobNames[i:i+500]
+                Query = 'SELECT job_name, end_time, CASE WHEN exit_status = 0 THEN failed ELSE exit_status END, maxvmem, wallclock FROM jobs WHERE job_name IN ({0}) ORDER BY end_time, rowid'.format(','.join(['?'] * len(Names)))
+                for row in conn.execute(Query, Names):
+                    D[row[0]] = row[1:]
+        return D
+
+
+# use this function to parse the records of a SGE accounting file
+def ParseAccountingRecords(data):
+    '''
+    (bytes) -> list
+    Take newline-separated records of a SGE accounting file and return a list
+    of (job_name, job_number, task_number, end_time, failed, exit_status, maxvmem, wallclock)
+    tuples. Comments and malformed records are skipped
+    '''
+    
+    Records = []
+    for line in data.split(b'\n'):
+        if line.startswith(b'#'):
+            continue
+        # see accounting(5) for the field order. the category (field 39) is free
+        # text with colons (-l h_rt=01:00:00), fields after it are read from the right
+        fields = line.split(b':', 39)
+        if len(fields) < 40:
+            continue
+        tail = fields[39].rsplit(b':', 4)
+        if len(tail) < 5:
+            continue
+        # pe_taskid, maxvmem, arid and ar_submission_time are split off the right, iow stays with the category
+        try:
+            Records.append((fields[4].decode('utf-8'), int(fields[5]), int(fields[35]), int(fields[10]), int(fields[11]), int(fields[12]), float(tail[2]), float(fields[13])))
+        except (ValueError, UnicodeDecodeError):
+            continue
+    return Records
+
+
+# use this class to launch jobs on the SGE cluster
+class SgeScheduler(Scheduler):
+    '''
+    Submit jobs with qsub, get exit status from an index of the accounting
+    files, or with qacct if the index can't be used, and count or cancel
+    jobs with qstat and qdel
+    '''
+    
+    TracksCompletions = True
+    TracksUsage = True
+    
+    def __init__(self, Project='gsi', Accounting='/oicr/cluster/ogs2011.11/default/common/accounting*'):
+        self.Project = Project
+        self.Accounting = Accounting
+        self.Index = None
+    
+    def Submit(self, JobName, BashScript, LogDir, Mem=None, Holds=None, Time=None, Queue=None):
+        RecordJobSubmission(JobName)
+        QsubCmd = 'qsub -b y -P {0}'.format(self.Project)
+        if Holds:
+            QsubCmd += ' -hold_jid {0}'.format(','.join(Holds))
+        QsubCmd += self.Resources(Mem, Time, Queue)
+        QsubCmd += " -N {0} -e {1} -o {1} \"bash {2} {0} {3}\"".format(JobName, LogDir, WriteJobRunner(), BashScript)
+        return subprocess.call(QsubCmd, shell=True)
+    
+    def SubmitArray(self, ArrayName, Dispatcher, Size, LogDir, Mem=None, Holds=None, MaxRunning=0, Time=None, Queue=None):
+        RecordJobSubmission(ArrayName)
+        QsubCmd = 'qsub -b y -P {0} -t 1-{1}'.format(self.Project, Size)
+        if MaxRunning > 0:
+            QsubCmd += ' -tc {0}'.format(MaxRunning)
+        if Holds:
+            QsubCmd += ' -hold_jid {0}'.format(','.join(Holds))
+        QsubCmd += self.Resources(Mem, Time, Queue)
+        QsubCmd += " -N {0} -e {1} -o {1} \"bash {2}\"".format(ArrayName, LogDir, Dispatcher)
+        return subprocess.call(QsubCmd, shell=True)
+    
+    def Resources(self, Mem, Time, Queue):
+        '''
+        (SgeScheduler, str | None, int | None, str | None) -> str
+        Return the qsub options requesting Mem Gb, Time seconds and Queue
+        '''
+        
+        Options = ''
+        if Mem is not None:
+            Options += ' -l h_vmem={0}g'.format(Mem)
+        if Time is not None:
+            Options += ' -l h_rt={0}'.format(FormatWallclock(Time))
+        if Queue is not None:
+            Options += ' -q {0}'.format(Queue)
+        return Options
+    
+    def ExitStatus(self, JobName):
+        return self.ExitStatuses([JobName])[JobName]
+    
+    def ExitStatuses(self, JobNames):
+        try:
+            if self.Index is None:
+                self.Index = AccountingIndex(self.Accounting)
+            Records = self.Index.Lookup(JobNames)
+        except (sqlite3.Error, OSError):
+            # index not available, scan the accounting files
+            return {i: self.QacctExitStatus(i) for i in JobNames}
+        # return an error for jobs not found
+        return {i: str(Records[i][1]) if i in Records else '1' for i in JobNames}
+    
+    def Completions(self, JobNames):
+        try:
+            if self.Index is None:
+                self.Index = AccountingIndex(self.Accounting)
+            Records = self.Index.Lookup(JobNames)
+        except (sqlite3.Error, OSError):
+            return {}
+        return {i: (int(Records[i][0]), str(Records[i][1])) for i in Records}
+    
+    def Usage(self, JobNames):
+        try:
+            if self.Index is None:
+                self.Index = AccountingIndex(self.Accounting)
+            Records = self.Index.Lookup(JobNames)
+        except (sqlite3.Error, OSError):
+            return {}
+        return {i: (Records[i][2], Records[i][3]) for i in Records if str(Records[i][1]) == '0' and Records[i][2] is not None}
+    
+    def QacctExitStatus(self, JobName):
+        '''
+        (SgeScheduler, str) -> str
+        Return the exit code of the most recent run of JobName using qacct
+        on the accounting files of the current year
+        '''
+        
+        # make a sorted list of accounting files with job info archives
+        Archives = subprocess.check_output('ls -lt {0}'.format(self.Accounting), shell=True).decode('utf-8').rstrip().split('\n')
+        # keep accounting files for the current year
+        Archives = [Archives[i].split()[-1] for i in range(len(Archives)) if ':' in Archives[i].split()[-2]]
+        
+        # loop over the most recent archives and stop when job is found    
+        for AccountingFile in Archives:
+            try:
+                i = subprocess.check_output('qacct -j {0} -f {1}'.format(JobName, AccountingFile), shell=True).decode('utf-8').rstrip().split('\n')
+            except:
+                i = ''
+            else:
+                if i != '':
+                    break
+                
+        # create a dict with months
+        Months = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+                   'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+        
+        # check if accounting file with job has been found
+        if i == '':
+            # return error
+            return '1'        
+        else:
+            # record all exit status. the same job may have been run multiple times if re-encryption was needed
+            d, failed = {}, '0'
+            for j in i:
+                if 'end_time' in j:
+                    k = j.split()[2:]
+                    if len(k) != 0:
+                        # convert date to epoch time
+                        date = '.'.join([k[1], Months[k[0]], k[-1]]) + ' ' + k[2] 
+                        p = '%d.%m.%Y %H:%M:%S'
+                        date = int(time.mktime(time.strptime(date, p)))
+                    else:
+                        date = 0
+                elif j.split()[:1] == ['failed']:
+                    failed = j.split()[1]
+                elif 'exit_status' in j:
+                    # jobs failing with a zero exit status are errors
+                    d[date] = failed if j.split()[1] == '0' and failed != '0' else j.split()[1]
+                    failed = '0'
+            # get the exit status of the most recent job    
+            EndJobs = list(d.keys())
+            EndJobs.sort()
+            if len(d) != 0:
+                # return exit code
+                return d[EndJobs[-1]]
+            else:
+                # return error
+                return '1'
+    
+    def CountJobs(self, Pattern):
+        return int(subprocess.check_output('qstat | grep {0} | wc -l'.format(Pattern), shell=True).decode('utf-8').rstrip())
+    
+    def ActiveJobs(self):
+        # qstat truncates job names, full names are listed with -r
+        Jobs = subprocess.check_output(['qstat', '-r', '-u', getpass.getuser()]).decode('utf-8').split('\n')
+        return set([i.split(':', 1)[1].strip() for i in Jobs if i.strip().startswith('Full jobname:')])
+    
+    def Cancel(self, JobName):
+        return subprocess.call('qdel {0}'.format(JobName), shell=True)
+
+
+# use this class to launch jobs on a Slurm cluster
+class SlurmScheduler(Scheduler):
+    '''
+    Submit jobs with sbatch, get exit status with sacct and count or cancel
+    jobs with squeue and scancel. Slurm dependencies use job ids, so held
+    job names are resolved to the ids of their queued or running jobs.
+    The partition and account are taken from SBATCH_PARTITION and SBATCH_ACCOUNT
+    '''
+    
+    TracksCompletions = True
+    TracksUsage = True
+    
+    def __init__(self, History=365):
+        self.History = History
+        self.User = getpass.getuser()
+        # ids of the jobs submitted by this process {job name: [job ids]}
+        self.Submitted = {}
+    
+    def JobIds(self, JobNames):
+        '''
+        (SlurmScheduler, list) -> list
+        Return the ids of the queued or running jobs named in JobNames
+        '''
+        
+        Ids = set()
+        for JobName in JobNames:
+            Ids.update(self.Submitted.get(JobName, []))
+        try:
+            Queued = subprocess.check_output(['squeue', '-h', '-u', self.User, '-o', '%i', '-n', ','.join(JobNames)]).decode('utf-8').split()
+        except (OSError, subprocess.CalledProcessError):
+            Queued = []
+        Ids.update(Queued)
+        return sorted(Ids)
+    
+    def Submit(self, JobName, BashScript, LogDir, Mem=None, Holds=None, Time=None, Queue=None):
+        RecordJobSubmission(JobName)
+        return self.Sbatch(JobName, ['-o', os.path.join(LogDir, '%x.o%j'), '-e', os.path.join(LogDir, '%x.e%j')], 'bash {0} {1} {2}'.format(WriteJobRunner(), JobName, BashScript), Mem, Holds, Time, Queue)
+    
+    def SubmitArray(self, ArrayName, Dispatcher, Size, LogDir, Mem=None, Holds=None, MaxRunning=0, Time=None, Queue=None):
+        RecordJobSubmission(ArrayName)
+        Array = '1-{0}'.format(Size)
+        if MaxRunning > 0:
+            Array += '%{0}'.format(MaxRunning)
+        return self.Sbatch(ArrayName, ['--array={0}'.format(Array), '-o', os.path.join(LogDir, '%x.o%A.%a'), '-e', os.path.join(LogDir, '%x.e%A.%a')], 'bash {0}'.format(Dispatcher), Mem, Holds, Time, Queue)
+    
+    def Sbatch(self, JobName, Options, Command, Mem=None, Holds=None, Time=None, Queue=None):
+        '''
+        (SlurmScheduler, str, list, str, str | None, list | None, int | None, str | None) -> int
+        Submit Command with sbatch as JobName with Options and return the exit code of sbatch
+        '''
+        
+        SbatchCmd = ['sbatch', '--parsable', '-J', JobName] + Options
+        if Mem is not None:
+            SbatchCmd.append('--mem={0}G'.format(Mem))
+        if Time is not None:
+            SbatchCmd.append('--time={0}'.format(FormatWallclock(Time)))
+        if Queue is not None:
+            SbatchCmd.append('--partition={0}'.format(Queue))
+        if Holds:
+            Ids = self.JobIds(Holds)
+            if len(Ids) != 0:
+                SbatchCmd.append('--dependency=afterany:{0}'.format(':'.join(Ids)))
+        SbatchCmd.extend(['--wrap', Command])
+        try:
+            job = subprocess.run(SbatchCmd, stdout=subprocess.PIPE)
+        except OSError:
+            return 1
+        if job.returncode == 0:
+            self.Submitted.setdefault(JobName, []).append(job.stdout.decode('utf-8').strip().split(';')[0])
+        return job.returncode
+    
+    def ExitStatus(self, JobName):
+        return self.ExitStatuses([JobName])[JobName]
+    
+    def ExitStatuses(self, JobNames):
+        D = {i: '1' for i in JobNames}
+        Completed = self.Completions(JobNames)
+        D.update({i: Completed[i][1] for i in Completed})
+        return D
+    
+    def Completions(self, JobNames):
+        D = {}
+        if len(JobNames) == 0:
+            return D
+        Start = time.strftime('%Y-%m-%d', time.localtime(time.time() - self.History * 24 * 3600))
+        try:
+            Jobs = subprocess.check_output(['sacct', '-n', '-X', '-P', '-S', Start, '--name', ','.join(JobNames), '-o', 'End,JobName,State,ExitCode']).decode('utf-8').rstrip().split('\n')
+        except (OSError, subprocess.CalledProcessError):
+            return D
+        # keep finished jobs, end times are sortable iso dates
+        Jobs = sorted([i.split('|') for i in Jobs if i.count('|') == 3 and i.split('|')[0][:1].isdigit()])
+        for End, JobName, State, ExitCode in Jobs:
+            if JobName in JobNames:
+                ExitCode = ExitCode.split(':')[0]
+                if State == 'COMPLETED' and ExitCode == '0':
+                    ExitCode = '0'
+                elif ExitCode == '0':
+                    ExitCode = '1'
+                D[JobName] = (time.mktime(time.strptime(End, '%Y-%m-%dT%H:%M:%S')), ExitCode)
+        return D
+    
+    def Usage(self, JobNames):
+        D = {}
+        if len(JobNames) == 0:
+            return D
+        Start = time.strftime('%Y-%m-%d', time.localtime(time.time() - self.History * 24 * 3600))
+        try:
+            Jobs = subprocess.check_output(['sacct', '-n', '-P', '-S', Start, '--name', ','.join(JobNames), '-o', 'JobID,JobName,State,MaxRSS,ElapsedRaw']).decode('utf-8').rstrip().split('\n')
+        except (OSError, subprocess.CalledProcessError):
+            return D
+        # memory is reported by the steps of the jobs {job id: [job name, completed, memory, wallclock]}
+        Records, Units = {}, {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+        for line in Jobs:
+            if line.count('|') != 4:
+                continue
+            JobId, JobName, State, MaxRSS, Elapsed = line.split('|')
+            Id = JobId.split('.')[0]
+            Records.setdefault(Id, [None, False, 0, 0])
+            if '.' not in JobId:
+                Records[Id][:2] = [JobName, State == 'COMPLETED']
+                Records[Id][3] = int(Elapsed) if Elapsed.isdigit() else 0
+            elif MaxRSS != '':
+                Memory = float(MaxRSS[:-1]) * Units[MaxRSS[-1]] if MaxRSS[-1] in Units else float(MaxRSS)
+                Records[Id][2] = max(Records[Id][2], Memory)
+        # job ids increase with submission time
+        for Id in sorted(Records, key=lambda i: int(i.split('_')[0]) if i.split('_')[0].isdigit() else 0):
+            JobName, Completed, Memory, Wallclock = Records[Id]
+            if JobName in JobNames and Completed and Memory > 0:
+                D[JobName] = (Memory, Wallclock)
+        return D
+    
+    def CountJobs(self, Pattern):
+        try:
+            Names = subprocess.check_output(['squeue', '-h', '-u', self.User, '-o', '%j']).decode('utf-8').split()
+        except (OSError, subprocess.CalledProcessError):
+            return 0
+        return len([i for i in Names if Pattern in i])
+    
+    def ActiveJobs(self):
+        return set(subprocess.check_output(['squeue', '-h', '-u', self.User, '-o', '%j']).decode('utf-8').split())
+    
+    def Cancel(self, JobName):
+        return subprocess.call(['scancel', '-u', self.User, '-n', JobName])
+
+
+# use this class to run jobs on the current machine
+class LocalScheduler(Scheduler):
+    '''
+    Run jobs as bash subprocesses of this process, at most Workers at once.
+    Each running job takes a thread that starts its process and waits for it.
+    Held jobs are queued only when the jobs they wait for are done so that
+    waiting jobs never take a worker. The end time, exit code, maximum memory
+    and wallclock of each job are appended to an accounting file in the job
+    directory, read like the SGE and Slurm accounting by checks running in
+    other processes. Wait() must be called before the process exits, jobs
+    still held at that point would not run
+    '''
+    
+    TracksCompletions = True
+    TracksUsage = True
+    
+    def __init__(self, Workers=None, Accounting=None):
+        self.Executor = concurrent.futures.ThreadPoolExecutor(Workers or os.cpu_count() or 1)
+        self.Accounting = Accounting or os.path.join(GetJobDir(), 'local.accounting')
+        # futures and processes of the jobs submitted by this process {job name: [futures]}
+        self.Jobs, self.Processes = {}, {}
+        self.Lock = threading.Lock()
+    
+    def Queue(self, JobName, Command, LogDir, Holds=None):
+        '''
+        (LocalScheduler, str, list, str, list | None) -> int
+        Run Command as JobName once all jobs named in Holds are done
+        '''
+        
+        Job = concurrent.futures.Future()
+        with self.Lock:
+            Pending = [j for i in (Holds or []) for j in self.Jobs.get(i, []) if not j.done()]
+            self.Jobs.setdefault(JobName, []).append(Job)
+        # launch the job when the last held job is done
+        Remaining = [len(Pending)]
+        def Release(Future):
+            with self.Lock:
+                Remaining[0] -= 1
+                Ready = Remaining[0] == 0
+            if Ready:
+                self.Launch(Job, JobName, Command, LogDir)
+        if len(Pending) == 0:
+            self.Launch(Job, JobName, Command, LogDir)
+        for i in Pending:
+            i.add_done_callback(Release)
+        return 0
+    
+    def Submit(self, JobName, BashScript, LogDir, Mem=None, Holds=None, Time=None, Queue=None):
+        RecordJobSubmission(JobName)
+        return self.Queue(JobName, ['bash', BashScript], LogDir, Holds)
+    
+    def SubmitArray(self, ArrayName, Dispatcher, Size, LogDir, Mem=None, Holds=None, MaxRunning=0, Time=None, Queue=None):
+        RecordJobSubmission(ArrayName)
+        # the pool size bounds the number of running tasks
+        for i in range(1, Size + 1):
+            self.Queue(ArrayName, ['bash', Dispatcher, str(i)], LogDir, Holds)
+        return 0
+    
+    def Launch(self, Job, JobName, Command, LogDir):
+        '''
+        (LocalScheduler, concurrent.futures.Future, str, list, str) -> None
+        Queue the job on the pool unless it was cancelled while held
+        '''
+        
+        if not Job.set_running_or_notify_cancel():
+            return
+        try:
+            Running = self.Executor.submit(self.Run, JobName, Command, LogDir)
+        except RuntimeError as e:
+            # pool already shut down
+            Job.set_exception(e)
+            return
+        Running.add_done_callback(lambda i: Job.set_exception(i.exception()) if i.exception() else Job.set_result(i.result()))
+    
+    def Run(self, JobName, Command, LogDir):
+        '''
+        (LocalScheduler, str, list, str) -> int
+        Run Command, save its logs in LogDir, its exit code in the job directory
+        and its accounting record
+        '''
+        
+        JobId = '{0}{1}'.format(os.getpid(), int(time.time() * 1000000))
+        Start, Memory = time.time(), 0
+        with open(os.path.join(LogDir, '{0}.o{1}'.format(JobName, JobId)), 'w') as out, open(os.path.join(LogDir, '{0}.e{1}'.format(JobName, JobId)), 'w') as err:
+            process = subprocess.Popen(Command, stdout=out, stderr=err)
+            with self.Lock:
+                self.Processes.setdefault(JobName, []).append(process)
+            try:
+                # reap the process to get its resource usage
+                pid, status, usage = os.wait4(process.pid, 0)
+                ExitCode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+                # maximum resident set size is in kilobytes on linux
+                process.returncode, Memory = ExitCode, usage.ru_maxrss * 1024
+            except ChildProcessError:
+                # already reaped when cancelled
+                ExitCode = process.wait()
+        with self.Lock:
+            self.Processes[JobName].remove(process)
+        self.Account(JobName, time.time(), ExitCode, Memory, time.time() - Start)
+        WriteJobExit(JobName, ExitCode)
+        NotifyWatcher(JobName, ExitCode)
+        return ExitCode
+    
+    def Account(self, JobName, EndTime, ExitCode, Memory, Wallclock):
+        '''
+        (LocalScheduler, str, float, int, int, float) -> None
+        Append the accounting record of a run of JobName to the accounting file
+        '''
+        
+        with open(self.Accounting, 'a') as newfile:
+            fcntl.flock(newfile, fcntl.LOCK_EX)
+            try:
+                newfile.write('\t'.join([JobName, str(int(EndTime)), str(ExitCode), str(Memory), str(int(Wallclock))]) + '\n')
+                newfile.flush()
+            finally:
+                fcntl.flock(newfile, fcntl.LOCK_UN)
+    
+    def Lookup(self, JobNames):
+        '''
+        (LocalScheduler, list) -> dict
+        Return a dictionary with the (end_time, exit_status, memory, wallclock)
+        of the most recent run of each job in JobNames found in the accounting file
+        '''
+        
+        JobNames, D = set(JobNames), {}
+        try:
+            with open(self.Accounting) as infile:
+                for line in infile:
+                    fields = line.rstrip('\n').split('\t')
+                    # skip records partially written
+                    if len(fields) == 5 and fields[0] in JobNames:
+                        try:
+                            D[fields[0]] = (int(fields[1]), fields[2], int(fields[3]), int(fields[4]))
+                        except ValueError:
+                            continue
+        except FileNotFoundError:
+            pass
+        return D
+    
+    def ExitStatus(self, JobName):
+        return self.ExitStatuses([JobName])[JobName]
+    
+    def ExitStatuses(self, JobNames):
+        Records = self.Lookup(JobNames)
+        # return an error for jobs not found
+        return {i: Records[i][1] if i in Records else '1' for i in JobNames}
+    
+    def Completions(self, JobNames):
+        Records = self.Lookup(JobNames)
+        return {i: (Records[i][0], Records[i][1]) for i in Records}
+    
+    def Usage(self, JobNames):
+        Records = self.Lookup(JobNames)
+        return {i: (Records[i][2], Records[i][3]) for i in Records if Records[i][1] == '0' and Records[i][2] > 0}
+    
+    def CountJobs(self, Pattern):
+        with self.Lock:
+            return len([j for i in self.Jobs for j in self.Jobs[i] if Pattern in i and not j.done()])
+    
+    def ActiveJobs(self):
+        with self.Lock:
+            return set([i for i in self.Jobs if any([not j.done() for j in self.Jobs[i]])])
+    
+    def Cancel(self, JobName):
+        with self.Lock:
+            Jobs = list(self.Jobs.get(JobName, []))
+            Processes = list(self.Processes.get(JobName, []))
+        for i in Jobs:
+            i.cancel()
+        for i in Processes:
+            # processes are reaped by the threads running them
+            if i.returncode is None:
+                try:
+                    os.kill(i.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        return 0
+    
+    def Wait(self):
+        '''
+        (LocalScheduler) -> None
+        Wait until all jobs, including held jobs, are done and shut down the pool
+        '''
+        
+        while True:
+            with self.Lock:
+                Jobs = [j for i in self.Jobs for j in self.Jobs[i] if not j.done()]
+            if len(Jobs) == 0:
+                break
+            concurrent.futures.wait(Jobs)
+        self.Executor.shutdown(wait=True)
+
+
+# use this class to group the jobs of many aliases into array jobs
+class JobWave(object):
+    '''
+    Collect the jobs of a wave of aliases by stage (Encrypt, CheckEncryption...)
+    and submit each stage as a single array job held on the previous stage.
+    Tasks are dispatched by task index from a manifest, save their logs in
+    their own log directory and their exit codes under their own job names
+    so that CheckEncryption and CheckUpload check each file as before
+    '''
+    
+    def __init__(self, Name, MaxRunning=0):
+        '''
+        (str, int) -> None
+        Set up an empty wave. Array jobs are named Stage.Name and run at
+        most MaxRunning tasks at once (no limit if 0)
+        '''
+        
+        self.Name = Name
+        self.MaxRunning = MaxRunning
+        # stages in submission order and their tasks {stage: [(job name, bash script, log dir)]}
+        self.Stages, self.Tasks, self.Mem = [], {}, {}
+        # wallclock limit and queue of each stage, fitting its longest task
+        self.Time, self.Queue = {}, {}
+    
+    def __len__(self):
+        return sum([len(self.Tasks[i]) for i in self.Tasks])
+    
+    def Add(self, Stage, JobName, BashScript, LogDir, Mem=None, Time=None, Queue=None):
+        '''
+        (JobWave, str, str, str, str, str | None, int | None, str | None) -> int
+        Add the job JobName running BashScript to Stage and return 0.
+        All tasks of a stage get the largest memory and wallclock limit requested
+        '''
+        
+        if Stage not in self.Tasks:
+            self.Stages.append(Stage)
+            self.Tasks[Stage], self.Mem[Stage] = [], Mem
+            self.Time[Stage], self.Queue[Stage] = Time, Queue
+        elif Mem is not None and (self.Mem[Stage] is None or float(Mem) > float(self.Mem[Stage])):
+            self.Mem[Stage] = Mem
+        # a task without a limit removes the limit of the stage
+        if len(self.Tasks[Stage]) != 0 and self.Time[Stage] is not None:
+            if Time is None:
+                self.Time[Stage], self.Queue[Stage] = None, None
+            elif Time > self.Time[Stage]:
+                self.Time[Stage], self.Queue[Stage] = Time, Queue
+        self.Tasks[Stage].append((JobName, BashScript, LogDir))
+        return 0
+    
+    def Mark(self):
+        '''
+        (JobWave) -> dict
+        Return the number of tasks of each stage, to be passed to Restore
+        '''
+        
+        return {i: len(self.Tasks[i]) for i in self.Tasks}
+    
+    def Restore(self, Marker):
+        '''
+        (JobWave, dict) -> None
+        Drop the tasks added since Mark returned Marker and the stages left without tasks
+        '''
+        
+        for i in self.Tasks:
+            del self.Tasks[i][Marker.get(i, 0):]
+        self.Stages = [i for i in self.Stages if len(self.Tasks[i]) != 0]
+        for i in list(self.Tasks):
+            if len(self.Tasks[i]) == 0:
+                del self.Tasks[i], self.Mem[i], self.Time[i], self.Queue[i]
+    
+    def Submit(self):
+        '''
+        (JobWave) -> int
+        Write the manifest of each stage and submit one array job per stage.
+        Return 0 if all arrays were submitted or the exit code of the first failed submission
+        '''
+        
+        Holds = []
+        for Stage in self.Stages:
+            ArrayName = '{0}.{1}'.format(Stage, self.Name)
+            Dispatcher = WriteArrayManifest(ArrayName, self.Tasks[Stage])
+            job = GetScheduler().SubmitArray(ArrayName, Dispatcher, len(self.Tasks[Stage]), os.path.dirname(Dispatcher), self.Mem[Stage], Holds, self.MaxRunning, self.Time[Stage], self.Queue[Stage])
+            if job != 0:
+                return job
+            # next stage starts when all tasks of this stage are done
+            Holds = [ArrayName]
+        return 0
+
+
+# use this class to size the jobs from the resources used by earlier jobs
+class ResourcePlanner(SqliteStore):
+    '''
+    Plan the memory, wallclock limit and queue of the jobs of a stage (Encrypt,
+    Upload) from the size of the files they process. The size of each job is
+    recorded in an SQLite file when it is submitted and matched with the memory
+    and wallclock reported by the scheduler for the jobs that completed. Jobs
+    get the default memory and no limit until enough jobs are known, and
+    a wallclock limit only if queues with a limit are given
+    '''
+    
+    FileName, Variable, Description = 'resources.sqlite', 'GAEA_RESOURCE_PLAN', 'resource plan'
+    Schema = ['CREATE TABLE IF NOT EXISTS sizes (job_name TEXT, stage TEXT, size INTEGER, submitted REAL, PRIMARY KEY (job_name, stage))']
+    
+    def __init__(self, Stage, Mem, Queues=None, PlanFile=None, History=90, MinRuns=5):
+        '''
+        (str, str, dict | None, str | None, int, int) -> None
+        Set up the planner of Stage with Mem Gb as the default and maximum memory.
+        Queues is a dictionary with the wallclock limit in hours of each queue
+        (0 for no limit). Sizes are recorded in PlanFile, GAEA_RESOURCE_PLAN or
+        resources.sqlite in the state directory and jobs submitted in the last
+        History days are used once at least MinRuns of them completed
+        '''
+        
+        self.Stage, self.Mem = Stage, Mem
+        self.Queues = Queues if Queues else {}
+        self.History, self.MinRuns = History, MinRuns
+        # (size, memory, wallclock) of completed jobs, loaded on first use
+        self.Runs = None
+        try:
+            SqliteStore.__init__(self, PlanFile)
+        except (sqlite3.Error, OSError):
+            # plan from the default memory only
+            self.StoreFile = None
+    
+    def Record(self, Sizes):
+        '''
+        (ResourcePlanner, dict) -> None
+        Record the size in bytes of each submitted job {job name: size}
+        '''
+        
+        if self.StoreFile is None or len(Sizes) == 0:
+            return
+        try:
+            with self.Writing() as conn:
+                conn.executemany('INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?)', [(i, self.Stage, Sizes[i], time.time()) for i in Sizes])
+        except (sqlite3.Error, OSError):
+            pass
+    
+    def LoadRuns(self):
+        '''
+        (ResourcePlanner) -> list
+        Return a list with the (size, maximum memory in bytes, wallclock in seconds)
+        of the recent jobs of the stage that completed
+        '''
+        
+        if self.Runs is not None:
+            return self.Runs
+        self.Runs, Sizes = [], {}
+        if self.StoreFile is not None:
+            try:
+                with self.Reading() as conn:
+                    Query = 'SELECT job_name, size FROM sizes WHERE stage = ? AND submitted >= ? ORDER BY submitted DESC LIMIT 2000'
+                    Sizes = dict(conn.execute(Query, (self.Stage, time.time() - self.History * 24 * 3600)).fetchall())
+            except (sqlite3.Error, OSError):
+                Sizes = {}
+        if len(Sizes) != 0 and GetScheduler().TracksUsage:
+            Usage = GetScheduler().Usage(list(Sizes.keys()))
+            self.Runs = [(Sizes[i], Usage[i][0], Usage[i][1]) for i in Usage if i in Sizes]
+        return self.Runs
+    
+    def Plan(self, Size):
+        '''
+        (ResourcePlanner, int) -> tuple
+        Return the (memory in Gb, wallclock limit in seconds, queue) of a job
+        processing Size bytes. The limit and queue are None if they can't be
+        planned or if no queue has a limit
+        '''
+        
+        # compare with jobs of similar size
+        Runs = [i for i in self.LoadRuns() if Size / 10 <= i[0] <= max(Size, 1) * 10]
+        if len(Runs) < self.MinRuns:
+            return self.Mem, None, None
+        # request a quarter more memory than the largest job, in whole Gb, without exceeding the default
+        Mem = max(1, int(math.ceil(max([i[1] for i in Runs]) * 1.25 / 1024**3)))
+        Mem = str(min(Mem, int(float(self.Mem))))
+        # allow twice the time taken at the throughput of the slowest jobs
+        Throughputs = sorted([i[0] / max(i[2], 1) for i in Runs])
+        Throughput = Throughputs[len(Throughputs) // 10]
+        Time = int(2 * Size / Throughput) + 900 if Throughput > 0 else max([i[2] for i in Runs]) * 2 + 900
+        Time = max(Time, 3600)
+        if not any([self.Queues[i] != 0 for i in self.Queues]):
+            # jobs killed by a limit start again from scratch, only limit jobs sent to queues with limits
+            return Mem, None, None
+        # take the queue with the shortest limit fitting the job, queues without limit last
+        Queues = sorted([i for i in self.Queues if self.Queues[i] == 0 or self.Queues[i] * 3600 >= Time], key=lambda i: self.Queues[i] if self.Queues[i] != 0 else float('inf'))
+        Queue = Queues[0] if len(Queues) != 0 else None
+        return Mem, Time, Queue
+
+
+# schedulers available to launch jobs {name: class}
+Schedulers = {'sge': SgeScheduler, 'slurm': SlurmScheduler, 'local': LocalScheduler}
+_Schedulers = {}
+_SchedulersLock = threading.Lock()
+
+
+# use this function to get the scheduler launching the jobs of this process
+def GetScheduler(Name=None):
+    '''
+    (str | None) -> Scheduler
+    Return the process-wide scheduler Name, or the scheduler set by the
+    GAEA_SCHEDULER environment variable (sge by default) if Name is None
+    '''
+    
+    if Name is None:
+        Name = os.environ.get('GAEA_SCHEDULER', 'sge')
+    with _SchedulersLock:
+        if Name not in _Schedulers:
+            _Schedulers[Name] = Schedulers[Name]()
+        return _Schedulers[Name]
+
+
+# use this function to set the scheduler of this process and of the jobs it launches
+def SetScheduler(Name):
+    '''
+    (str) -> None
+    Set the scheduler used by this process. The name is exported in GAEA_SCHEDULER
+    so that jobs launched by the scheduler check other jobs with the same scheduler
+    '''
+    
+    os.environ['GAEA_SCHEDULER'] = Name
+
+
+# use this function to wait for the jobs run by local schedulers
+def WaitForJobs():
+    '''
+    () -> None
+    Wait until the jobs launched by local schedulers of this process are done
+    '''
+    
+    with _SchedulersLock:
+        Local = [_Schedulers[i] for i in _Schedulers if isinstance(_Schedulers[i], LocalScheduler)]
+    for i in Local:
+        i.Wait()
+
+
+# use this function to check the job exit status
+def GetJobExitStatus(JobName):
+    '''
+    (str) -> str
+    Take a job name and return the exit code of that job after it finished running
+    ('0' indicates a normal, error-free run and '1' or another value inicates an error)
+    '''
+    
+    return GetJobExitStatuses([JobName])[JobName]
+
+
+# use this function to check the exit status of many jobs at once
+def GetJobExitStatuses(JobNames):
+    '''
+    (list) -> dict
+    Take a list of job names and return a dictionary with the exit code of
+    each job after it finished running ('0' indicates a normal, error-free run)
+    '''
+    
+    # exit codes of array tasks and local jobs are saved in the job directory
+    D = {i: ReadJobExit(i) for i in JobNames}
+    Missing = [i for i in JobNames if D[i] is None]
+    if len(Missing) != 0:
+        D.update(GetScheduler().ExitStatuses(Missing))
+    return D
+
+
+# use this function to find the jobs that finished since they were submitted
+def GetFinishedJobs(JobNames):
+    '''
+    (list) -> dict
+    Take a list of job names and return a dictionary with the exit code of the
+    jobs that finished since they were last submitted. Jobs still queued or
+    running, and jobs without a recorded submission, are not in the dictionary.
+    Jobs of a pack or tasks of an array job that didn't save their exit code
+    failed if their pack or array finished
+    '''
+    
+    D, Pending = {}, {}
+    for i in JobNames:
+        Submitted = ReadJobSubmission(i)
+        if Submitted is not None:
+            # exit codes are cleared when jobs are submitted
+            ExitCode = ReadJobExit(i)
+            if ExitCode is not None:
+                D[i] = ExitCode
+            else:
+                Pending[i] = Submitted
+    # jobs of packs and array tasks are not known to the scheduler by their
+    # names, their packs or arrays are {job: parent}
+    Parents = {i: ReadJobParent(i) for i in Pending}
+    Parents = {i: Parents[i] for i in Parents if Parents[i] is not None}
+    if len(Parents) != 0:
+        Packs = GetFinishedJobs(sorted(set(Parents.values())))
+        if len(Packs) != 0:
+            # arrays are accounted as soon as their first task ends
+            try:
+                Active = GetScheduler().ActiveJobs()
+            except (OSError, subprocess.CalledProcessError):
+                Active = set(Packs)
+            Packs = {i: Packs[i] for i in Packs if i not in Active}
+        for i in Parents:
+            if Parents[i] in Packs:
+                # the job may have saved its exit code just before its pack ended
+                ExitCode = ReadJobExit(i)
+                D[i] = ExitCode if ExitCode is not None else '1'
+            del Pending[i]
+    if len(Pending) != 0 and GetScheduler().TracksCompletions:
+        Completed = GetScheduler().Completions(list(Pending.keys()))
+        for i in Completed:
+            # ignore earlier runs of the job, end times are in whole seconds
+            if Completed[i][0] >= int(Pending[i]):
+                D[i] = Completed[i][1]
+    return D
+    
+# use this function to grab all sub-directories of a given directory on the staging server
+def GetSubDirectories(UserName, PassWord, Directory):
+    '''
+    (str, str, str) -> list
+    Connect to EGA staging server using the credentials UserName and PassWord
+    for a given box and return a list of sub-directories in Directory
+    '''
+    
+    # make a list of directories on the staging servers
+    Cmd = "ssh xfer4.res.oicr.on.ca \"lftp -u {0},{1} -e \\\" set ftp:ssl-allow false; ls {2} ; bye;\\\" ftp://ftp-private.ebi.ac.uk\"".format(UserName, PassWord, Directory)
+    a = subprocess.check_output(Cmd, shell=True).decode('utf-8').rstrip().split('\n')
+    Content = [os.path.join(Directory, i.split()[-1]) for i in a if i.startswith('d')]
+    return Content
+
+# use this function to list all directories on the staging server    
+def GrabAllDirectoriesStagingServer(CredentialFile, Box):
+    '''
+    (str, str) -> list
+    Connect to EGA staging server using the credential file and return a list
+    of all directories on the staging server for the given Box
+    '''
+    
+    # extract the user name and password from the credential file
+    UserName, PassWord = ParseCredentials(CredentialFile, Box)
+    
+    # traverse directories breadth-first from the home directory, skipping EGA-owned directories
+    Directories, Queue = [''], collections.deque([''])
+    Checked = set(Directories)
+    while len(Queue) != 0:
+        for i in GetSubDirectories(UserName, PassWord, Queue.popleft()):
+            if i not in Checked and i not in StagingExclude:
+                Checked.add(i)
+                Directories.append(i)
+                Queue.append(i)
+    return Directories
+
+
+# use this function to retrieve the size of a file on the staging server
+def ExtractFileSizeStagingServer(CredentialFile, Box, Directory):
+    '''
+    (str, str, str) -> dict
+    Connect to EGA staging server using the credentials UserName and PassWord
+    for a given box and return a dictionary with file size for all files under Directory
+    '''
+    
+    # extract the user name and password from the credential file
+    UserName, PassWord = ParseCredentials(CredentialFile, Box)
+    
+    # make a list of files under Directory on the staging server
+    Cmd = "ssh xfer4.res.oicr.on.ca \"lftp -u {0},{1} -e \\\" set ftp:ssl-allow false; ls {2} ; bye;\\\" ftp://ftp-private.ebi.ac.uk\"".format(UserName, PassWord, Directory)
+    a = subprocess.check_output(Cmd, shell=True).decode('utf-8').rstrip().split('\n')
+    Content = [i for i in a if i.startswith('-')]
+    # extract file size for all files {filepath: file_size}
+    Size = {}
+    for S in Content:
+        S = S.rstrip().split()
+        FileSize = int(S[4])
+        filePath = os.path.join(Directory, S[-1])
+        Size[filePath] = FileSize
+    return Size
+
+
+# EGA-owned directories of the staging servers
+StagingExclude = set(['MD5_daily_reports', 'metadata'])
+
+# months of the dates of ftp listings
+ListMonths = {j: i + 1 for i, j in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+
+# use this class to list all files of a staging server in a single connection
+class StagingCrawler(object):
+    '''
+    Walk the directories of the staging server of a box with a single FTP
+    connection and collect the size and modification time of every file.
+    Directories are listed with MLSD, or with LIST on servers without MLSD.
+    The time each directory listing started is kept in Listed {directory: time}.
+    The server is GAEA_STAGING_SERVER (host or host:port) or ftp-private.ebi.ac.uk
+    '''
+    
+    def __init__(self, UserName, PassWord, Server=None, Timeout=300):
+        '''
+        (str, str, str | None, int) -> None
+        Set up a crawler logging in Server as UserName
+        '''
+        
+        if Server is None:
+            Server = os.environ.get('GAEA_STAGING_SERVER', 'ftp-private.ebi.ac.uk')
+        self.Host, Port = Server.rpartition(':')[0] or Server, Server.rpartition(':')[-1]
+        self.Port = int(Port) if self.Host != Server and Port.isdigit() else 21
+        self.UserName, self.PassWord, self.Timeout = UserName, PassWord, Timeout
+        self.FTP, self.MLSD = None, True
+        self.Listed = {}
+    
+    def __enter__(self):
+        self.FTP = ftplib.FTP(timeout=self.Timeout)
+        self.FTP.connect(self.Host, self.Port)
+        self.FTP.login(self.UserName, self.PassWord)
+        return self
+    
+    def __exit__(self, *exc):
+        try:
+            self.FTP.quit()
+        except ftplib.all_errors:
+            self.FTP.close()
+        self.FTP = None
+    
+    @staticmethod
+    def ParseModify(Modify):
+        '''
+        (str) -> int
+        Return the seconds since the epoch of a MLSD modify fact YYYYMMDDHHMMSS in UTC
+        '''
+        
+        return calendar.timegm(time.strptime(Modify[:14], '%Y%m%d%H%M%S'))
+    
+    @staticmethod
+    def ParseListTime(Month, Day, YearOrTime, Now=None):
+        '''
+        (str, str, str, float | None) -> int
+        Return the seconds since the epoch of the date of a LIST line in UTC.
+        Dates with a time and without a year are within the last year
+        '''
+        
+        if Now is None:
+            Now = time.time()
+        if ':' in YearOrTime:
+            Hour, Minute = [int(i) for i in YearOrTime.split(':')]
+            Year = time.gmtime(Now).tm_year
+            Date = calendar.timegm((Year, ListMonths[Month], int(Day), Hour, Minute, 0))
+            # servers show the time of files modified in the last 6 months
+            if Date > Now + 24 * 3600:
+                Date = calendar.timegm((Year - 1, ListMonths[Month], int(Day), Hour, Minute, 0))
+            return Date
+        return calendar.timegm((int(YearOrTime), ListMonths[Month], int(Day), 0, 0, 0))
+    
+    def List(self, Directory):
+        '''
+        (StagingCrawler, str) -> tuple
+        Return a tuple with the list of sub-directories of Directory and a
+        dictionary {file path: (size, modification time)} of its files
+        '''
+        
+        Directories, Files = [], {}
+        # files uploaded after the listing started may be missing
+        self.Listed[Directory.strip('/')] = time.time()
+        if self.MLSD:
+            try:
+                for Name, Facts in self.FTP.mlsd(Directory, ['type', 'size', 'modify']):
+                    Type = Facts.get('type', '').lower()
+                    if Type == 'dir':
+                        Directories.append(os.path.join(Directory, Name))
+                    elif Type == 'file':
+                        Modify = Facts.get('modify')
+                        Files[os.path.join(Directory, Name)] = (int(Facts.get('size', 0)), self.ParseModify(Modify) if Modify else None)
+                return Directories, Files
+            except ftplib.error_perm as e:
+                # fall back to LIST on servers without MLSD
+                if not str(e).startswith('500') and not str(e).startswith('502'):
+                    raise
+                self.MLSD = False
+        Lines = []
+        self.FTP.retrlines('LIST {0}'.format(Directory) if Directory != '' else 'LIST', Lines.append)
+        for line in Lines:
+            Fields = line.split(None, 8)
+            if len(Fields) < 9 or Fields[8] in ['.', '..']:
+                continue
+            if line.startswith('d'):
+                Directories.append(os.path.join(Directory, Fields[8]))
+            elif line.startswith('-'):
+                Files[os.path.join(Directory, Fields[8])] = (int(Fields[4]), self.ParseListTime(Fields[5], Fields[6], Fields[7]))
+        return Directories, Files
+    
+    def Crawl(self, Directory='', Exclude=None):
+        '''
+        (StagingCrawler, str, set | None) -> dict
+        Return a dictionary {file path: (size, modification time)} of all files
+        under Directory, skipping the directories in Exclude
+        '''
+        
+        if Exclude is None:
+            Exclude = set()
+        Files, Queue, Checked = {}, collections.deque([Directory]), set([Directory])
+        while len(Queue) != 0:
+            Directories, Content = self.List(Queue.popleft())
+            Files.update(Content)
+            for i in Directories:
+                if i not in Checked and i not in Exclude:
+                    Checked.add(i)
+                    Queue.append(i)
+        return Files
+
+
+# use this class to keep the last listing of the staging servers
+class StagingSnapshot(SqliteStore):
+    '''
+    SQLite snapshot of the files on the staging server of each box with their
+    size and modification time, and the time the listing of each directory
+    started in the last crawl of the box. Each crawl is compared with the
+    previous one and only the difference is applied
+    '''
+    
+    FileName, Variable, Description = 'staging.sqlite', 'GAEA_STAGING_SNAPSHOT', 'staging snapshot'
+    Schema = ['CREATE TABLE IF NOT EXISTS files (box TEXT, path TEXT, directory TEXT, size INTEGER, mtime INTEGER, PRIMARY KEY (box, path))',
+              'CREATE INDEX IF NOT EXISTS files_directory ON files (box, directory)',
+              'CREATE TABLE IF NOT EXISTS directories (box TEXT, directory TEXT, listed REAL, PRIMARY KEY (box, directory))']
+    
+    def Migrate(self, conn):
+        # the start of the crawl of all boxes is not kept, directories are trusted after the next crawl
+        conn.execute('DROP TABLE IF EXISTS crawls')
+    
+    @staticmethod
+    def Directory(Path):
+        '''
+        (str) -> str
+        Return the directory of a path on the staging server relative to the home directory
+        '''
+        
+        return os.path.dirname(Path.strip('/'))
+    
+    def Load(self, Box, conn=None):
+        '''
+        (StagingSnapshot, str, sqlite3.Connection | None) -> dict
+        Return the files {file path: (size, modification time)} of the last crawl of Box
+        '''
+        
+        if conn is None:
+            with self.Reading() as conn:
+                return self.Load(Box, conn)
+        return {i[0]: (i[1], i[2]) for i in conn.execute('SELECT path, size, mtime FROM files WHERE box = ?', (Box,))}
+    
+    def List(self, Box, Directory):
+        '''
+        (StagingSnapshot, str, str) -> tuple | None
+        Return a tuple with the time the listing of Directory started in the
+        last crawl of Box and the names of the files directly under Directory,
+        or None if Directory was not listed
+        '''
+        
+        with self.Reading() as conn:
+            row = conn.execute('SELECT listed FROM directories WHERE box = ? AND directory = ?', (Box, Directory.strip('/'))).fetchone()
+            if row is None:
+                return None
+            return row[0], [os.path.basename(i[0]) for i in conn.execute('SELECT path FROM files WHERE box = ? AND directory = ?', (Box, Directory.strip('/')))]
+    
+    def Update(self, Box, Files, Listed):
+        '''
+        (StagingSnapshot, str, dict, dict) -> dict
+        Replace the snapshot of Box with the Files {file path: (size, modification time)}
+        of a crawl listing directories at Listed {directory: time} and return
+        the difference with the previous crawl {'added': {file path: size},
+        'removed': {file path: size}, 'resized': {file path: (previous size, size)}}
+        '''
+        
+        with self.Writing() as conn:
+            Previous = self.Load(Box, conn)
+            Delta = {'added': {i: Files[i][0] for i in Files if i not in Previous},
+                     'removed': {i: Previous[i][0] for i in Previous if i not in Files},
+                     'resized': {i: (Previous[i][0], Files[i][0]) for i in Files if i in Previous and Previous[i][0] != Files[i][0]}}
+            # files touched without changing size are updated too
+            Changed = [i for i in Files if i not in Previous or Previous[i] != tuple(Files[i])]
+            conn.executemany('DELETE FROM files WHERE box = ? AND path = ?', [(Box, i) for i in Delta['removed']])
+            conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', [(Box, i, self.Directory(i), Files[i][0], Files[i][1]) for i in Changed])
+            conn.execute('DELETE FROM directories WHERE box = ?', (Box,))
+            conn.executemany('INSERT INTO directories VALUES (?, ?, ?)', [(Box, i.strip('/'), Listed[i]) for i in Listed])
+        return Delta
+
+
+# use this function to list all files on the staging server of a box through xfer4
+def ListStagingServerThroughGateway(CredentialFile, Box):
     '''
-    (str, str, str) -> list
-    Connect to EGA staging server using the credentials UserName and PassWord
-    for a given box and return a list of sub-directories in Directory
+    (str, str) -> tuple
+    Return a tuple with a dictionary {file path: (size, None)} of all files on
+    the staging server of Box, listing directories one by one with lftp on xfer4,
+    and a dictionary {directory: time its listing started}
     '''
     
-    # make a list of directories on the staging servers
-    Cmd = "ssh xfer4.res.oicr.on.ca \"lftp -u {0},{1} -e \\\" set ftp:ssl-allow false; ls {2} ; bye;\\\" ftp://ftp-private.ebi.ac.uk\"".format(UserName, PassWord, Directory)
-    a = subprocess.check_output(Cmd, shell=True).decode('utf-8').rstrip().split('\n')
-    Content = [os.path.join(Directory, i.split()[-1]) for i in a if i.startswith('d')]
-    return Content
+    Files, Listed = {}, {}
+    for i in GrabAllDirectoriesStagingServer(CredentialFile, Box):
+        Listed[i.strip('/')] = time.time()
+        Size = ExtractFileSizeStagingServer(CredentialFile, Box, i)
+        Files.update({j: (Size[j], None) for j in Size})
+    return Files, Listed
 
-# use this function to list all directories on the staging server    
-def GrabAllDirectoriesStagingServer(CredentialFile, Box):
+
+# use this function to crawl the staging server of a box with a few connections
+def CrawlBoxStagingServer(UserName, PassWord, Slots, MaxPerBox):
     '''
-    (str, str) -> list
-    Connect to EGA staging server using the credential file and return a list
-    of all directories on the staging server for the given Box
+    (str, str, threading.BoundedSemaphore, int) -> tuple
+    Return a tuple with a dictionary {file path: (size, modification time)} of
+    all files on the staging server of the box of UserName, except EGA-owned
+    directories, and a dictionary {directory: time its listing started}.
+    Top-level directories are crawled by up to MaxPerBox connections, each
+    connection taking one of the Slots shared by all boxes while it is open
     '''
     
-    # extract the user name and password from the credential file
-    UserName, PassWord = ParseCredentials(CredentialFile, Box)
+    with Slots:
+        with StagingCrawler(UserName, PassWord) as Crawler:
+            Directories, Files = Crawler.List('')
+            Listed = dict(Crawler.Listed)
+    Queue = collections.deque([i for i in Directories if i not in StagingExclude])
+    Lock = threading.Lock()
+    
+    def Worker():
+        with Slots:
+            with StagingCrawler(UserName, PassWord) as Crawler:
+                while True:
+                    with Lock:
+                        if len(Queue) == 0:
+                            return
+                        Directory = Queue.popleft()
+                    Content = Crawler.Crawl(Directory, StagingExclude)
+                    with Lock:
+                        Files.update(Content)
+                        Listed.update(Crawler.Listed)
     
-    # exclude EGA-owned directories
-    Exclude = ['MD5_daily_reports', 'metadata']
-    
-    # make a list of directories on the staging server 
-    a = GetSubDirectories(UserName, PassWord, '')
-    # dump all sub-directories into the collecting list
-    # skip EGA-owned directories
-    b = [i for i in a if i not in Exclude]
-    # add home directory
-    b.append('')
-    # make a list of directories already traversed
-    checked = ['']
-        
-    # initialize list with list length so that first interation always occurs
-    L = [0, len(b)]
-    while L[-1] != L[-2]:
-        for i in b:
-            # ignore if already checked and ignore EGA-owned directories
-            if i not in checked and i not in Exclude:
-                b.extend(GetSubDirectories(UserName, PassWord, i))
-                checked.append(i)
-        # update L
-        L.append(len(b))
-    return b
+    Workers = min(MaxPerBox, len(Queue))
+    if Workers != 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=Workers) as Executor:
+            for Job in [Executor.submit(Worker) for i in range(Workers)]:
+                Job.result()
+    return Files, Listed
 
 
-# use this function to retrieve the size of a file on the staging server
-def ExtractFileSizeStagingServer(CredentialFile, Box, Directory):
+# use this function to crawl the staging servers of many boxes at once
+def CrawlStagingServers(CredentialFile, Boxes, MaxConnections=8, MaxPerBox=4):
     '''
-    (str, str, str) -> dict
-    Connect to EGA staging server using the credentials UserName and PassWord
-    for a given box and return a dictionary with file size for all files under Directory
+    (str, list, int, int) -> generator
+    Crawl the staging servers of all Boxes in parallel with at most MaxPerBox
+    connections per box and MaxConnections overall, and yield a tuple (box,
+    {file path: (size, modification time)}, {directory: time its listing started})
+    for each box as soon as its crawl is done. Boxes whose staging server can't
+    be reached directly are listed through xfer4, in which case modification times are None
     '''
     
-    # extract the user name and password from the credential file
-    UserName, PassWord = ParseCredentials(CredentialFile, Box)
+    Slots = threading.BoundedSemaphore(max(1, MaxConnections))
+    Credentials = {Box: ParseCredentials(CredentialFile, Box) for Box in Boxes}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(Boxes))) as Executor:
+        Jobs = {Executor.submit(CrawlBoxStagingServer, Credentials[Box][0], Credentials[Box][1], Slots, max(1, MaxPerBox)): Box for Box in Boxes}
+        for Job in concurrent.futures.as_completed(Jobs):
+            Box = Jobs[Job]
+            try:
+                Files, Listed = Job.result()
+            except ftplib.all_errors as e:
+                print('Could not crawl the staging server of {0}, listing directories through xfer4: {1}'.format(Box, e), file=sys.stderr)
+                Files, Listed = ListStagingServerThroughGateway(CredentialFile, Box)
+            yield Box, Files, Listed
+
+
+# use this function to list all files on the staging server of a box
+def CrawlStagingServer(CredentialFile, Box, MaxConnections=4):
+    '''
+    (str, str, int) -> dict
+    Return a dictionary {file path: (size, modification time)} of all files on
+    the staging server of Box, except EGA-owned directories, crawled with up to
+    MaxConnections connections. Directories are listed one by one through xfer4
+    if the staging server can't be reached directly, in which case modification times are None
+    '''
     
-    # make a list of files under Directory on the staging server
-    Cmd = "ssh xfer4.res.oicr.on.ca \"lftp -u {0},{1} -e \\\" set ftp:ssl-allow false; ls {2} ; bye;\\\" ftp://ftp-private.ebi.ac.uk\"".format(UserName, PassWord, Directory)
-    a = subprocess.check_output(Cmd, shell=True).decode('utf-8').rstrip().split('\n')
-    Content = [i for i in a if i.startswith('-')]
-    # extract file size for all files {filepath: file_size}
-    Size = {}
-    for S in Content:
-        S = S.rstrip().split()
-        FileSize = int(S[4])
-        filePath = os.path.join(Directory, S[-1])
-        Size[filePath] = FileSize
-    return Size
+    for Box, Files, Listed in CrawlStagingServers(CredentialFile, [Box], MaxConnections, MaxConnections):
+        return Files
 
 
 # use this function to match file md5sums with objoect alias
@@ -1382,10 +4022,65 @@ def AddFileInfoStagingServer(CredentialFile, MetDataBase, SubDataBase, AnalysesT
     of Box in Table StagingServerTable of SubDataBase using credentials to connect to each database
     '''
     
-    # list all directories on the staging server of box
-    Directories = GrabAllDirectoriesStagingServer(CredentialFile, Box)
-    # Extract file size for all files on the staging server
-    FileSize = [ExtractFileSizeStagingServer(CredentialFile, Box, i) for i in Directories]
+    WriteFileInfoStagingServer(CredentialFile, MetDataBase, SubDataBase, AnalysesTable, RunsTable, StagingServerTable, Box, CrawlStagingServer(CredentialFile, Box))
+
+
+# use this function to add files from the staging servers of many boxes into database
+def AddFileInfoStagingServers(CredentialFile, MetDataBase, SubDataBase, AnalysesTable, RunsTable, StagingServerTable, FootPrintTable, Boxes, MaxConnections=8, MaxPerBox=4):
+    '''
+    (str, str, str, str, str, str, str, list, int, int) -> dict
+    Crawl the staging servers of all Boxes in parallel and update the file info
+    and footprint of each box in StagingServerTable and FootPrintTable as soon
+    as its crawl is done. Return a dictionary with the difference between the
+    crawl of each box and its previous snapshot, or None if there is no snapshot
+    '''
+    
+    Snapshot = StagingSnapshot.Open()
+    Deltas = {}
+    for Box, Files, Listed in CrawlStagingServers(CredentialFile, Boxes, MaxConnections, MaxPerBox):
+        Rows = WriteFileInfoStagingServer(CredentialFile, MetDataBase, SubDataBase, AnalysesTable, RunsTable, StagingServerTable, Box, Files)
+        AddFootprintData(CredentialFile, SubDataBase, StagingServerTable, FootPrintTable, Box, Rows)
+        Deltas[Box] = None
+        if Snapshot is not None:
+            try:
+                Deltas[Box] = Snapshot.Update(Box, Files, Listed)
+            except (sqlite3.Error, OSError) as e:
+                print('Could not update the staging snapshot of {0}: {1}'.format(Box, e), file=sys.stderr)
+    return Deltas
+
+
+# use this function to print the difference between crawls of the staging servers
+def PrintStagingDiff(Deltas):
+    '''
+    (dict) -> None
+    Print the files added, removed and resized on the staging server of each box
+    since its previous crawl as box, change, file, previous size and size
+    '''
+    
+    print('\t'.join(['egaBox', 'change', 'file', 'previousSize', 'fileSize']))
+    for Box in Deltas:
+        if Deltas[Box] is None:
+            print('\t'.join([Box, 'unknown', 'NA', 'NA', 'NA']))
+            continue
+        for i in sorted(Deltas[Box]['added']):
+            print('\t'.join([Box, 'added', i, 'NA', str(Deltas[Box]['added'][i])]))
+        for i in sorted(Deltas[Box]['removed']):
+            print('\t'.join([Box, 'removed', i, str(Deltas[Box]['removed'][i]), 'NA']))
+        for i in sorted(Deltas[Box]['resized']):
+            print('\t'.join([Box, 'resized', i, str(Deltas[Box]['resized'][i][0]), str(Deltas[Box]['resized'][i][1])]))
+
+
+# use this function to write the files of the staging server of a box into database
+def WriteFileInfoStagingServer(CredentialFile, MetDataBase, SubDataBase, AnalysesTable, RunsTable, StagingServerTable, Box, Files):
+    '''
+    (str, str, str, str, str, str, str, dict) -> list
+    Add file info including size and accession IDs for the Files {file path:
+    (size, modification time)} on the staging server of Box in Table
+    StagingServerTable of SubDataBase using credentials to connect to each database.
+    Only new or changed rows are written. Return the rows of Box
+    '''
+    
+    FileSize = [{i: Files[i][0] for i in Files}]
     # Extract md5sums and accessions from the metadata database
     RegisteredAnalyses = LinkFilesWithAlias(CredentialFile, MetDataBase, AnalysesTable, Box)
     RegisteredRuns = LinkFilesWithAlias(CredentialFile, MetDataBase, RunsTable, Box)
@@ -1420,51 +4115,39 @@ def AddFileInfoStagingServer(CredentialFile, MetDataBase, SubDataBase, AnalysesT
         conn = EstablishConnection(CredentialFile, SubDataBase)
         cur = conn.cursor()
         # get the column headers from the table
-        cur.execute("SELECT * FROM {0}".format(StagingServerTable))
+        cur.execute("SELECT * FROM {0} LIMIT 0".format(StagingServerTable))
         Fields = [i[0] for i in cur.description]
         conn.close()
 
-    # connect to submission database
-    conn = EstablishConnection(CredentialFile, SubDataBase)
-    cur = conn.cursor()
-    # format colums with datatype and convert to string
+    # list values according to the table column order
     Fields = ["file", "filename", "fileSize", "alias", "egaAccessionId", "egaBox"]
-    Columns = ' '.join([Fields[i] + ' TEXT NULL,' if i != len(Fields) -1 else Fields[i] + ' TEXT NULL' for i in range(len(Fields))])
-    # create a string with column headers
-    ColumnNames = ', '.join(Fields)
-
-    # drop all entries for that Box
-    cur.execute('DELETE FROM {0} WHERE {0}.egaBox=\"{1}\"'.format(StagingServerTable, Box))
-    conn.commit()
-        
-    # loop over dicts
-    for i in range(len(Data)):
-        # list values according to the table column order
-        for filename in Data[i]:
-            # convert data to strings, converting missing values to NULL
-            Values =  FormatData(Data[i][filename])
-            cur.execute('INSERT INTO {0} ({1}) VALUES {2}'.format(StagingServerTable, ColumnNames, Values))
-            conn.commit()
-    conn.close()            
+    Rows = [Data[i][filename] for i in range(len(Data)) for filename in Data[i]]
+    # update the changed entries for that Box in a single transaction
+    UpdateBoxRows(CredentialFile, SubDataBase, StagingServerTable, Fields, Box, Rows, 'file')
+    return Rows
 
 
 # use this function to add information to Footprint table
-def AddFootprintData(CredentialFile, SubDataBase, StagingServerTable, FootPrintTable, Box):
+def AddFootprintData(CredentialFile, SubDataBase, StagingServerTable, FootPrintTable, Box, Rows=None):
     '''
-    (str, str, str, str, str) -> None
+    (str, str, str, str, str, list | None) -> None
     Use credentials to connect to SubDatabase, extract file information from
-    StagingServerTable for given Box and collapse it per directory in FootPrintTable
+    StagingServerTable for given Box, or take the Rows just written to
+    StagingServerTable, and collapse it per directory in FootPrintTable
     '''
     
-    # connect to submission database
-    conn = EstablishConnection(CredentialFile, SubDataBase)
-    cur = conn.cursor()
-    try:
-        cur.execute('SELECT * FROM {0} WHERE {0}.egaBox=\"{1}\"'.format(StagingServerTable, Box))
-        Data = cur.fetchall()
-    except:
-        Data = []
-    conn.close()
+    if Rows is not None:
+        Data = [FormatData(i) for i in Rows]
+    else:
+        # connect to submission database
+        conn = EstablishConnection(CredentialFile, SubDataBase)
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT * FROM {0} WHERE {0}.egaBox=\"{1}\"'.format(StagingServerTable, Box))
+            Data = cur.fetchall()
+        except:
+            Data = []
+        conn.close()
         
     Size = {}
     if len(Data) != 0:
@@ -1522,15 +4205,13 @@ def AddFootprintData(CredentialFile, SubDataBase, StagingServerTable, FootPrintT
             conn.commit()
         else:
             # get the column headers from the table
-            cur.execute("SELECT * FROM {0}".format(FootPrintTable))
+            cur.execute("SELECT * FROM {0} LIMIT 0".format(FootPrintTable))
             Fields = [i[0] for i in cur.description]
             
-        # create a string with column headers
-        ColumnNames = ', '.join(Fields)
-        # drop all entries for that Box
-        cur.execute('DELETE FROM {0} WHERE {0}.egaBox=\"{1}\"'.format(FootPrintTable, Box))
-        conn.commit()
+        conn.close()
     
+        # list values according to the table column order
+        Rows = []
         # loop over data in boxes
         for box in Size:
             # loop over directory in each box
@@ -1538,12 +4219,9 @@ def AddFootprintData(CredentialFile, SubDataBase, StagingServerTable, FootPrintT
                 # add box to list of data
                 L = [box]
                 L.extend(Size[box][directory])
-                # list values according to the table column order
-                # convert data to strings, converting missing values to NULL
-                Values =  FormatData(list(map(lambda x: str(x), L)))
-                cur.execute('INSERT INTO {0} ({1}) VALUES {2}'.format(FootPrintTable, ColumnNames, Values))
-                conn.commit()
-        conn.close()            
+                Rows.append(list(map(lambda x: str(x), L)))
+        # update the changed entries for that Box in a single transaction
+        UpdateBoxRows(CredentialFile, SubDataBase, FootPrintTable, ["egaBox", "location", "AllFiles", "Registered", "NotRegistered", "Size", "SizeRegistered", "SizeNotRegistered"], Box, Rows, 'location')
                 
 
 # use this function to get the available disk space on the staging server
@@ -1594,6 +4272,212 @@ def RetrieveColumnHeader(CredentialFile, DataBase, Table):
     return Header
 
 
+## functions to migrate the database schema ==================================
+
+# version of the database schema expected by this script
+GaeaSchemaVersion = 1
+
+# filter columns converted to VARCHAR {column: length}. column names are case-insensitive
+IndexedColumns = {'egabox': 100, 'status': 100, 'alias': 255}
+
+# maximum number of bytes per character of the character sets {charset: bytes}
+CharsetBytes = {'utf8mb4': 4, 'utf8mb3': 3, 'utf8': 3, 'ucs2': 2, 'utf16': 4, 'utf32': 4, 'latin1': 1, 'ascii': 1, 'binary': 1}
+
+
+# use this function to get the longest index prefix allowed on a column
+def IndexPrefixLength(RowFormat, Collation):
+    '''
+    (str | None, str | None) -> int
+    Return the maximum number of characters of a column with Collation that
+    can be indexed by InnoDB in a table with RowFormat: 3072 bytes for the
+    DYNAMIC and COMPRESSED row formats and 767 bytes for COMPACT and REDUNDANT
+    '''
+    
+    KeyBytes = 3072 if str(RowFormat).lower() in ['dynamic', 'compressed'] else 767
+    # assume the widest character set if the collation is unknown
+    Charset = str(Collation).lower().split('_')[0]
+    return KeyBytes // CharsetBytes.get(Charset, 4)
+
+
+# use this function to get the schema version recorded in a database
+def GetSchemaVersion(CredentialFile, DataBase, VersionTable='SchemaVersion'):
+    '''
+    (str, str, str) -> int
+    Return the most recent schema version recorded in VersionTable of DataBase
+    or 0 if no version was ever recorded
+    '''
+    
+    if VersionTable not in ListTables(CredentialFile, DataBase):
+        return 0
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT MAX({0}.version) FROM {0}'.format(VersionTable))
+        Version = cur.fetchall()[0][0]
+    if Version is None:
+        return 0
+    return int(Version)
+
+
+# use this function to record the schema version of a database
+def RecordSchemaVersion(CredentialFile, DataBase, Version, Description, VersionTable='SchemaVersion'):
+    '''
+    (str, str, int, str, str) -> None
+    Record Version of the schema of DataBase in VersionTable, creating the table if it doesn't exist
+    '''
+    
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS {0} (version INT PRIMARY KEY, description TEXT NULL, appliedOn VARCHAR(20) NULL)'.format(VersionTable))
+        cur.execute('INSERT IGNORE INTO {0} (version, description, appliedOn) VALUES (%s, %s, %s)'.format(VersionTable),
+                    (Version, Description, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))))
+        conn.commit()
+
+
+# use this function to list the changes needed to index the filter columns of a table
+def PlanTableMigration(CredentialFile, DataBase, Table):
+    '''
+    (str, str, str) -> list
+    Return a list of ALTER TABLE clauses converting the egaBox, Status and alias
+    columns of Table to VARCHAR and adding composite indexes on (egaBox, Status, alias)
+    and (egaBox, alias). Return an empty list if Table is already migrated or
+    doesn't have an egaBox column. Columns holding values longer than the
+    VARCHAR length are kept as TEXT and indexed on a prefix. Columns wider than
+    the key length allowed by the row format and character set of Table are
+    indexed on the longest prefix allowed
+    '''
+    
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        cur.execute('SHOW FULL COLUMNS FROM {0}'.format(Table))
+        # map lowercase column names to {name, type, collation}
+        Columns = {i[0].lower(): [i[0], i[1].lower(), i[2]] for i in cur.fetchall()}
+        cur.execute('SHOW TABLE STATUS LIKE %s', (Table,))
+        Status = cur.fetchall()
+        RowFormat = Status[0][3] if len(Status) != 0 else None
+        cur.execute('SHOW INDEX FROM {0}'.format(Table))
+        Indexes = set([i[2] for i in cur.fetchall()])
+        # get the longest value of each filter column
+        Lengths = {}
+        for column in IndexedColumns:
+            if column in Columns:
+                cur.execute('SELECT MAX(CHAR_LENGTH({0}.{1})) FROM {0}'.format(Table, Columns[column][0]))
+                Lengths[column] = cur.fetchall()[0][0] or 0
+    
+    # only tables recording objects per box are migrated
+    if 'egabox' not in Columns:
+        return []
+    
+    Clauses = []
+    # make a list of column names to use in indexes
+    Keys = {}
+    for column in IndexedColumns:
+        if column in Columns:
+            name, datatype, collation = Columns[column]
+            Prefix = IndexPrefixLength(RowFormat, collation)
+            if 'text' in datatype:
+                if Lengths[column] <= IndexedColumns[column]:
+                    # convert to VARCHAR, keep nullability
+                    Clauses.append('MODIFY {0} VARCHAR({1}) NULL'.format(name, IndexedColumns[column]))
+                    Width = IndexedColumns[column]
+                else:
+                    # values are too long, index on a prefix
+                    Width = None
+            elif datatype.startswith('varchar('):
+                Width = int(datatype.split('(')[1].split(')')[0])
+            else:
+                Width = 0
+            if Width is None or Width > Prefix:
+                Keys[column] = '{0}({1})'.format(name, min(Prefix, IndexedColumns[column]))
+            else:
+                Keys[column] = name
+    
+    # add composite indexes if they don't already exist
+    if 'status' in Keys and 'alias' in Keys and 'gaea_box_status_alias' not in Indexes:
+        Clauses.append('ADD INDEX gaea_box_status_alias ({0}, {1}, {2})'.format(Keys['egabox'], Keys['status'], Keys['alias']))
+    if 'alias' in Keys and 'gaea_box_alias' not in Indexes:
+        Clauses.append('ADD INDEX gaea_box_alias ({0}, {1})'.format(Keys['egabox'], Keys['alias']))
+    if 'alias' not in Keys and 'gaea_box' not in Indexes:
+        Clauses.append('ADD INDEX gaea_box ({0})'.format(Keys['egabox']))
+    return Clauses
+
+
+# use this function to time the queries filtering on box, status and alias
+def TimeHotQueries(CredentialFile, DataBase, Tables, Box, Repeat=5):
+    '''
+    (str, str, list, str, int) -> dict
+    Run the queries filtering on egaBox, Status and alias for each table in Tables
+    Repeat times and return a dictionary {(table, query): median time in ms}
+    '''
+    
+    D = {}
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        for Table in Tables:
+            cur.execute('SHOW COLUMNS FROM {0}'.format(Table))
+            Columns = set([i[0].lower() for i in cur.fetchall()])
+            if 'egabox' not in Columns:
+                continue
+            Queries = {}
+            Queries['box'] = ('SELECT SQL_NO_CACHE COUNT(*) FROM {0} WHERE {0}.egaBox=%s'.format(Table), (Box,))
+            if 'status' in Columns:
+                Queries['box+status'] = ('SELECT SQL_NO_CACHE {0}.alias FROM {0} WHERE {0}.Status=%s AND {0}.egaBox=%s'.format(Table), ('start', Box))
+            if 'alias' in Columns:
+                # pick an existing alias of the box
+                cur.execute('SELECT {0}.alias FROM {0} WHERE {0}.egaBox=%s LIMIT 1'.format(Table), (Box,))
+                alias = cur.fetchall()
+                alias = alias[0][0] if len(alias) != 0 else ''
+                Queries['box+alias'] = ('SELECT SQL_NO_CACHE {0}.alias FROM {0} WHERE {0}.egaBox=%s AND {0}.alias=%s'.format(Table), (Box, alias))
+            for query in Queries:
+                Cmd, Params = Queries[query]
+                Times = []
+                for i in range(Repeat):
+                    start = time.perf_counter()
+                    cur.execute(Cmd, Params)
+                    cur.fetchall()
+                    Times.append((time.perf_counter() - start) * 1000)
+                Times.sort()
+                D[(Table, query)] = Times[len(Times) // 2]
+    return D
+
+
+# use this function to migrate the schema of a database
+def MigrateDataBase(CredentialFile, DataBase, Box, DryRun=False, VersionTable='SchemaVersion'):
+    '''
+    (str, str, str, bool, str) -> None
+    Index the filter columns of all tables in DataBase, record the schema version
+    and print the latency of the hot queries for Box before and after migration.
+    Tables already migrated are left untouched. Print the ALTER statements only if DryRun is True
+    '''
+    
+    Tables = [i for i in ListTables(CredentialFile, DataBase) if i != VersionTable]
+    Plan = {}
+    for Table in Tables:
+        Clauses = PlanTableMigration(CredentialFile, DataBase, Table)
+        if len(Clauses) != 0:
+            Plan[Table] = 'ALTER TABLE {0} {1}'.format(Table, ', '.join(Clauses))
+    
+    print('{0}: schema version {1}, {2} table(s) to migrate'.format(DataBase, GetSchemaVersion(CredentialFile, DataBase, VersionTable), len(Plan)))
+    if DryRun == True:
+        for Table in sorted(Plan):
+            print(Plan[Table])
+        return
+    
+    Before = TimeHotQueries(CredentialFile, DataBase, sorted(Plan), Box)
+    # each table is rebuilt once with all its changes
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        for Table in sorted(Plan):
+            cur.execute(Plan[Table])
+    After = TimeHotQueries(CredentialFile, DataBase, sorted(Plan), Box)
+    RecordSchemaVersion(CredentialFile, DataBase, GaeaSchemaVersion, 'index egaBox, Status and alias', VersionTable)
+    
+    # print report
+    if len(Before) != 0:
+        print('\t'.join(['database', 'table', 'query', 'before_ms', 'after_ms']))
+        for key in sorted(Before):
+            print('\t'.join([DataBase, key[0], key[1], '{0:.2f}'.format(Before[key]), '{0:.2f}'.format(After.get(key, -1))]))
+
+
 ## functions specific to Analyses objects =====================================
     
 # use this function to add sample accessions to Analysis Table in the submission database
@@ -1806,27 +4690,270 @@ def CheckEgaAccessionId(CredentialFile, SubDataBase, MetDataBase, Object, Table,
     conn.close()    
 
 
+# use this class to remember the md5sums of the original files
+class ChecksumLedger(SqliteStore):
+    '''
+    SQLite ledger of the md5sums of the original files. Each md5sum is recorded
+    with the inode, size and modification time of the file when it was read,
+    and is only returned while the file still has the same fingerprint
+    '''
+    
+    FileName, Variable, Description = 'checksums.sqlite', 'GAEA_CHECKSUM_LEDGER', 'checksum ledger'
+    Schema = ['CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, md5 TEXT NOT NULL, recorded REAL)']
+    
+    @staticmethod
+    def Fingerprint(stat):
+        '''
+        (os.stat_result) -> tuple
+        Return the (inode, size, modification time in ns) of a file
+        '''
+        
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    
+    def Lookup(self, FilePaths):
+        '''
+        (ChecksumLedger, list) -> dict
+        Return a dictionary with the recorded md5sum of each file in FilePaths
+        that was not modified since it was recorded. Other files are not in the dictionary
+        '''
+        
+        FilePaths = list(set([os.path.abspath(i) for i in FilePaths]))
+        Records = {}
+        with self.Reading() as conn:
+            # stay below the maximum number of sqlite parameters
+            for i in range(0, len(FilePaths), 500):
+                Paths = FilePaths[i:i+500]
+                Query = 'SELECT path, inode, size, mtime_ns, md5 FROM checksums WHERE path IN ({0})'.format(','.join(['?'] * len(Paths)))
+                for row in conn.execute(Query, Paths):
+                    Records[row[0]] = row[1:]
+        D = {}
+        for i in Records:
+            try:
+                if self.Fingerprint(os.stat(i)) == tuple(Records[i][:3]):
+                    D[i] = Records[i][3]
+            except OSError:
+                continue
+        return D
+    
+    def Record(self, FilePath, stat, Md5):
+        '''
+        (ChecksumLedger, str, os.stat_result, str) -> None
+        Record the Md5 of FilePath computed from the content it had when stat was taken
+        '''
+        
+        with self.Writing() as conn:
+            conn.execute('INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?,?)', (os.path.abspath(FilePath),) + self.Fingerprint(stat) + (Md5, time.time()))
+
+
+# use this class to remember the contigs found by full scans of vcf and tsv files
+class ContigLedger(SqliteStore):
+    '''
+    SQLite ledger of the raw contig names found by full scans of vcf and tsv
+    files, keyed by absolute path and recorded with the size and modification
+    time of the file when it was scanned. Names are only returned while the
+    file still has the same size and modification time
+    '''
+    
+    FileName, Variable, Description = 'contigs.sqlite', 'GAEA_CONTIG_LEDGER', 'contig ledger'
+    Schema = ['CREATE TABLE IF NOT EXISTS contigs (path TEXT, type TEXT, size INTEGER, mtime_ns INTEGER, names TEXT NOT NULL, recorded REAL, PRIMARY KEY (path, type))']
+    
+    def Lookup(self, FilePath, FileType):
+        '''
+        (ContigLedger, str, str) -> list
+        Return the list of contig names recorded for FilePath of FileType or
+        None if none were recorded or if the file was modified since
+        '''
+        
+        with self.Reading() as conn:
+            row = conn.execute('SELECT size, mtime_ns, names FROM contigs WHERE path = ? AND type = ?', (os.path.abspath(FilePath), FileType)).fetchone()
+        if row is None:
+            return None
+        stat = os.stat(FilePath)
+        if (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return json.loads(row[2])
+    
+    def Record(self, FilePath, FileType, stat, Names):
+        '''
+        (ContigLedger, str, str, os.stat_result, iterable) -> None
+        Record the contig Names found in FilePath of FileType when stat was taken
+        '''
+        
+        with self.Writing() as conn:
+            conn.execute('INSERT OR REPLACE INTO contigs VALUES (?,?,?,?,?,?)', (os.path.abspath(FilePath), FileType, stat.st_size, stat.st_mtime_ns, json.dumps(sorted(Names)), time.time()))
+
+
+# use this function to stream a file to the encryption process
+def FeedEncryption(FilePath, Stream, Md5, Errors, BufferSize):
+    '''
+    (str, file, hashlib.md5 | None, list, int) -> None
+    Read FilePath once, update the Md5 of the original file (unless Md5 is None)
+    and write the data to Stream, then close Stream. Errors are appended to the list Errors
+    '''
+    
+    try:
+        with open(FilePath, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(BufferSize), b''):
+                if Md5 is not None:
+                    Md5.update(chunk)
+                Stream.write(chunk)
+    except OSError as e:
+        Errors.append(e)
+    finally:
+        try:
+            Stream.close()
+        except OSError:
+            pass
+
+
+# use this function to encrypt a file and compute the md5sums of the original and encrypted files in a single read
+def EncryptAndHashFile(FilePath, OutFile, KeyRing, BufferSize=4*1024*1024, Ledger=None, Sink=None):
+    '''
+    (str, str, str, int, ChecksumLedger | None, file | None) -> int
+    Take the path to a file, the path OutFile to the encrypted file without the
+    .gpg extension and the path to the encryption keys. Read FilePath once, encrypt
+    it to OutFile.gpg while computing the md5sums of the original and encrypted
+    data and write them in OutFile.md5 and OutFile.gpg.md5. The md5sum of the
+    original file is taken from Ledger if the file didn't change since it was
+    recorded, and recorded otherwise. If Sink is given, the encrypted data is
+    written to Sink instead of OutFile.gpg. Return 0 if encryption succeeded
+    or the non-zero exit code otherwise
+    '''
+    
+    # remove sidecars of previous runs so that a failed run leaves no md5sums behind
+    for extension in ['.md5', '.gpg.md5']:
+        if os.path.isfile(OutFile + extension):
+            os.remove(OutFile + extension)
+    
+    try:
+        stat = os.stat(FilePath)
+    except OSError as e:
+        print('Could not encrypt {0}: {1}'.format(FilePath, e), file=sys.stderr)
+        return 1
+    # skip hashing the original file if its md5sum is known
+    Known = None
+    if Ledger is not None:
+        try:
+            Known = Ledger.Lookup([FilePath]).get(os.path.abspath(FilePath))
+        except sqlite3.Error as e:
+            print('Could not read the checksum ledger: {0}'.format(e), file=sys.stderr)
+    
+    MyCmd = ['gpg', '--no-default-keyring', '--keyring', KeyRing, '-r', 'EGA_Public_key', '-r', 'SeqProdBio', '--trust-model', 'always', '-o', '-', '-e']
+    OriginalMd5, EncryptedMd5, Errors = hashlib.md5() if Known is None else None, hashlib.md5(), []
+    gpg = subprocess.Popen(MyCmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # plain text is hashed and sent to gpg while the cipher text is hashed and saved
+    feeder = threading.Thread(target=FeedEncryption, args=(FilePath, gpg.stdin, OriginalMd5, Errors, BufferSize))
+    feeder.start()
+    try:
+        newfile = open(OutFile + '.gpg', 'wb') if Sink is None else Sink
+        try:
+            for chunk in iter(lambda: gpg.stdout.read(BufferSize), b''):
+                EncryptedMd5.update(chunk)
+                newfile.write(chunk)
+        finally:
+            if Sink is None:
+                newfile.close()
+    except OSError as e:
+        Errors.append(e)
+        gpg.kill()
+    feeder.join()
+    gpg.stdout.close()
+    ExitCode = gpg.wait()
+    
+    if ExitCode == 0 and len(Errors) == 0:
+        if Known is None:
+            Known = OriginalMd5.hexdigest()
+            # record the md5sum only if the file didn't change while it was read
+            if Ledger is not None and ChecksumLedger.Fingerprint(os.stat(FilePath)) == ChecksumLedger.Fingerprint(stat):
+                try:
+                    Ledger.Record(FilePath, stat, Known)
+                except (sqlite3.Error, OSError) as e:
+                    print('Could not record {0} in the checksum ledger: {1}'.format(FilePath, e), file=sys.stderr)
+        # write md5sums in the same format as md5sum | cut -f1 -d ' '
+        for extension, Md5 in [('.md5', Known), ('.gpg.md5', EncryptedMd5.hexdigest())]:
+            with open(OutFile + extension + '.tmp', 'w') as newfile:
+                newfile.write(Md5 + '\n')
+            os.replace(OutFile + extension + '.tmp', OutFile + extension)
+        return 0
+    else:
+        for i in Errors:
+            print('Could not encrypt {0}: {1}'.format(FilePath, i), file=sys.stderr)
+        if Sink is None and os.path.isfile(OutFile + '.gpg'):
+            os.remove(OutFile + '.gpg')
+        return ExitCode if ExitCode > 0 else 1
+
+
+# use this function to encrypt a file straight to the staging server
+def EncryptAndStreamFile(FilePath, OutFile, KeyRing, CredentialFile, Box, StagePath, Ledger=None):
+    '''
+    (str, str, str, str, str, str, ChecksumLedger | None) -> int
+    Take the path to a file, the path OutFile to the encrypted file without the
+    .gpg extension and the path to the encryption keys. Read FilePath once and
+    upload the encrypted data to StagePath on the staging server of Box while
+    it is encrypted, without writing it to disk. md5sums are written to
+    OutFile.md5 and OutFile.gpg.md5 and uploaded once the encrypted file is
+    staged. A line with Completed is printed for each staged file as in the
+    upload logs. Return 0 if all files were staged or a non-zero exit code otherwise
+    '''
+    
+    UserName, PassWord = ParseCredentials(CredentialFile, Box)
+    encryptedName = os.path.basename(OutFile) + '.gpg'
+    # aspera can't read from a pipe, the encrypted data is uploaded with lftp
+    Cmd = "ssh xfer4.res.oicr.on.ca \"lftp -u {0},{1} -e \\\" set ftp:ssl-allow false; put /dev/stdin -o {2}; bye;\\\" ftp://ftp-private.ebi.ac.uk\""
+    lftp = subprocess.Popen(Cmd.format(UserName, PassWord, os.path.join(StagePath, encryptedName)), shell=True, stdin=subprocess.PIPE)
+    ExitCode = EncryptAndHashFile(FilePath, OutFile, KeyRing, Ledger=Ledger, Sink=lftp.stdin)
+    try:
+        lftp.stdin.close()
+    except OSError:
+        pass
+    # an encrypted file not fully staged can't be checked with its md5sums
+    if lftp.wait() != 0 or ExitCode != 0:
+        print('Could not stage {0}'.format(encryptedName), file=sys.stderr)
+        for extension in ['.md5', '.gpg.md5']:
+            if os.path.isfile(OutFile + extension):
+                os.remove(OutFile + extension)
+        return ExitCode if ExitCode != 0 else 1
+    print('Completed {0}'.format(encryptedName))
+    
+    Cmd = "ssh xfer4.res.oicr.on.ca \"lftp -u {0},{1} -e \\\" set ftp:ssl-allow false; mput {3} {4} -O {2}; bye;\\\" ftp://ftp-private.ebi.ac.uk\""
+    ExitCode = subprocess.call(Cmd.format(UserName, PassWord, StagePath, OutFile + '.gpg.md5', OutFile + '.md5'), shell=True)
+    if ExitCode != 0:
+        print('Could not stage the md5sums of {0}'.format(encryptedName), file=sys.stderr)
+        return ExitCode
+    for extension in ['.gpg.md5', '.md5']:
+        print('Completed {0}'.format(os.path.basename(OutFile) + extension))
+    return 0
+
+
 # use this script to launch qsubs to encrypt the files and do a checksum
-def EncryptAndChecksum(CredentialFile, DataBase, Table, Box, alias, Object, filePaths, fileNames, KeyRing, OutDir, Mem, MyScript):
+def EncryptAndChecksum(CredentialFile, DataBase, Table, Box, alias, Object, filePaths, fileNames, KeyRing, OutDir, Mem, MyScript, MaxPerAlias=1, Lanes=None, Wave=None, CheckJob=False, Planner=None, PackSize=0):
     '''
-    (file, str, str, str, str, str, list, list, str, str, str, int, str) -> list
+    (file, str, str, str, str, str, list, list, str, str, str, int, str, int, list | None, JobWave | None, bool, ResourcePlanner | None, int) -> list
     Take the file with Credential to connect to db, a given alias for Object
     for Box in Table, lists with file paths and names, the path to the encryption
     keys, the directory where encrypted and cheksums are saved, and 
     memory allocated to run the jobs and return a list of exit codes specifying
-    if the jobs were launched successfully or not
+    if the jobs were launched successfully or not. Each file is encrypted and
+    checksummed by a single job reading the original file once.
+    At most MaxPerAlias files of the alias are encrypted at once. Lanes is the
+    list of the jobs last launched in each slot of the global cap, shared by
+    all aliases and updated in place. Each job waits for the jobs of the oldest slot.
+    If Wave is given, jobs are added to the Encrypt and CheckEncryption
+    stages of the wave instead of being submitted. Encryption is checked by
+    the watcher, or by a CheckEncryption job held on the jobs of the alias with CheckJob.
+    Memory, wallclock and queue of each job are planned by Planner from the size
+    of its files and files smaller than PackSize bytes are encrypted one after
+    the other by a single job of at most PackSize bytes
     '''
 
-    MyCmd1 = 'md5sum {0} | cut -f1 -d \' \' > {1}.md5'
-    MyCmd2 = 'gpg --no-default-keyring --keyring {2} -r EGA_Public_key -r SeqProdBio --trust-model always -o {1}.gpg -e {0}'
-    MyCmd3 = 'md5sum {0}.gpg | cut -f1 -d \' \' > {0}.gpg.md5'
+    MyCmd = 'module load python-gsi/3.6.4; python3.6 {0} EncryptFile -i {1} -o {2} -k {3}'
     
     # check that lists of file paths and names have the same number of entries
     if len(filePaths) != len(fileNames):
         return [-1]
     else:
-        # make a list to store the job names and job exit codes
-        JobExits, JobNames = [], []
+        # make a list to store the job names, scripts and file sizes
+        JobNames, BashScripts, Sizes = [], [], []
         # loop over files for that alias      
         for i in range(len(filePaths)):
             # check that FileName is valid
@@ -1849,69 +4976,108 @@ def EncryptAndChecksum(CredentialFile, DataBase, Table, Box, alias, Object, file
         
                     # get name of output file
                     OutFile = os.path.join(OutDir, fileNames[i])
-                    # put commands in shell script
-                    BashScript1 = os.path.join(qsubdir, alias + '_' + fileNames[i] + '_md5sum_original.sh')
-                    BashScript2 = os.path.join(qsubdir, alias + '_' + fileNames[i] + '_encrypt.sh')
-                    BashScript3 = os.path.join(qsubdir, alias + '_' + fileNames[i] + '_md5sum_encrypted.sh')
+                    # put command in shell script
+                    BashScript = os.path.join(qsubdir, alias + '_' + fileNames[i] + '_encrypt.sh')
+                    with open(BashScript, 'w') as newfile:
+                        newfile.write(MyCmd.format(MyScript, filePaths[i], OutFile, KeyRing) + '\n')
+                    JobNames.append('Encrypt.{0}'.format(alias + '__' + fileNames[i]))
+                    BashScripts.append(BashScript)
+                    Sizes.append(os.path.getsize(filePaths[i]))
+        
+        # array tasks are already cheap to schedule, only separate jobs are packed
+        Packs = PackFiles(Sizes, PackSize if Wave is None else 0)
+        # make a list to store the names of the jobs launched and their exit codes
+        JobExits, Units, Submitted = [], [], {}
+        for k in range(len(Packs)):
+            if len(Packs[k]) == 1:
+                UnitName, BashScript = JobNames[Packs[k][0]], BashScripts[Packs[k][0]]
+            else:
+                UnitName = 'EncryptPack.{0}.{1}'.format(alias, k + 1)
+                BashScript = os.path.join(qsubdir, alias + '_pack_{0}_encrypt.sh'.format(k + 1))
+                WritePackScript(BashScript, UnitName, [(JobNames[j], BashScripts[j]) for j in Packs[k]], logDir)
+            UnitSize = sum([Sizes[j] for j in Packs[k]])
+            if Planner is None:
+                UnitMem, Time, Queue = Mem, None, None
+            else:
+                UnitMem, Time, Queue = Planner.Plan(UnitSize)
             
-                    with open(BashScript1, 'w') as newfile:
-                        newfile.write(MyCmd1.format(filePaths[i], OutFile) + '\n')
-                    with open(BashScript2, 'w') as newfile:
-                        newfile.write(MyCmd2.format(filePaths[i], OutFile, KeyRing) + '\n')
-                    with open(BashScript3, 'w') as newfile:
-                        newfile.write(MyCmd3.format(OutFile) + '\n')
-        
-                    # launch qsub directly, collect job names and exit codes
-                    JobName1 = 'Md5sum.original.{0}'.format(alias + '__' + fileNames[i])
-                    # check if 1st file in list
-                    if i == 0:
-                        QsubCmd1 = "qsub -b y -P gsi -l h_vmem={0}g -N {1} -e {2} -o {2} \"bash {3}\"".format(Mem, JobName1, logDir, BashScript1)
-                    else:
-                        # launch job when previous job is done
-                        QsubCmd1 = "qsub -b y -P gsi -hold_jid {0} -l h_vmem={1}g -N {2} -e {3} -o {3} \"bash {4}\"".format(JobNames[-1], Mem, JobName1, logDir, BashScript1)
-                    job1 = subprocess.call(QsubCmd1, shell=True)
-                                   
-                    JobName2 = 'Encrypt.{0}'.format(alias + '__' + fileNames[i])
-                    QsubCmd2 = "qsub -b y -P gsi -hold_jid {0} -l h_vmem={1}g -N {2} -e {3} -o {3} \"bash {4}\"".format(JobName1, Mem, JobName2, logDir, BashScript2)
-                    job2 = subprocess.call(QsubCmd2, shell=True)
-                            
-                    JobName3 = 'Md5sum.encrypted.{0}'.format(alias + '__' + fileNames[i])
-                    QsubCmd3 = "qsub -b y -P gsi -hold_jid {0} -l h_vmem={1}g -N {2} -e {3} -o {3} \"bash {4}\"".format(JobName2, Mem, JobName3, logDir, BashScript3)
-                    job3 = subprocess.call(QsubCmd3, shell=True)
-                            
-                    # store job names and exit codes
-                    JobExits.extend([job1, job2, job3])
-                    JobNames.extend([JobName1, JobName2, JobName3])
+            # make a list of jobs to wait for
+            Holds = []
+            if MaxPerAlias > 0 and k >= MaxPerAlias:
+                # launch job when the job MaxPerAlias jobs earlier is done
+                Holds.append(Units[k - MaxPerAlias])
+            if Lanes:
+                # take the oldest slot of the global cap
+                Previous = Lanes.pop(0)
+                Lanes.append([UnitName])
+                Holds.extend([j for j in Previous if j not in Holds])
+            if Wave is None:
+                job = GetScheduler().Submit(UnitName, BashScript, logDir, UnitMem, Holds, Time, Queue)
+            else:
+                job = Wave.Add('Encrypt', UnitName, BashScript, logDir, UnitMem, Time, Queue)
+            if job == 0:
+                Submitted[UnitName] = UnitSize
+                    
+            # store job names and exit codes
+            JobExits.append(job)
+            Units.append(UnitName)
+        # array tasks are accounted under the name of their array, only separate jobs are planned from
+        if Planner is not None and Wave is None:
+            Planner.Record(Submitted)
         
         # launch check encryption job
-        MyCmd = 'sleep 300; module load python-gsi/3.6.4; python3.6 {0} CheckEncryption -c {1} -s {2} -t {3} -b {4} -a {5} -o {6} -j \"{7}\"'
-        # put commands in shell script
-        BashScript = os.path.join(qsubdir, alias + '_check_encryption.sh')
-        with open(BashScript, 'w') as newfile:
-            newfile.write(MyCmd.format(MyScript, CredentialFile, DataBase, Table, Box, alias, Object, ';'.join(JobNames)) + '\n')
-                
-        # launch qsub directly, collect job names and exit codes
-        JobName = 'CheckEncryption.{0}'.format(alias)
-        # launch job when previous job is done
-        QsubCmd = "qsub -b y -P gsi -hold_jid {0} -l h_vmem={1}g -N {2} -e {3} -o {3} \"bash {4}\"".format(JobNames[-1], Mem, JobName, logDir, BashScript)
-        job = subprocess.call(QsubCmd, shell=True)
-        # store the exit code (but not the job name)
-        JobExits.append(job)          
+        if CheckJob:
+            # jobs record their exit codes before ending, the check job runs once they are all done
+            MyCmd = 'module load python-gsi/3.6.4; python3.6 {0} CheckEncryption -c {1} -s {2} -t {3} -b {4} -a {5} -o {6} --Held'
+            # put commands in shell script
+            BashScript = os.path.join(qsubdir, alias + '_check_encryption.sh')
+            with open(BashScript, 'w') as newfile:
+                newfile.write(MyCmd.format(MyScript, CredentialFile, DataBase, Table, Box, alias, Object) + '\n')
+                    
+            # launch qsub directly, collect job names and exit codes
+            JobName = 'CheckEncryption.{0}'.format(alias)
+            # launch job when all encryption jobs of the alias are done
+            if Wave is None:
+                job = GetScheduler().Submit(JobName, BashScript, logDir, Mem, Units)
+            else:
+                job = Wave.Add('CheckEncryption', JobName, BashScript, logDir, Mem)
+            # store the exit code (but not the job name)
+            JobExits.append(job)          
         
         return JobExits
 
 
 
 # use this function to encrypt files and update status to encrypting
-def EncryptFiles(CredentialFile, DataBase, Table, Object, Box, KeyRing, Mem, DiskSpace, MyScript):
+def EncryptFiles(CredentialFile, DataBase, Table, Object, Box, KeyRing, Mem, DiskSpace, MyScript, MaxPerAlias=1, MaxJobs=0, ArrayJobs=False, CheckJobs=False, Queues=None, PackSize=0):
     '''
-    (file, str, str, str, str, str, str, int, str, str) -> None
+    (file, str, str, str, str, str, str, int, str, str, int, int, bool, bool, dict | None, int) -> None
     Take a file with credentials to connect to Database, encrypt files of aliases
     of Object (analyses or runs) only if DiskSpace (in TB) is available in scratch
     after encryption and update file status to encrypting if encryption and md5sum
-    jobs are successfully launched using required memory 
+    jobs are successfully launched using required memory. Up to MaxPerAlias files
+    of an alias and MaxJobs files overall (no limit if 0), counting the
+    encryption jobs of earlier runs still queued or running, are encrypted at once.
+    With ArrayJobs, all files are encrypted by a single array job followed by
+    an array job checking the encryption of each alias if CheckJobs is True.
+    Encryption is checked by the watcher unless CheckJobs is True.
+    Files encrypted by a previous run are kept if their encrypted file and
+    md5sums are intact, only the other files of the alias are encrypted again.
+    Jobs are sized from the size of their files and the resources used by
+    earlier encryption jobs, using the wallclock limits of Queues {queue: hours},
+    and files smaller than PackSize bytes are packed in single jobs
     '''
     
+    # list the last jobs of each slot of the global cap, starting with the jobs of earlier runs
+    Lanes, Remaining = GetEncryptionLanes(MaxJobs)
+    if ArrayJobs and MaxJobs > 0 and Remaining <= 0:
+        # all slots are taken, aliases are encrypted by a later run
+        return
+    # plan memory, wallclock and queue of the jobs from earlier jobs
+    Planner = ResourcePlanner('Encrypt', Mem, Queues)
+    # collect the jobs of all aliases in array jobs
+    Wave = JobWave('{0}.{1}'.format(Box, time.strftime('%Y%m%d%H%M%S')), Remaining) if ArrayJobs else None
+    Launched = []
     # create a list of aliases for encryption 
     Aliases = SelectAliasesForEncryption(CredentialFile, DataBase, Table, Box, DiskSpace)
     
@@ -1940,41 +5106,232 @@ def EncryptFiles(CredentialFile, DataBase, Table, Object, Box, KeyRing, Mem, Dis
                     assert '/scratch2/groups/gsi/bis/EGA_Submissions' in WorkingDir
                     # convert single quotes to double quotes for str -> json conversion
                     files = json.loads(i[1].replace("'", "\""))
+                    # keep files encrypted by previous runs if their outputs are intact
+                    Encrypted = ListEncryptedFiles(files, WorkingDir)
                     # create parallel lists of file paths and names
                     filePaths, fileNames = [] , [] 
                     # loop over files for that alias
                     for file in files:
+                        if file in Encrypted:
+                            continue
                         # get the filePath and fileName
                         filePaths.append(files[file]['filePath'])
                         fileNames.append(files[file]['fileName'])
+                        files[file] = SetEncryptionStatus(files[file], 'running')
 
                     # remove encrypted files if already exist in working directory
                     # it generates an error if encrypted files are present and encryption starts again
                     # make a list of files in working directory
-                    CurrentEncrypted = [os.path.join(WorkingDir, j) for j in os.listdir(WorkingDir) if j[-4:] == '.gpg' in j] 
+                    Kept = [files[j]['fileName'] + '.gpg' for j in Encrypted]
+                    CurrentEncrypted = [os.path.join(WorkingDir, j) for j in os.listdir(WorkingDir) if j[-4:] == '.gpg' and j not in Kept] 
                     for j in CurrentEncrypted:
                         os.remove(j)
                     
-                    # update status -> encrypting
-                    conn = EstablishConnection(CredentialFile, DataBase)
-                    cur = conn.cursor()
-                    cur.execute('UPDATE {0} SET {0}.Status=\"encrypting\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{1}\" AND {0}.egaBox=\"{2}\"'.format(Table, alias, Box))
-                    conn.commit()
-                    conn.close()
+                    # update status -> encrypting and record the files being encrypted
+                    with DatabaseConnection(CredentialFile, DataBase) as conn:
+                        cur = conn.cursor()
+                        cur.execute('UPDATE {0} SET {0}.Status=\"encrypting\", {0}.files=\"{1}\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, str(files), alias, Box))
+                        conn.commit()
+                    
+                    # check the alias directly if all files were already encrypted
+                    if len(filePaths) == 0:
+                        CheckBoxEncryption(CredentialFile, DataBase, Table, Box, Object, [alias])
+                        continue
 
                     # encrypt and run md5sums on original and encrypted files and check encryption status
-                    JobCodes = EncryptAndChecksum(CredentialFile, DataBase, Table, Box, alias, Object, filePaths, fileNames, KeyRing, WorkingDir, Mem, MyScript)
+                    Marker = Wave.Mark() if Wave is not None else None
+                    JobCodes = EncryptAndChecksum(CredentialFile, DataBase, Table, Box, alias, Object, filePaths, fileNames, KeyRing, WorkingDir, Mem, MyScript, MaxPerAlias, Lanes, Wave, CheckJobs, Planner, PackSize)
                     # check if encription was launched successfully
                     if not (len(set(JobCodes)) == 1 and list(set(JobCodes))[0] == 0):
+                        # drop the jobs of the alias from the wave
+                        if Wave is not None:
+                            Wave.Restore(Marker)
                         # store error message, reset status encrypting --> encrypt
                         Error = 'Could not launch encryption jobs'
-                        conn = EstablishConnection(CredentialFile, DataBase)
-                        cur = conn.cursor()
-                        cur.execute('UPDATE {0} SET {0}.Status=\"encrypt\", {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, alias, Box))
-                        conn.commit()
-                        conn.close()
+                        files = {j: files[j] if j in Encrypted else SetEncryptionStatus(files[j], 'pending') for j in files}
+                        with DatabaseConnection(CredentialFile, DataBase) as conn:
+                            cur = conn.cursor()
+                            cur.execute('UPDATE {0} SET {0}.Status=\"encrypt\", {0}.files=\"{1}\", {0}.errorMessages=\"{2}\" WHERE {0}.alias=\"{3}\" AND {0}.egaBox=\"{4}\"'.format(Table, str(files), Error, alias, Box))
+                            conn.commit()
+                    else:
+                        Launched.append(alias)
+            
+            # submit the array jobs of the wave
+            if Wave is not None and len(Wave) != 0 and Wave.Submit() != 0:
+                # reset status encrypting --> encrypt for all aliases of the wave
+                Transitions = StatusTransitions(CredentialFile, DataBase, Table, Box)
+                for alias in Launched:
+                    Transitions.Add(alias, Status='encrypt', errorMessages='Could not launch encryption jobs')
+                Transitions.Flush()
  
         
+# use this function to share the global cap of encryption jobs with the jobs of earlier runs
+def GetEncryptionLanes(MaxJobs):
+    '''
+    (int) -> tuple
+    Return a tuple with the list of MaxJobs slots of the global cap of
+    encryption jobs, each a list of the queued or running encryption jobs
+    the next job of the slot must wait for, and the number of slots not
+    taken by these jobs. Array jobs may run as many tasks as the cap and
+    take all slots. There are no slots if MaxJobs is 0
+    '''
+    
+    Jobs, Arrays = [], []
+    if MaxJobs > 0:
+        try:
+            Active = GetScheduler().ActiveJobs()
+        except (OSError, subprocess.CalledProcessError):
+            Active = set()
+        for i in sorted(Active):
+            if i.startswith('Encrypt.') or i.startswith('EncryptPack.'):
+                if os.path.isfile(os.path.join(GetJobDir(), 'arrays', i + '.manifest')):
+                    Arrays.append(i)
+                else:
+                    Jobs.append(i)
+    Lanes = [list(Arrays) for i in range(MaxJobs)]
+    for i in range(len(Jobs)):
+        Lanes[i % MaxJobs].append(Jobs[i])
+    return Lanes, MaxJobs - len(Jobs) - MaxJobs * len(Arrays)
+
+
+# use this function to read a md5sum written by EncryptFile
+def ReadMd5(Md5File):
+    '''
+    (str) -> str
+    Return the md5sum saved in Md5File or an empty string if the file can't be read
+    '''
+    
+    try:
+        with open(Md5File) as infile:
+            return infile.read().strip()
+    except OSError:
+        return ''
+
+
+# use this function to get the md5sums of original files from the checksum ledger
+def LookupChecksums(FilePaths):
+    '''
+    (list) -> dict
+    Return a dictionary with the md5sums recorded in the checksum ledger for
+    the files in FilePaths that didn't change since they were recorded
+    '''
+    
+    if len(FilePaths) == 0:
+        return {}
+    Ledger = ChecksumLedger.Open()
+    try:
+        return Ledger.Lookup(list(FilePaths)) if Ledger is not None else {}
+    except sqlite3.Error as e:
+        print('Could not read the checksum ledger: {0}'.format(e), file=sys.stderr)
+        return {}
+
+
+# use this function to record the encryption status of a file
+def SetEncryptionStatus(FileInfo, Status, Checksums=None):
+    '''
+    (dict, str, dict | None) -> dict
+    Return a copy of the FileInfo dictionary of a file in the files column with
+    its encryption Status (pending, running, done or failed) and for done files
+    the encryptedName, unencryptedChecksum and checksum given in Checksums
+    '''
+    
+    FileInfo = dict(FileInfo)
+    FileInfo['encryptionStatus'] = Status
+    for i in ['encryptedName', 'unencryptedChecksum', 'checksum']:
+        if Status == 'done':
+            FileInfo[i] = Checksums[i]
+        elif i in FileInfo:
+            # checksums of a previous run are no longer valid
+            del FileInfo[i]
+    return FileInfo
+
+
+# use this function to find the files of an alias encrypted by a previous run
+def ListEncryptedFiles(files, WorkingDir):
+    '''
+    (dict, str) -> list
+    Take the files dictionary of an alias and the working directory and return
+    the list of files recorded as done whose encrypted file and md5sums are
+    still in the working directory, and whose original file didn't change
+    since it was encrypted according to the checksum ledger
+    '''
+    
+    Done = [i for i in files if files[i].get('encryptionStatus') == 'done']
+    if len(Done) == 0:
+        return []
+    Checksums = LookupChecksums(Done)
+    Encrypted = []
+    for file in Done:
+        fileName = files[file]['fileName']
+        if Checksums.get(os.path.abspath(file)) == files[file]['unencryptedChecksum'] \
+           and os.path.isfile(os.path.join(WorkingDir, fileName + '.gpg')) \
+           and ReadMd5(os.path.join(WorkingDir, fileName + '.md5')) == files[file]['unencryptedChecksum'] \
+           and ReadMd5(os.path.join(WorkingDir, fileName + '.gpg.md5')) == files[file]['checksum']:
+            Encrypted.append(file)
+    return Encrypted
+
+
+# use this function to record the encryption status of each file of an alias
+def TrackEncryptedFiles(alias, files, Verified, ExitCodes):
+    '''
+    (str, dict, dict, dict) -> tuple
+    Take the files dictionary of alias, the dictionary of verified files
+    returned by VerifyEncryptedFiles and the exit codes of the encryption jobs
+    and return a tuple with a boolean indicating if all files are encrypted
+    and the files dictionary with the encryption status of each file.
+    Files without job are done if they were done in a previous run
+    '''
+    
+    Tracked, Done = {}, True
+    for file in files:
+        JobName = 'Encrypt.{0}'.format(alias + '__' + files[file]['fileName'])
+        if JobName in ExitCodes:
+            Succeeded = ExitCodes[JobName] == '0'
+        else:
+            Succeeded = files[file].get('encryptionStatus') == 'done'
+        if Succeeded and file in Verified:
+            Tracked[file] = SetEncryptionStatus(files[file], 'done', Verified[file])
+        else:
+            Tracked[file] = SetEncryptionStatus(files[file], 'failed')
+            Done = False
+    return Done, Tracked
+
+
+# use this function to collect the md5sums of the encrypted files of an alias
+def VerifyEncryptedFiles(files, WorkingDir, Object, Checksums=None, Streamed=False):
+    '''
+    (dict, str, str, dict | None, bool) -> tuple
+    Take the files dictionary of an alias of Object, the working directory
+    where files are encrypted and return a tuple with a boolean indicating if all
+    files were encrypted with md5sums and the updated files dictionary.
+    md5sums of original files are taken from Checksums {file path: md5sum}
+    returned by the checksum ledger, or from the md5 files. Encrypted files
+    streamed to the staging server are not expected in the working directory
+    '''
+    
+    if Checksums is None:
+        Checksums = {}
+    # create a dict to store the updated file info
+    Files = {}
+    # create boolean, update when md5sums and encrypted file not found
+    Encrypted = True
+    for file in files:
+        # get the fileName
+        fileName = files[file]['fileName']
+        # check that encrypted and md5sum files do exist
+        encryptedName = fileName + '.gpg'
+        encryptedMd5 = ReadMd5(os.path.join(WorkingDir, fileName + '.gpg.md5'))
+        originalMd5 = Checksums.get(os.path.abspath(file), '') or ReadMd5(os.path.join(WorkingDir, fileName + '.md5'))
+        if (Streamed or os.path.isfile(os.path.join(WorkingDir, encryptedName))) and encryptedMd5 != '' and originalMd5 != '':
+            # capture md5sums, build updated dict
+            Files[file] = {'filePath': file, 'unencryptedChecksum': originalMd5, 'encryptedName': encryptedName, 'checksum': encryptedMd5}
+            if Object == 'analyses':
+                Files[file]['fileTypeId'] = files[file]['fileTypeId']
+        else:
+            Encrypted = False
+    return Encrypted, Files
+
+
 # use this function to check that encryption is done for a given alias
 def CheckEncryption(CredentialFile, DataBase, Table, Box, Alias, Object, JobNames):
     '''
@@ -2006,80 +5363,52 @@ def CheckEncryption(CredentialFile, DataBase, Table, Box, Alias, Object, JobName
         WorkingDir = GetWorkingDirectory(Data[2])
         # convert single quotes to double quotes for str -> json conversion
         files = json.loads(Data[1].replace("'", "\""))
-        # create a dict to store the updated file info
-        Files = {}
-                
-        # create boolean, update when md5sums and encrypted file not found or if jobs didn't exit properly 
-        Encrypted = True
+        # check that files were encrypted and that md5sums were generated
+        Encrypted, Files = VerifyEncryptedFiles(files, WorkingDir, Object, LookupChecksums(files))
         
         # check the exit status of each encryption and md5sum jobs for that alis
-        for jobName in JobNames:
-            if GetJobExitStatus(jobName) != '0':
-                Encrypted = False
+        # files encrypted by a previous run have no job
+        ExitCodes = GetJobExitStatuses([i for i in JobNames if i != ''])
+        # record the status of each file so that only failed files are encrypted again
+        Encrypted, Tracked = TrackEncryptedFiles(alias, files, Files, ExitCodes)
         
-        # check that files were encrypted and that md5sums were generated
-        for file in files:
-            # get the fileName
-            fileName = files[file]['fileName']
-            if Object == 'analyses':
-                fileTypeId = files[file]['fileTypeId']
-            # check that encryoted and md5sum files do exist
-            originalMd5File = os.path.join(WorkingDir, fileName + '.md5')
-            encryptedMd5File = os.path.join(WorkingDir, fileName + '.gpg.md5')
-            encryptedFile = os.path.join(WorkingDir, fileName + '.gpg')
-            if os.path.isfile(originalMd5File) and os.path.isfile(encryptedMd5File) and os.path.isfile(encryptedFile):
-                # get the name of the encrypted file
-                encryptedName = fileName + '.gpg'
-                # get the md5sums
-                encryptedMd5 = subprocess.check_output('cat {0}'.format(encryptedMd5File), shell = True).decode('utf-8').rstrip()
-                originalMd5 = subprocess.check_output('cat {0}'.format(originalMd5File), shell = True).decode('utf-8').rstrip()
-                if encryptedMd5 != '' and originalMd5 != '':
-                    # capture md5sums, build updated dict
-                    if Object == 'analyses':
-                        Files[file] = {'filePath': file, 'unencryptedChecksum': originalMd5, 'encryptedName': encryptedName, 'checksum': encryptedMd5, 'fileTypeId': fileTypeId} 
-                    elif Object == 'runs':
-                        Files[file] = {'filePath': file, 'unencryptedChecksum': originalMd5, 'encryptedName': encryptedName, 'checksum': encryptedMd5}
-                else:
-                    # update boolean
-                    Encrypted = False
-            else:
-                # update boollean
-                Encrypted = False
-                
         # check if md5sums and encrypted files is available for all files
         if Encrypted == True:
             # update file info and status only if all files do exist and md5sums can be extracted
-            conn = EstablishConnection(CredentialFile, DataBase)
-            cur = conn.cursor()
-            cur.execute('UPDATE {0} SET {0}.files=\"{1}\", {0}.errorMessages=\"None\", {0}.Status=\"upload\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, str(Files), alias, Box))
-            conn.commit()
-            conn.close()
+            with DatabaseConnection(CredentialFile, DataBase) as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE {0} SET {0}.files=\"{1}\", {0}.errorMessages=\"None\", {0}.Status=\"upload\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, str(Files), alias, Box))
+                conn.commit()
         elif Encrypted == False:
             # reset status encrypting -- > encrypt, record error message
             Error = 'Encryption or md5sum did not complete'
-            conn = EstablishConnection(CredentialFile, DataBase)
-            cur = conn.cursor()
-            cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\", {0}.Status=\"encrypt\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, alias, Box))
-            conn.commit()
-            conn.close()
+            with DatabaseConnection(CredentialFile, DataBase) as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE {0} SET {0}.files=\"{1}\", {0}.errorMessages=\"{2}\", {0}.Status=\"encrypt\" WHERE {0}.alias=\"{3}\" AND {0}.egaBox=\"{4}\"'.format(Table, str(Tracked), Error, alias, Box))
+                conn.commit()
     else:
         # couldn't evaluate encryption, record error and reset to encrypt
         # reset status encrypting -- > encrypt, record error message
         Error = 'Could not check encryption'
-        conn = EstablishConnection(CredentialFile, DataBase)
-        cur = conn.cursor()
-        cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\", {0}.Status=\"encrypt\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, Alias, Box))
-        conn.commit()
-        conn.close()
+        with DatabaseConnection(CredentialFile, DataBase) as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE {0} SET {0}.errorMessages=\"{1}\", {0}.Status=\"encrypt\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, Alias, Box))
+            conn.commit()
 
 # use this script to launch qsubs to encrypt the files and do a checksum
-def UploadAliasFiles(alias, files, StagePath, FileDir, CredentialFile, DataBase, Table, Object, Box, Mem, UploadMode, MyScript, **KeyWordParams):
+def UploadAliasFiles(alias, files, StagePath, FileDir, CredentialFile, DataBase, Table, Object, Box, Mem, UploadMode, MyScript, Wave=None, CheckJob=False, Planner=None, PackSize=0, **KeyWordParams):
     '''
-    (str, dict, str, str, str, str, str, str, str, str, str, str, str, dict) -> list
+    (str, dict, str, str, str, str, str, str, str, str, str, str, str, JobWave | None, bool, ResourcePlanner | None, int, dict) -> list
     Take a files dictionary with file information for a given alias in Box, the file with 
     DataBase credentials, the Table names, the directory StagePath where to upload
     the files in UploadMode, the directory FileDir where the command scripts are saved, name, memory and path to script to launch the jobs and return a list of
-    exit codes used for uploading the encrypted and md5 files 
+    exit codes used for uploading the encrypted and md5 files. If Wave is given,
+    jobs are added to the MakeDestinationDir, Upload and CheckUpload stages
+    of the wave instead of being submitted. Upload is checked by the watcher,
+    or by a CheckUpload job held on the jobs of the alias with CheckJob.
+    Memory, wallclock and queue of each job are planned by Planner from the size
+    of its files and files smaller than PackSize bytes are uploaded one after
+    the other by a single job of at most PackSize bytes
     '''
     
     # parse the crdential file, get username and password for given box
@@ -2103,8 +5432,8 @@ def UploadAliasFiles(alias, files, StagePath, FileDir, CredentialFile, DataBase,
     elif UploadMode == 'aspera':
         UploadCmd = "ssh xfer4.res.oicr.on.ca \"export ASPERA_SCP_PASS={0};ascp -P33001 -O33001 -QT -l300M {1} {2}@fasp.ega.ebi.ac.uk:{3};ascp -P33001 -O33001 -QT -l300M {4} {2}@fasp.ega.ebi.ac.uk:{3};ascp -P33001 -O33001 -QT -l300M {5} {2}@fasp.ega.ebi.ac.uk:{3};\""
       
-    # create parallel lists to store the job names and exit codes
-    JobExits, JobNames = [], []
+    # create parallel lists to store the job names, scripts and file sizes
+    JobExits, JobNames, BashScripts, Sizes = [], [], [], []
     
     # make a list of file paths
     filePaths = list(files.keys())
@@ -2118,9 +5447,11 @@ def UploadAliasFiles(alias, files, StagePath, FileDir, CredentialFile, DataBase,
             newfile.write(Cmd.format(UserName, MyPassword, StagePath))    
         # launch job directly for the 1st file only
         JobName = 'MakeDestinationDir.{0}'.format(alias)
-        QsubCmd = "qsub -b y -P gsi -N {0} -e {1} -o {1} \"bash {2}\"".format(JobName, logDir, BashScript)
         if JobName not in JobNames:
-            job = subprocess.call(QsubCmd, shell=True)
+            if Wave is None:
+                job = GetScheduler().Submit(JobName, BashScript, logDir)
+            else:
+                job = Wave.Add('MakeDestinationDir', JobName, BashScript, logDir)
             # record job name but not exit code.
             # may produce an error message if directory already exists. do not evaluate command during CheckUpload
             JobNames.append(JobName)
@@ -2142,54 +5473,90 @@ def UploadAliasFiles(alias, files, StagePath, FileDir, CredentialFile, DataBase,
             newfile = open(BashScript, 'w')
             newfile.write(MyCmd + '\n')
             newfile.close()
-            # launch job directly
-            JobName = 'Upload.{0}'.format(alias + '__' + fileName)
-            # hold until previous job is done
-            QsubCmd = "qsub -b y -P gsi -hold_jid {0} -l h_vmem={1}g -N {2} -e {3} -o {3} \"bash {4}\"".format(JobNames[-1], Mem, JobName, logDir, BashScript)
-            job = subprocess.call(QsubCmd, shell=True)
-            # store job exit code and name
-            JobExits.append(job)
-            JobNames.append(JobName)
+            JobNames.append('Upload.{0}'.format(alias + '__' + fileName))
+            BashScripts.append(BashScript)
+            Sizes.append(sum([os.path.getsize(j) for j in [encryptedFile, originalMd5, encryptedMd5]]))
         else:
             return [-1]
     
-    # launch check upload job
+    # array tasks are already cheap to schedule, only separate jobs are packed
+    Packs = PackFiles(Sizes, PackSize if Wave is None else 0)
+    # upload jobs run one after the other, starting after the destination directory is made
+    Units, Submitted = JobNames[:1], {}
+    for k in range(len(Packs)):
+        if len(Packs[k]) == 1:
+            UnitName, BashScript = JobNames[Packs[k][0] + 1], BashScripts[Packs[k][0]]
+        else:
+            UnitName = 'UploadPack.{0}.{1}'.format(alias, k + 1)
+            BashScript = os.path.join(qsubdir, alias + '_pack_{0}_upload.sh'.format(k + 1))
+            WritePackScript(BashScript, UnitName, [(JobNames[j + 1], BashScripts[j]) for j in Packs[k]], logDir)
+        UnitSize = sum([Sizes[j] for j in Packs[k]])
+        if Planner is None:
+            UnitMem, Time, Queue = Mem, None, None
+        else:
+            UnitMem, Time, Queue = Planner.Plan(UnitSize)
+        # hold until previous job is done
+        if Wave is None:
+            job = GetScheduler().Submit(UnitName, BashScript, logDir, UnitMem, [Units[-1]], Time, Queue)
+        else:
+            job = Wave.Add('Upload', UnitName, BashScript, logDir, UnitMem, Time, Queue)
+        if job == 0:
+            Submitted[UnitName] = UnitSize
+        # store job exit code and name
+        JobExits.append(job)
+        Units.append(UnitName)
+    # array tasks are accounted under the name of their array, only separate jobs are planned from
+    if Planner is not None and Wave is None:
+        Planner.Record(Submitted)
+    
+    # upload is checked by the watcher
+    if not CheckJob:
+        return JobExits
+    
+    # launch check upload job, jobs record their exit codes before ending
     if Object == 'analyses':
         if 'attributes' in KeyWordParams:
             AttributesTable = KeyWordParams['attributes']
-        CheckCmd = 'sleep 600; module load python-gsi/3.6.4; python3.6 {0} CheckUpload -c {1} -s {2} -t {3} -b {4} -a {5} -j \"{6}\" -o {7} --Attributes {8}'
+        CheckCmd = 'module load python-gsi/3.6.4; python3.6 {0} CheckUpload -c {1} -s {2} -t {3} -b {4} -a {5} -o {6} --Held --Attributes {7}'
     elif Object == 'runs':
-        CheckCmd = 'sleep 600; module load python-gsi/3.6.4; python3.6 {0} CheckUpload -c {1} -s {2} -t {3} -b {4} -a {5} -j \"{6}\" -o {7}' 
+        CheckCmd = 'module load python-gsi/3.6.4; python3.6 {0} CheckUpload -c {1} -s {2} -t {3} -b {4} -a {5} -o {6} --Held' 
     
-    # do not check job used to make destination directory
-    JobNames = JobNames[1:]
     # put commands in shell script
     BashScript = os.path.join(qsubdir, alias + '_check_upload.sh')
     with open(BashScript, 'w') as newfile:
         if Object == 'analyses':
-            newfile.write(CheckCmd.format(MyScript, CredentialFile, DataBase, Table, Box, alias, ';'.join(JobNames), Object, AttributesTable) + '\n')
+            newfile.write(CheckCmd.format(MyScript, CredentialFile, DataBase, Table, Box, alias, Object, AttributesTable) + '\n')
         elif Object == 'runs':
-            newfile.write(CheckCmd.format(MyScript, CredentialFile, DataBase, Table, Box, alias, ';'.join(JobNames), Object) + '\n')
+            newfile.write(CheckCmd.format(MyScript, CredentialFile, DataBase, Table, Box, alias, Object) + '\n')
             
     # launch qsub directly, collect job names and exit codes
     JobName = 'CheckUpload.{0}'.format(alias)
     # launch job when previous job is done
-    QsubCmd = "qsub -b y -P gsi -hold_jid {0} -l h_vmem={1}g -N {2} -e {3} -o {3} \"bash {4}\"".format(JobNames[-1], Mem, JobName, logDir, BashScript)
-    job = subprocess.call(QsubCmd, shell=True)
+    if Wave is None:
+        job = GetScheduler().Submit(JobName, BashScript, logDir, Mem, [Units[-1]])
+    else:
+        job = Wave.Add('CheckUpload', JobName, BashScript, logDir, Mem)
     # store the exit code (but not the job name)
     JobExits.append(job)          
         
     return JobExits
 
 # use this function to upload the files
-def UploadObjectFiles(CredentialFile, DataBase, Table, Object, FootPrintTable, Box, Mem, UploadMode, Max, MaxFootPrint, MyScript, **KeyWordParams):
+def UploadObjectFiles(CredentialFile, DataBase, Table, Object, FootPrintTable, Box, Mem, UploadMode, Max, MaxFootPrint, MyScript, ArrayJobs=False, CheckJobs=False, Queues=None, PackSize=0, **KeyWordParams):
     '''
-    (file, str, str, str, str, int, int, str) -> None
+    (file, str, str, str, str, int, int, str, bool, bool, dict | None, int) -> None
     Take the file with credentials to connect to the database and to EGA,
     and upload files of aliases with upload status using specified Memory and 
-    UploadMode and update status to uploading. 
+    UploadMode and update status to uploading. With ArrayJobs, the jobs of
+    all aliases are submitted as one array job per step. Upload is checked
+    by the watcher unless CheckJobs is True and a checking job is launched.
+    Jobs are sized from the size of their files and the resources used by
+    earlier upload jobs, using the wallclock limits of Queues {queue: hours},
+    and files smaller than PackSize bytes are packed in single jobs
     '''
     
+    # plan memory, wallclock and queue of the jobs from earlier jobs
+    Planner = ResourcePlanner('Upload', Mem, Queues)
     
     # connect to database
     conn = EstablishConnection(CredentialFile, DataBase)
@@ -2229,13 +5596,16 @@ def UploadObjectFiles(CredentialFile, DataBase, Table, Object, FootPrintTable, B
     # check that alias are ready for uploading and that staging server's limit is not reached 
     if len(Data) != 0 and 0 <= NotRegistered < MaxFootPrint:
         # count the number of files being uploaded
-        Uploading = int(subprocess.check_output('qstat | grep Upload | wc -l', shell=True).decode('utf-8').rstrip())        
+        Uploading = GetScheduler().CountJobs('Upload')        
         # upload new files up to Max
         Maximum = int(Max) - Uploading
         if Maximum < 0:
             Maximum = 0
         Data = Data[: Maximum]
         
+        # collect the jobs of all aliases in array jobs
+        Wave = JobWave('{0}.{1}'.format(Box, time.strftime('%Y%m%d%H%M%S'))) if ArrayJobs else None
+        Launched = []
         for i in Data:
             alias = i[0]
             # get the file information, working directory and stagepath for that alias
@@ -2245,32 +5615,180 @@ def UploadObjectFiles(CredentialFile, DataBase, Table, Object, FootPrintTable, B
             StagePath  = i[3]
                             
             # update status -> uploading
-            conn = EstablishConnection(CredentialFile, DataBase)
-            cur = conn.cursor()
-            cur.execute('UPDATE {0} SET {0}.Status=\"uploading\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{1}\" AND {0}.egaBox=\"{2}\";'.format(Table, alias, Box))
-            conn.commit()
-            conn.close()
+            with DatabaseConnection(CredentialFile, DataBase) as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE {0} SET {0}.Status=\"uploading\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{1}\" AND {0}.egaBox=\"{2}\";'.format(Table, alias, Box))
+                conn.commit()
             
             # upload files
-            JobCodes = UploadAliasFiles(alias, files, StagePath, WorkingDir, CredentialFile, DataBase, Table, Object, Box, Mem, UploadMode, MyScript, **KeyWordParams)
+            Marker = Wave.Mark() if Wave is not None else None
+            JobCodes = UploadAliasFiles(alias, files, StagePath, WorkingDir, CredentialFile, DataBase, Table, Object, Box, Mem, UploadMode, MyScript, Wave, CheckJobs, Planner, PackSize, **KeyWordParams)
                         
             # check if upload launched properly for all files under that alias
             if not (len(set(JobCodes)) == 1 and list(set(JobCodes))[0] == 0):
+                # drop the jobs of the alias from the wave
+                if Wave is not None:
+                    Wave.Restore(Marker)
                 # record error message, reset status same uploading --> upload
                 Error = 'Could not launch upload jobs'
-                conn = EstablishConnection(CredentialFile, DataBase)
+                with DatabaseConnection(CredentialFile, DataBase) as conn:
+                    cur = conn.cursor()
+                    cur.execute('UPDATE {0} SET {0}.Status=\"upload\", {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, alias, Box))
+                    conn.commit()
+            else:
+                Launched.append(alias)
+        
+        # submit the array jobs of the wave
+        if Wave is not None and len(Wave) != 0 and Wave.Submit() != 0:
+            # reset status uploading --> upload for all aliases of the wave
+            Transitions = StatusTransitions(CredentialFile, DataBase, Table, Box)
+            for alias in Launched:
+                Transitions.Add(alias, Status='upload', errorMessages='Could not launch upload jobs')
+            Transitions.Flush()
+
+
+
+# use this function to launch the jobs streaming the files of an alias to the staging server
+def StreamAliasFiles(alias, files, StagePath, FileDir, CredentialFile, DataBase, Table, Object, Box, KeyRing, Mem, MyScript, CheckJob=False, Planner=None, **KeyWordParams):
+    '''
+    (str, dict, str, str, str, str, str, str, str, str, str, str, bool, ResourcePlanner | None, dict) -> list
+    Take a files dictionary with file information for a given alias in Box, the
+    directory StagePath where files are uploaded and the directory FileDir where
+    md5sums and command scripts are saved and return a list of exit codes of
+    the jobs encrypting each file straight to the staging server. Jobs run one
+    after the other once the destination directory is made and are named like
+    upload jobs so that they are checked as uploads. Upload is checked by the
+    watcher, or by a CheckUpload job held on the jobs of the alias with CheckJob
+    '''
+    
+    UserName, MyPassword = ParseCredentials(CredentialFile, Box)
+    
+    assert os.path.isdir(FileDir)
+    # make a directory to save the scripts
+    qsubdir = os.path.join(FileDir, 'qsubs')
+    if os.path.isdir(qsubdir) == False:
+        os.mkdir(qsubdir)
+    # create a log dir
+    logDir = os.path.join(qsubdir, 'log')
+    if os.path.isdir(logDir) == False:
+        os.mkdir(logDir)
+    
+    # no job is launched unless all files can be streamed
+    if not all([os.path.isfile(filePath) for filePath in files]):
+        return [-1]
+    
+    # create destination directory
+    Cmd = "ssh xfer4.res.oicr.on.ca \"lftp -u {0},{1} -e \\\" set ftp:ssl-allow false; mkdir -p {2}; bye;\\\" ftp://ftp-private.ebi.ac.uk\""
+    BashScript = os.path.join(qsubdir, alias + '_make_destination_directory.sh')
+    with open(BashScript, 'w') as newfile:
+        newfile.write(Cmd.format(UserName, MyPassword, StagePath))
+    JobName = 'MakeDestinationDir.{0}'.format(alias)
+    # exit code is not evaluated, directory may already exist
+    GetScheduler().Submit(JobName, BashScript, logDir)
+    
+    MyCmd = 'module load python-gsi/3.6.4; python3.6 {0} StreamFile -c {1} -b {2} -i {3} -o {4} -k {5} --StagePath {6}'
+    JobExits, JobNames, Submitted = [], [JobName], {}
+    for filePath in files:
+        fileName = files[filePath]['fileName']
+        BashScript = os.path.join(qsubdir, alias + '_' + fileName + '_stream.sh')
+        with open(BashScript, 'w') as newfile:
+            newfile.write(MyCmd.format(MyScript, CredentialFile, Box, filePath, os.path.join(FileDir, fileName), KeyRing, StagePath) + '\n')
+        JobName = 'Upload.{0}'.format(alias + '__' + os.path.basename(filePath))
+        Size = os.path.getsize(filePath)
+        if Planner is None:
+            JobMem, Time, Queue = Mem, None, None
+        else:
+            JobMem, Time, Queue = Planner.Plan(Size)
+        # hold until previous job is done
+        job = GetScheduler().Submit(JobName, BashScript, logDir, JobMem, [JobNames[-1]], Time, Queue)
+        if job != 0:
+            # the alias is streamed again from the start, stop the jobs already queued
+            for i in Submitted:
+                GetScheduler().Cancel(i)
+            return [job]
+        Submitted[JobName] = Size
+        JobExits.append(job)
+        JobNames.append(JobName)
+    if Planner is not None:
+        Planner.Record(Submitted)
+    
+    # check the alias once its jobs are done
+    if CheckJob:
+        CheckCmd = 'module load python-gsi/3.6.4; python3.6 {0} CheckUpload -c {1} -s {2} -t {3} -b {4} -a {5} -o {6} --Held'
+        if Object == 'analyses':
+            CheckCmd += ' --Attributes {0}'.format(KeyWordParams.get('attributes', 'empty'))
+        BashScript = os.path.join(qsubdir, alias + '_check_stream.sh')
+        with open(BashScript, 'w') as newfile:
+            newfile.write(CheckCmd.format(MyScript, CredentialFile, DataBase, Table, Box, alias, Object) + '\n')
+        JobExits.append(GetScheduler().Submit('CheckUpload.{0}'.format(alias), BashScript, logDir, Mem, [JobNames[-1]]))
+    return JobExits
+
+
+# use this function to encrypt files straight to the staging server
+def StreamObjectFiles(CredentialFile, DataBase, Table, Object, FootPrintTable, Box, KeyRing, Mem, Max, MaxFootPrint, MyScript, CheckJobs=False, Queues=None, **KeyWordParams):
+    '''
+    (str, str, str, str, str, str, str, str, int, int, str, bool, dict | None, dict) -> None
+    Take the file with credentials to connect to the database and to EGA and
+    encrypt the files of aliases with encrypt status straight to the staging
+    server, without writing encrypted files to scratch, and update status to
+    uploading. Aliases are streamed up to Max at once and while the footprint
+    of non-registered files on the staging server is below MaxFootPrint.
+    md5sums are recorded when upload is checked
+    '''
+    
+    # plan memory, wallclock and queue of the jobs from earlier jobs
+    Planner = ResourcePlanner('Stream', Mem, Queues)
+    
+    if Object == 'analyses':
+        AttributesTable = KeyWordParams.get('attributes', 'empty')
+        Cmd = 'SELECT {0}.alias, {0}.files, {0}.WorkingDirectory, {1}.StagePath FROM {0} JOIN {1} WHERE {0}.Status=\"encrypt\" AND {0}.egaBox=\"{2}\" AND {0}.AttributesKey = {1}.alias'.format(Table, AttributesTable, Box)
+    elif Object == 'runs':
+        Cmd = 'SELECT {0}.alias, {0}.files, {0}.WorkingDirectory, {0}.StagePath FROM {0} WHERE {0}.Status=\"encrypt\" AND {0}.egaBox=\"{1}\"'.format(Table, Box)
+    try:
+        with DatabaseConnection(CredentialFile, DataBase) as conn:
+            cur = conn.cursor()
+            cur.execute(Cmd)
+            Data = cur.fetchall()
+    except:
+        Data = []
+    
+    # get the footprint of non-registered files on the Box's staging server
+    NotRegistered = GetDiskSpaceStagingServer(CredentialFile, DataBase, FootPrintTable, Box)
+    if len(Data) == 0 or not 0 <= NotRegistered < MaxFootPrint:
+        return
+    # stream new files up to Max
+    Maximum = max(0, int(Max) - GetScheduler().CountJobs('Upload'))
+    for alias, files, WorkingDirectory, StagePath in Data[: Maximum]:
+        files = json.loads(files.replace("'", "\""))
+        WorkingDir = GetWorkingDirectory(WorkingDirectory)
+        if os.path.isdir(WorkingDir) == False:
+            os.makedirs(WorkingDir)
+        assert '/scratch2/groups/gsi/bis/EGA_Submissions' in WorkingDir
+        files = {i: SetEncryptionStatus(files[i], 'streaming') for i in files}
+        
+        # update status -> uploading and record the files being streamed
+        with DatabaseConnection(CredentialFile, DataBase) as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE {0} SET {0}.Status=\"uploading\", {0}.files=\"{1}\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, str(files), alias, Box))
+            conn.commit()
+        
+        JobCodes = StreamAliasFiles(alias, files, StagePath, WorkingDir, CredentialFile, DataBase, Table, Object, Box, KeyRing, Mem, MyScript, CheckJobs, Planner, **KeyWordParams)
+        if not (len(set(JobCodes)) == 1 and list(set(JobCodes))[0] == 0):
+            # record error message, reset status uploading --> encrypt
+            files = {i: SetEncryptionStatus(files[i], 'pending') for i in files}
+            with DatabaseConnection(CredentialFile, DataBase) as conn:
                 cur = conn.cursor()
-                cur.execute('UPDATE {0} SET {0}.Status=\"upload\", {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, alias, Box))
+                cur.execute('UPDATE {0} SET {0}.Status=\"encrypt\", {0}.files=\"{1}\", {0}.errorMessages=\"{2}\" WHERE {0}.alias=\"{3}\" AND {0}.egaBox=\"{4}\"'.format(Table, str(files), 'Could not launch streaming jobs', alias, Box))
                 conn.commit()
-                conn.close()
                     
                     
 # use this function to print a dictionary of directory
-def ListFilesStagingServer(CredentialFile, DataBase, Table, Box, Object, **KeyWordParams):
+def ListFilesStagingServer(CredentialFile, DataBase, Table, Box, Object, Alias=None, **KeyWordParams):
     '''
-    (str, str, str, str, str, dict) -> dict
+    (str, str, str, str, str, str | None, dict) -> dict
     Return a dictionary of directory: files on the EGA staging server under the 
-    given Box for alias in DataBase Table with uploading status
+    given Box for alias in DataBase Table with uploading status, or only for
+    the StagePath of Alias if given
     '''
         
     # parse credential file to get EGA username and password
@@ -2295,6 +5813,9 @@ def ListFilesStagingServer(CredentialFile, DataBase, Table, Box, Object, **KeyWo
         elif Object == 'runs':
             Cmd = 'SELECT {0}.alias, {0}.StagePath FROM {0} WHERE {0}.Status=\"uploading\" AND {0}.egaBox=\"{1}\"'.format(Table, Box)
         
+        if Alias is not None:
+            Cmd += ' AND {0}.alias=\"{1}\"'.format(Table, Alias)
+        
         try:
             cur.execute(Cmd)
             Data = cur.fetchall()
@@ -2304,15 +5825,173 @@ def ListFilesStagingServer(CredentialFile, DataBase, Table, Box, Object, **KeyWo
         
         # check that some aliases have the proper status
         if len(Data) != 0:
-            # make a list of stagepath
-            StagePaths = list(set([i[1] for i in Data]))
-            for i in StagePaths:
-                uploaded_files = subprocess.check_output("ssh xfer4.res.oicr.on.ca 'lftp -u {0},{1} -e \"set ftp:ssl-allow false; ls {2}; bye;\" ftp://ftp-private.ebi.ac.uk'".format(UserName, MyPassword, i), shell=True).decode('utf-8').rstrip().split('\n')
-                # get the file paths
-                for j in range(len(uploaded_files)):
-                    uploaded_files[j] = uploaded_files[j].split()[-1]
-                # populate dict
-                FilesBox[i] = uploaded_files
+            # list each stagepath once
+            FilesBox = ListStagePaths(CredentialFile, Box, set([i[1] for i in Data]))
+    return FilesBox
+
+
+# use this class to share the listings of the staging server between processes
+class StagingListingCache(SqliteStore):
+    '''
+    SQLite cache of the listings of the directories of the staging servers
+    {(box, stagepath): files} kept for TTL seconds. A lock file per directory
+    lets a single process list a directory while concurrent processes wait
+    and take its listing. Expired listings and unused lock files are pruned
+    '''
+    
+    FileName, Variable, Description = 'listings.sqlite', 'GAEA_STAGING_CACHE', 'staging listing cache'
+    Schema = ['CREATE TABLE IF NOT EXISTS listings (box TEXT, stagepath TEXT, files TEXT, listed REAL, PRIMARY KEY (box, stagepath))']
+    
+    def __init__(self, CacheFile=None, TTL=None):
+        '''
+        (str | None, int | None) -> None
+        Set up the cache in CacheFile, GAEA_STAGING_CACHE or listings.sqlite in
+        the state directory, with listings kept for TTL seconds, GAEA_STAGING_CACHE_TTL
+        or 120 seconds
+        '''
+        
+        if TTL is None:
+            TTL = int(os.environ.get('GAEA_STAGING_CACHE_TTL', 120))
+        self.TTL = TTL
+        SqliteStore.__init__(self, CacheFile)
+        self.LockDir = self.StoreFile + '.locks'
+        os.makedirs(self.LockDir, exist_ok=True)
+    
+    def Read(self, Box, StagePath):
+        '''
+        (StagingListingCache, str, str) -> tuple | None
+        Return a tuple with the time StagePath of Box was listed and its files
+        if the listing is younger than TTL, or None
+        '''
+        
+        with self.Reading() as conn:
+            row = conn.execute('SELECT listed, files FROM listings WHERE box = ? AND stagepath = ?', (Box, StagePath)).fetchone()
+        if row is None or time.time() - row[0] > self.TTL:
+            return None
+        return row[0], json.loads(row[1])
+    
+    def Get(self, Box, StagePath, List, Names=None):
+        '''
+        (StagingListingCache, str, str, function, list | None) -> list
+        Return the files of StagePath on the staging server of Box from a recent
+        listing, or call List to list StagePath and share the result. A recent
+        listing missing any of the file Names is only used if it started after
+        this call, otherwise StagePath is listed again
+        '''
+        
+        Start = time.time()
+        Entry = self.Read(Box, StagePath)
+        if Entry is not None and (Names is None or set(Names).issubset(Entry[1])):
+            return Entry[1]
+        LockFile = os.path.join(self.LockDir, hashlib.md5('{0}\t{1}'.format(Box, StagePath).encode('utf-8')).hexdigest() + '.lock')
+        while True:
+            with open(LockFile, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # lock files pruned while waiting don't lock the directory anymore
+                    try:
+                        if not os.path.samestat(os.fstat(lock.fileno()), os.stat(LockFile)):
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    # keep the lock file while it is used
+                    os.utime(LockFile)
+                    # another process may have listed the directory while waiting
+                    Latest = self.Read(Box, StagePath)
+                    if Latest is not None and (Names is None or Latest[0] >= Start or set(Names).issubset(Latest[1])):
+                        return Latest[1]
+                    Listed = time.time()
+                    Files = List()
+                    with self.Writing() as conn:
+                        conn.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)', (Box, StagePath, json.dumps(Files), Listed))
+                    return Files
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+    
+    def Prune(self):
+        '''
+        (StagingListingCache) -> int
+        Remove the listings older than TTL and the lock files not used in the
+        last TTL seconds and not held by another process. Return the number
+        of listings removed
+        '''
+        
+        Expired = time.time() - self.TTL
+        with self.Writing() as conn:
+            Count = conn.execute('DELETE FROM listings WHERE listed < ?', (Expired,)).rowcount
+        for i in os.listdir(self.LockDir):
+            LockFile = os.path.join(self.LockDir, i)
+            try:
+                if os.path.getmtime(LockFile) >= Expired:
+                    continue
+                with open(LockFile, 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(LockFile)
+            except OSError:
+                # held by another process or already removed
+                continue
+        return Count
+
+
+# use this function to list the files of a directory on the staging server
+def ListStagePath(UserName, MyPassword, StagePath):
+    '''
+    (str, str, str) -> list
+    Return the names of the files and directories in StagePath on the staging
+    server, logging in as UserName through xfer4
+    '''
+    
+    uploaded_files = subprocess.check_output("ssh xfer4.res.oicr.on.ca 'lftp -u {0},{1} -e \"set ftp:ssl-allow false; ls {2}; bye;\" ftp://ftp-private.ebi.ac.uk'".format(UserName, MyPassword, StagePath), shell=True).decode('utf-8').rstrip().split('\n')
+    # get the file paths
+    return [j.split()[-1] for j in uploaded_files if j.strip() != '']
+
+
+# use this function to list the files of directories on the staging server
+def ListStagePaths(CredentialFile, Box, StagePaths, Expected=None):
+    '''
+    (str, str, list, dict | None) -> dict
+    Return a dictionary of directory: files on the EGA staging server of Box
+    for each directory in StagePaths, listing each directory once.
+    Expected {directory: (time, [file names])} lists the files expected in
+    directories uploaded since time. These directories are taken from the
+    staging snapshot if they were listed after time and have all expected files.
+    Other directories are listed once per TTL window across processes with
+    the listing cache, listing again recent listings missing expected files
+    '''
+    
+    # parse credential file to get EGA username and password
+    UserName, MyPassword = ParseCredentials(CredentialFile, Box)
+    
+    # missing files may have been uploaded after the snapshot, only files found are trusted
+    Snapshot = StagingSnapshot.Open() if Expected else None
+    
+    # share listings with concurrent checks
+    Cache = StagingListingCache.Open()
+    
+    FilesBox = {}
+    for i in sorted(set(StagePaths)):
+        if Snapshot is not None and i in Expected and Expected[i][0] is not None:
+            try:
+                Listed = Snapshot.List(Box, i)
+            except sqlite3.Error:
+                Listed = None
+            if Listed is not None and Listed[0] >= Expected[i][0] and len(Listed[1]) != 0 and set(Expected[i][1]).issubset(Listed[1]):
+                FilesBox[i] = Listed[1]
+                continue
+        if Cache is None:
+            FilesBox[i] = ListStagePath(UserName, MyPassword, i)
+        else:
+            Names = Expected[i][1] if Expected and i in Expected else None
+            try:
+                FilesBox[i] = Cache.Get(Box, i, lambda: ListStagePath(UserName, MyPassword, i), Names)
+            except sqlite3.Error:
+                FilesBox[i] = ListStagePath(UserName, MyPassword, i)
+    # drop expired listings and unused lock files
+    if Cache is not None:
+        try:
+            Cache.Prune()
+        except (sqlite3.Error, OSError) as e:
+            print('Could not prune the staging listing cache: {0}'.format(e), file=sys.stderr)
     return FilesBox
 
 
@@ -2453,19 +6132,17 @@ def IsUploadSuccessfull(LogFile):
         return False
 
 # use this function to check the success of the upload
-def CheckUploadSuccess(LogDir, alias, FileName):
+def CheckUploadSuccess(LogDir, alias, FileName, LogFiles=None):
     '''
-    (str, str, str) --> bool
+    (str, str, str, list | None) --> bool
     Take the directory where logs of the upload script are saved, an alias and 
     the file name and retrieve the most recent out log and return True if all
-    files are uploaded (ie no error) or False if errors are found
+    files are uploaded (ie no error) or False if errors are found.
+    LogFiles is the list of out logs returned by ListUploadLogs for LogDir
     '''
 
     # sort the out log files from the most recent to the older ones
-    logfiles = subprocess.check_output('ls -lt {0}'.format(os.path.join(LogDir, 'Upload.*.o*')), shell=True).decode('utf-8').rstrip().split('\n')
-    # keep the log out file names
-    for i in range(len(logfiles)):
-        logfiles[i] = logfiles[i].strip().split()[-1]
+    logfiles = ListUploadLogs(LogDir) if LogFiles is None else LogFiles
     
     # set up a boolean to update if most recent out log is found for FileName
     Found = False
@@ -2493,6 +6170,81 @@ def CheckUploadSuccess(LogDir, alias, FileName):
         return False
     
     
+# use this function to list the out logs of the upload jobs
+def ListUploadLogs(LogDir):
+    '''
+    (str) -> list
+    Return the paths of the out logs of upload jobs in LogDir sorted from the most recent to the older ones
+    '''
+    
+    logfiles = glob.glob(os.path.join(LogDir, 'Upload.*.o*'))
+    Times = {}
+    for i in logfiles:
+        try:
+            Times[i] = os.path.getmtime(i)
+        except OSError:
+            continue
+    return sorted(Times, key=lambda i: Times[i], reverse=True)
+
+
+# use this function to list the names of the files of an alias on the staging server
+def ListStagedNames(files):
+    '''
+    (dict) -> list
+    Return the names of the encrypted and md5 files of the files dictionary of an alias
+    '''
+    
+    Names = []
+    for filePath in files:
+        encryptedFile = files[filePath].get('encryptedName', files[filePath].get('fileName', os.path.basename(filePath)) + '.gpg')
+        Names.extend([encryptedFile, encryptedFile + '.md5', encryptedFile[:-4] + '.md5'])
+    return Names
+
+
+# use this function to collect the files expected in stagepaths since jobs were submitted
+def ExpectStagedFiles(Expected, StagePath, JobNames, files):
+    '''
+    (dict, str, list, dict) -> None
+    Add the files of an alias uploaded to StagePath by JobNames to the dictionary
+    Expected {stagepath: (time, [file names])} passed to ListStagePaths, keeping
+    the latest submission of the jobs uploading to each stagepath
+    '''
+    
+    Submitted = [ReadJobSubmission(i) for i in JobNames]
+    Time = None if None in Submitted or len(Submitted) == 0 else max(Submitted)
+    if StagePath in Expected:
+        Previous, Names = Expected[StagePath]
+        Time = None if Time is None or Previous is None else max(Time, Previous)
+    else:
+        Names = []
+    Expected[StagePath] = (Time, Names + ListStagedNames(files))
+
+
+# use this function to check the logs and staging server listing of the files of an alias
+def VerifyUploadedFiles(alias, files, LogDir, StagedFiles, LogFiles=None):
+    '''
+    (str, dict, str, list, list | None) -> bool
+    Take the files dictionary of alias, the directory with the upload logs,
+    the list of files in the StagePath of the alias on the staging server and
+    return True if logs have no error and all encrypted and md5 files are staged
+    '''
+    
+    if LogFiles is None:
+        LogFiles = ListUploadLogs(LogDir)
+    Uploaded = True
+    for filePath in files:
+        # check if errors are found in log
+        if CheckUploadSuccess(LogDir, alias, os.path.basename(filePath), LogFiles) == False:
+            Uploaded = False
+        # check if files are uploaded on the server
+        encryptedFile = files[filePath]['encryptedName']
+        originalMd5, encryptedMd5 = encryptedFile[:-4] + '.md5', encryptedFile + '.md5'
+        for j in [encryptedFile, encryptedMd5, originalMd5]:
+            if j not in StagedFiles:
+                Uploaded = False
+    return Uploaded
+
+
 # use this function to check that files were successfully uploaded for a given alias and update status uploading -> uploaded
 def CheckUploadFiles(CredentialFile, DataBase, Table, Box, Object, Alias, JobNames, **KeyWordParams):
     '''
@@ -2503,12 +6255,6 @@ def CheckUploadFiles(CredentialFile, DataBase, Table, Box, Object, Alias, JobNam
     that alias were successfuly uploaded.  
     '''
 
-    # parse credential file to get EGA username and password
-    UserName, MyPassword = ParseCredentials(CredentialFile, Box)
-        
-    # make a dict {directory: [files]} for alias with uploading status 
-    FilesBox = ListFilesStagingServer(CredentialFile, DataBase, Table, Box, Object, **KeyWordParams)
-        
     # connect to database
     conn = EstablishConnection(CredentialFile, DataBase)
     cur = conn.cursor()
@@ -2538,66 +6284,238 @@ def CheckUploadFiles(CredentialFile, DataBase, Table, Box, Object, Alias, JobNam
             files = json.loads(i[1].replace("'", "\""))
             WorkingDirectory = GetWorkingDirectory(i[2])
             StagePath = i[3]
-            # set up boolean to be updated if uploading is not complete
-            Uploaded = True
+            # make a dict {directory: [files]} for the stagepath of the alias
+            Expected = {}
+            ExpectStagedFiles(Expected, StagePath, JobNames.split(';'), files)
+            FilesBox = ListStagePaths(CredentialFile, Box, [StagePath], Expected)
             
-            # get the log directory
-            LogDir = os.path.join(WorkingDirectory, 'qsubs/log')
-            # check the out logs for each file
-            for filePath in files:
-                # get filename
-                filename = os.path.basename(filePath)
-                # check if errors are found in log
-                if CheckUploadSuccess(LogDir, alias, filename) == False:
-                    Uploaded = False
+            # check the out logs and files uploaded on the server
+            Uploaded = VerifyUploadedFiles(alias, files, os.path.join(WorkingDirectory, 'qsubs/log'), FilesBox[StagePath])
             
             # check the exit status of the jobs uploading files
+            ExitCodes = GetJobExitStatuses(JobNames.split(';'))
             for jobName in JobNames.split(';'):
-                if GetJobExitStatus(jobName) != '0':
+                if ExitCodes[jobName] != '0':
                     Uploaded = False
             
-            # check if files are uploaded on the server
-            for filePath in files:
-                # get filename
-                fileName = os.path.basename(filePath)
-                #assert fileName + '.gpg' == files[filePath]['encryptedName']
-                encryptedFile = files[filePath]['encryptedName']
-                
-                #originalMd5, encryptedMd5 = fileName + '.md5', fileName + '.gpg.md5'                    
-                
-                originalMd5, encryptedMd5 = encryptedFile[:-4] + '.md5', encryptedFile + '.md5'                    
-                
-                
-                
-                for j in [encryptedFile, encryptedMd5, originalMd5]:
-                    if j not in FilesBox[StagePath]:
-                        Uploaded = False
             # check if all files for that alias have been uploaded
             if Uploaded == True:
-                # connect to database, update status and close connection
-                conn = EstablishConnection(CredentialFile, DataBase)
-                cur = conn.cursor()
-                cur.execute('UPDATE {0} SET {0}.Status=\"uploaded\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{1}\" AND {0}.egaBox=\"{2}\"'.format(Table, alias, Box)) 
-                conn.commit()                                
-                conn.close()              
+                # connect to database, update status and release connection
+                with DatabaseConnection(CredentialFile, DataBase) as conn:
+                    cur = conn.cursor()
+                    cur.execute('UPDATE {0} SET {0}.Status=\"uploaded\", {0}.errorMessages=\"None\" WHERE {0}.alias=\"{1}\" AND {0}.egaBox=\"{2}\"'.format(Table, alias, Box)) 
+                    conn.commit()
             elif Uploaded == False:
                 # reset status uploading --> upload, record error message
                 Error = 'Upload failed'
-                conn = EstablishConnection(CredentialFile, DataBase)
-                cur = conn.cursor()
-                cur.execute('UPDATE {0} SET {0}.Status=\"upload\", {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, alias, Box)) 
-                conn.commit()                                
-                conn.close()
+                with DatabaseConnection(CredentialFile, DataBase) as conn:
+                    cur = conn.cursor()
+                    cur.execute('UPDATE {0} SET {0}.Status=\"upload\", {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, alias, Box)) 
+                    conn.commit()
     else:
         # reset status uploading --> upload, record error message
         Error = 'Could not check uploaded files'
-        conn = EstablishConnection(CredentialFile, DataBase)
+        with DatabaseConnection(CredentialFile, DataBase) as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE {0} SET {0}.Status=\"upload\", {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, Alias, Box)) 
+            conn.commit()
+
+
+# use this function to find the aliases whose jobs are all finished
+def SortAliasesByJobs(AliasJobs, CheckStage=None, Sidecars=None, Held=False):
+    '''
+    (dict, str | None, dict | None, bool) -> tuple
+    Take a dictionary {alias: [job names]} of aliases in flight according to
+    the database and return a tuple with a dictionary {alias: {job name: exit code}}
+    of the aliases whose jobs all finished since submission and the list of
+    aliases with jobs not finished. Aliases without jobs are finished.
+    Aliases whose jobs were launched before submissions were recorded are
+    finished when none of their jobs is queued or running. With CheckStage
+    (CheckEncryption or CheckUpload), aliases with a checking job queued or
+    running are left to it and are in neither. With Held, all jobs are known
+    to be finished, as when checked by a job held on them, and jobs without
+    exit code failed. Sidecars {job name: [files]} lists files written by
+    successful jobs, these jobs are done with exit code 0 when all files were
+    written after submission
+    '''
+    
+    if Sidecars is None:
+        Sidecars = {}
+    # queued and running jobs are only listed if needed
+    Active = []
+    def IsActive(JobName):
+        if len(Active) == 0:
+            try:
+                Active.append(GetScheduler().ActiveJobs())
+            except (OSError, subprocess.CalledProcessError):
+                # assume that all jobs are still running
+                return True
+        return JobName in Active[0]
+    
+    Aliases, ExitCodes, Pending, Legacy = [], {}, [], []
+    for alias in AliasJobs:
+        JobNames = AliasJobs[alias]
+        Submitted = [ReadJobSubmission(i) for i in JobNames]
+        if CheckStage is not None and not Held:
+            Checked = ReadJobSubmission('{0}.{1}'.format(CheckStage, alias))
+            # jobs launched before submissions were recorded may be checked by a job without record
+            if (None in Submitted or (Checked is not None and len(Submitted) != 0 and Checked >= max(Submitted))) and IsActive('{0}.{1}'.format(CheckStage, alias)):
+                continue
+        if None in Submitted and not Held:
+            if any([IsActive(i) for i in JobNames]):
+                Aliases.append(alias)
+                continue
+            Legacy.extend(JobNames)
+        Aliases.append(alias)
+        for i in range(len(JobNames)):
+            Files = Sidecars.get(JobNames[i], [])
+            if Submitted[i] is not None and len(Files) != 0 and all([os.path.isfile(j) and os.path.getmtime(j) >= Submitted[i] for j in Files]):
+                ExitCodes[JobNames[i]] = '0'
+            elif Submitted[i] is not None:
+                Pending.append(JobNames[i])
+            elif Held:
+                Legacy.append(JobNames[i])
+    
+    # check the jobs of all aliases at once
+    ExitCodes.update(GetFinishedJobs(Pending))
+    # jobs without records are done, take their last exit codes
+    if len(Legacy) != 0:
+        ExitCodes.update(GetJobExitStatuses(sorted(set(Legacy))))
+    if Held:
+        ExitCodes.update({i: '1' for i in Pending if i not in ExitCodes})
+    
+    Finished, Waiting = {}, []
+    for alias in Aliases:
+        if all([i in ExitCodes for i in AliasJobs[alias]]):
+            Finished[alias] = {i: ExitCodes[i] for i in AliasJobs[alias]}
+        else:
+            Waiting.append(alias)
+    return Finished, Waiting
+
+
+# use this function to check the encryption of all encrypting aliases of a box
+def CheckBoxEncryption(CredentialFile, DataBase, Table, Box, Object, Aliases=None, Held=False):
+    '''
+    (str, str, str, str, str, list | None, bool) -> list
+    Take the file with db credentials, the Table and Box of Object (analyses or runs),
+    check the encryption of encrypting aliases (or of the encrypting aliases
+    in Aliases) whose jobs are all done, update their status to upload or
+    encrypt in a single transaction and return the list of the working
+    directories of aliases with jobs not finished. Aliases with a CheckEncryption
+    job queued or running are left to it unless Aliases are given. With Held,
+    the jobs of Aliases are finished and jobs without exit code failed
+    '''
+    
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
         cur = conn.cursor()
-        cur.execute('UPDATE {0} SET {0}.Status=\"upload\", {0}.errorMessages=\"{1}\" WHERE {0}.alias=\"{2}\" AND {0}.egaBox=\"{3}\"'.format(Table, Error, Alias, Box)) 
-        conn.commit()                                
-        conn.close()
+        cur.execute('SELECT {0}.alias, {0}.files, {0}.WorkingDirectory FROM {0} WHERE {0}.Status=\"encrypting\" AND {0}.egaBox=\"{1}\"'.format(Table, Box))
+        Data = cur.fetchall()
+    
+    # collect the files and jobs of each alias
+    Files, WorkingDirs, AliasJobs, Sidecars = {}, {}, {}, {}
+    for alias, files, WorkingDirectory in Data:
+        if Aliases is not None and alias not in Aliases:
+            continue
+        Files[alias] = json.loads(files.replace("'", "\""))
+        WorkingDirs[alias] = GetWorkingDirectory(WorkingDirectory)
+        AliasJobs[alias] = []
+        for file in Files[alias]:
+            # files encrypted by a previous run have no job
+            if Files[alias][file].get('encryptionStatus') == 'done':
+                continue
+            fileName = Files[alias][file]['fileName']
+            JobName = 'Encrypt.{0}'.format(alias + '__' + fileName)
+            AliasJobs[alias].append(JobName)
+            # md5sums are written once the file is encrypted
+            Sidecars[JobName] = [os.path.join(WorkingDirs[alias], fileName + i) for i in ['.md5', '.gpg.md5']]
+    Finished, Waiting = SortAliasesByJobs(AliasJobs, 'CheckEncryption' if Aliases is None else None, Sidecars, Held)
+    
+    # get the md5sums of the original files of all aliases at once
+    Checksums = LookupChecksums([j for i in Finished for j in Files[i]])
+    Transitions = StatusTransitions(CredentialFile, DataBase, Table, Box)
+    for alias in Finished:
+        Encrypted, files = VerifyEncryptedFiles(Files[alias], WorkingDirs[alias], Object, Checksums)
+        # record the status of each file so that only failed files are encrypted again
+        Encrypted, Tracked = TrackEncryptedFiles(alias, Files[alias], files, Finished[alias])
+        if Encrypted:
+            Transitions.Add(alias, files=str(files), errorMessages='None', Status='upload')
+        else:
+            Transitions.Add(alias, files=str(Tracked), errorMessages='Encryption or md5sum did not complete', Status='encrypt')
+    Transitions.Flush()
+    return [WorkingDirs[i] for i in Waiting]
+
+
+# use this function to check the upload of all uploading aliases of a box
+def CheckBoxUpload(CredentialFile, DataBase, Table, Box, Object, Aliases=None, Held=False, **KeyWordParams):
+    '''
+    (str, str, str, str, str, list | None, bool, dict) -> list
+    Take the file with db credentials, the Table and Box of Object (analyses or runs),
+    check the upload of uploading aliases (or of the uploading aliases in Aliases)
+    whose jobs are all done, listing each StagePath once, update their status
+    to uploaded or upload in a single transaction and return the list of the
+    working directories of aliases with jobs not finished. Aliases whose files
+    were streamed to the staging server also get their md5sums recorded, or
+    go back to encrypt if streaming failed. Aliases with a CheckUpload job
+    queued or running are left to it unless Aliases are given. With Held,
+    the jobs of Aliases are finished and jobs without exit code failed
+    '''
+    
+    if Object == 'analyses':
+        AttributesTable = KeyWordParams.get('attributes', 'empty')
+        Cmd = 'SELECT {0}.alias, {0}.files, {0}.WorkingDirectory, {1}.StagePath FROM {0} JOIN {1} WHERE {0}.AttributesKey = {1}.alias AND {0}.Status=\"uploading\" AND {0}.egaBox=\"{2}\"'.format(Table, AttributesTable, Box)
+    elif Object == 'runs':
+        Cmd = 'SELECT {0}.alias, {0}.files, {0}.WorkingDirectory, {0}.StagePath FROM {0} WHERE {0}.Status=\"uploading\" AND {0}.egaBox=\"{1}\"'.format(Table, Box)
+    with DatabaseConnection(CredentialFile, DataBase) as conn:
+        cur = conn.cursor()
+        cur.execute(Cmd)
+        Data = cur.fetchall()
+    
+    # collect the files, stagepath and jobs of each alias
+    Files, WorkingDirs, StagePaths, AliasJobs = {}, {}, {}, {}
+    for alias, files, WorkingDirectory, StagePath in Data:
+        if Aliases is not None and alias not in Aliases:
+            continue
+        Files[alias] = json.loads(files.replace("'", "\""))
+        WorkingDirs[alias] = GetWorkingDirectory(WorkingDirectory)
+        StagePaths[alias] = StagePath
+        AliasJobs[alias] = ['Upload.{0}'.format(alias + '__' + os.path.basename(i)) for i in Files[alias]]
+    Finished, Waiting = SortAliasesByJobs(AliasJobs, 'CheckUpload' if Aliases is None else None, None, Held)
+    
+    if len(Finished) != 0:
+        # list the stagepaths of all finished aliases at once
+        Expected = {}
+        for alias in Finished:
+            ExpectStagedFiles(Expected, StagePaths[alias], AliasJobs[alias], Files[alias])
+        FilesBox = ListStagePaths(CredentialFile, Box, [StagePaths[i] for i in Finished], Expected)
+        # list the logs of each working directory once
+        LogFiles = {}
+        # streamed files are encrypted by the upload jobs {alias: [files]}
+        Streamed = {i: [j for j in Files[i] if Files[i][j].get('encryptionStatus') == 'streaming'] for i in Finished}
+        Checksums = LookupChecksums([j for i in Streamed for j in Streamed[i]])
+        Transitions = StatusTransitions(CredentialFile, DataBase, Table, Box)
+        for alias in Finished:
+            LogDir = os.path.join(WorkingDirs[alias], 'qsubs/log')
+            if LogDir not in LogFiles:
+                LogFiles[LogDir] = ListUploadLogs(LogDir)
+            if len(Streamed[alias]) != 0:
+                Encrypted, files = VerifyEncryptedFiles(Files[alias], WorkingDirs[alias], Object, Checksums, Streamed=True)
+                Uploaded = Encrypted and VerifyUploadedFiles(alias, files, LogDir, FilesBox[StagePaths[alias]], LogFiles[LogDir])
+                if Uploaded and all([i == '0' for i in Finished[alias].values()]):
+                    Transitions.Add(alias, files=str(files), Status='uploaded', errorMessages='None')
+                else:
+                    # nothing is left on disk to upload again
+                    files = {i: SetEncryptionStatus(Files[alias][i], 'pending') for i in Files[alias]}
+                    Transitions.Add(alias, files=str(files), Status='encrypt', errorMessages='Streaming failed')
+                continue
+            Uploaded = VerifyUploadedFiles(alias, Files[alias], LogDir, FilesBox[StagePaths[alias]], LogFiles[LogDir])
+            if Uploaded and all([i == '0' for i in Finished[alias].values()]):
+                Transitions.Add(alias, Status='uploaded', errorMessages='None')
+            else:
+                Transitions.Add(alias, Status='upload', errorMessages='Upload failed')
+        Transitions.Flush()
+    return [WorkingDirs[i] for i in Waiting]
+
 
-        
 # use this function to format the error Messages prior saving into db table
 def CleanUpError(errorMessages):
     '''
@@ -2677,10 +6595,17 @@ def RemoveFilesAfterSubmission(CredentialFile, Database, Table, Box, Remove):
 # use this function to print a dict the enumerations from EGA to std output
 def GrabEgaEnums(args):
     '''
-    (str) -> dict
-    Take the URL for a given enumeration and return and dict of tag: value pairs
+    (list) -> None
+    Take a list of command line arguments and print a dict of tag: value pairs
+    for the enumeration at the given URL or refresh the enumeration cache
     '''
     
+    if args.refresh:
+        RefreshEnumerations(args.myscript, args.mypython, args.enumcache, Blocking=False, MaxAge=args.maxage)
+        return
+    if not args.url:
+        raise ValueError('--URL is required unless --refresh is used')
+    
     # create a dict to store the enumeration info {value: tag}
     Enum = {}
     # connect to the api, retrieve the information for the given enumeration
@@ -2716,11 +6641,37 @@ def IsEncryptionDone(args):
     '''
     (list) -> None
     Take a list of command line arguments and update status to upload if encryption
-    is done for a given alias or reset status to encrypt
+    is done for a given alias or reset status to encrypt. Without job names,
+    check all encrypting aliases of the box (or the given alias) whose jobs are done
     '''
     # check that encryption is done, store md5sums and path to encrypted file in db
     # update status encrypting -> upload
-    CheckEncryption(args.credential, args.subdb, args.table, args.box, args.alias, args.object, args.jobnames)
+    if args.alias is not None and args.jobnames is not None:
+        CheckEncryption(args.credential, args.subdb, args.table, args.box, args.alias, args.object, args.jobnames)
+    else:
+        CheckBoxEncryption(args.credential, args.subdb, args.table, args.box, args.object, None if args.alias is None else [args.alias], args.held and args.alias is not None)
+
+
+# use this function to encrypt a file and write the md5sums of the original and encrypted files
+def EncryptFile(args):
+    '''
+    (list) -> None
+    Take a list of command line arguments, encrypt a single file and write its
+    md5sums and exit with the encryption exit code
+    '''
+    
+    sys.exit(EncryptAndHashFile(args.input, args.output, args.keyring, Ledger=ChecksumLedger.Open()))
+
+
+# use this function to stream a file to the staging server
+def StreamFile(args):
+    '''
+    (list) -> None
+    Take a list of command line arguments, encrypt a single file straight to
+    the staging server, write its md5sums and exit with the exit code of the upload
+    '''
+    
+    sys.exit(EncryptAndStreamFile(args.input, args.output, args.keyring, args.credential, args.box, args.stagepath, Ledger=ChecksumLedger.Open()))
   
         
 # use this function to check upload    
@@ -2728,15 +6679,65 @@ def IsUploadDone(args):
     '''    
     (list) -> None
     Take a list of command line arguments and update status to uploaded if upload
-    is done for a given alias or reset status to upload
+    is done for a given alias or reset status to upload. Without job names,
+    check all uploading aliases of the box (or the given alias) whose jobs are done
     '''
     
-    if args.object == 'analyses':
-        # check that files have been successfully uploaded, update status uploading -> uploaded or rest status uploading -> upload
-        CheckUploadFiles(args.credential, args.subdb, args.table, args.box, args.object, args.alias, args.jobnames, attributes = args.attributes)
-    elif args.object == 'runs':
-        CheckUploadFiles(args.credential, args.subdb, args.table, args.box, args.object, args.alias, args.jobnames)
+    if args.alias is not None and args.jobnames is not None:
+        if args.object == 'analyses':
+            # check that files have been successfully uploaded, update status uploading -> uploaded or rest status uploading -> upload
+            CheckUploadFiles(args.credential, args.subdb, args.table, args.box, args.object, args.alias, args.jobnames, attributes = args.attributes)
+        elif args.object == 'runs':
+            CheckUploadFiles(args.credential, args.subdb, args.table, args.box, args.object, args.alias, args.jobnames)
+    else:
+        Aliases = None if args.alias is None else [args.alias]
+        Held = args.held and args.alias is not None
+        if args.object == 'analyses':
+            CheckBoxUpload(args.credential, args.subdb, args.table, args.box, args.object, Aliases, Held, attributes = args.attributes)
+        elif args.object == 'runs':
+            CheckBoxUpload(args.credential, args.subdb, args.table, args.box, args.object, Aliases, Held)
+    
+# use this function to check encryption and upload when jobs finish
+def WatchJobs(args):
+    '''
+    (list) -> None
+    Take a list of command line arguments and check the encryption and upload
+    of the aliases of analyses and runs of all boxes as soon as their jobs
+    notify the watcher, and every Interval seconds, until interrupted or after
+    a single round with --Once
+    '''
     
+    Listener = None
+    if not args.once:
+        try:
+            Listener = JobListener(args.port)
+        except OSError as e:
+            print('Could not listen for jobs, checking every {0} seconds: {1}'.format(args.interval, e), file=sys.stderr)
+    try:
+        while True:
+            for Box in sorted(set(args.boxes)):
+                for Table, Object in [(args.analysestable, 'analyses'), (args.runstable, 'runs')]:
+                    try:
+                        CheckBoxEncryption(args.credential, args.subdb, Table, Box, Object)
+                        if Object == 'analyses':
+                            CheckBoxUpload(args.credential, args.subdb, Table, Box, Object, attributes = args.attributes)
+                        else:
+                            CheckBoxUpload(args.credential, args.subdb, Table, Box, Object)
+                    except Exception as e:
+                        # keep watching the other tables and retry in the next round
+                        print('Could not check jobs of {0} in {1}: {2}'.format(Table, Box, e), file=sys.stderr)
+            if args.once:
+                break
+            # finished jobs wake up the watcher, the interval catches missed notifications
+            if Listener is None:
+                time.sleep(args.interval)
+            else:
+                Listener.Wait(args.interval)
+    finally:
+        if Listener is not None:
+            Listener.Close()
+
+
 # use this function to form json for a given object
 def CreateJson(args):
     '''
@@ -2745,6 +6746,10 @@ def CreateJson(args):
     The specific steps involved vary based on the Object
     '''
 
+    # streamed files are uploaded with lftp by the stream jobs
+    if args.stream and args.uploadmode != 'lftp':
+        raise ValueError('--Stream requires --UploadMode lftp')
+
     # check if Analyses table exists
     Tables = ListTables(args.credential, args.subdb)
         
@@ -2791,14 +6796,20 @@ def CreateJson(args):
                    
             ## encrypt new files only if diskspace is available. update status encrypt --> encrypting
             ## check that encryption is done, store md5sums and path to encrypted file in db, update status encrypting -> upload or reset encrypting -> encrypt
-            EncryptFiles(args.credential, args.subdb, args.table, args.object, args.box, args.keyring, args.memory, args.diskspace, args.myscript)
+            ## or encrypt new files straight to the staging server. update status encrypt --> uploading
+            if args.stream and args.object == 'analyses':
+                StreamObjectFiles(args.credential, args.subdb, args.table, args.object, args.footprint, args.box, args.keyring, args.memory, args.max, args.maxfootprint, args.myscript, args.checkjobs, dict(args.queues), attributes = args.attributes)
+            elif args.stream and args.object == 'runs':
+                StreamObjectFiles(args.credential, args.subdb, args.table, args.object, args.footprint, args.box, args.keyring, args.memory, args.max, args.maxfootprint, args.myscript, args.checkjobs, dict(args.queues))
+            else:
+                EncryptFiles(args.credential, args.subdb, args.table, args.object, args.box, args.keyring, args.memory, args.diskspace, args.myscript, args.encryptperalias, args.encryptmax, args.arrayjobs, args.checkjobs, dict(args.queues), args.packsize * 1024**2)
         
             ## upload files and change the status upload -> uploading 
             ## check that files have been successfully uploaded, update status uploading -> uploaded or rest status uploading -> upload
             if args.object == 'analyses':
-                UploadObjectFiles(args.credential, args.subdb, args.table, args.object, args.footprint, args.box, args.memory, args.uploadmode, args.max, args.maxfootprint, args.myscript, attributes = args.attributes)
+                UploadObjectFiles(args.credential, args.subdb, args.table, args.object, args.footprint, args.box, args.memory, args.uploadmode, args.max, args.maxfootprint, args.myscript, args.arrayjobs, args.checkjobs, dict(args.queues), args.packsize * 1024**2, attributes = args.attributes)
             elif args.object == 'runs':
-                UploadObjectFiles(args.credential, args.subdb, args.table, args.object, args.footprint, args.box, args.memory, args.uploadmode, args.max, args.maxfootprint, args.myscript)
+                UploadObjectFiles(args.credential, args.subdb, args.table, args.object, args.footprint, args.box, args.memory, args.uploadmode, args.max, args.maxfootprint, args.myscript, args.arrayjobs, args.checkjobs, dict(args.queues), args.packsize * 1024**2)
             
             ## remove files with uploaded status. does not change status. keep status uploaded --> uploaded
             RemoveFilesAfterSubmission(args.credential, args.subdb, args.table, args.box, args.remove)
@@ -2806,14 +6817,14 @@ def CreateJson(args):
         ## form json and add to table and update status --> submit or keep current status
         if args.object == 'analyses':
             ## form json for analyses in uploaded mode, add to table and update status uploaded -> submit
-            AddJsonToTable(args.credential, args.subdb, args.table, args.box, args.object, args.myscript, args.mypython, projects = args.projects, attributes = args.attributes)
+            AddJsonToTable(args.credential, args.subdb, args.table, args.box, args.object, args.myscript, args.mypython, args.workers, args.timeout, projects = args.projects, attributes = args.attributes)
         elif args.object == 'samples':
              # update status valid -> submit if no error of keep status --> valid and record errorMessage
-             AddJsonToTable(args.credential, args.subdb, args.table, args.box, args.object, args.myscript, args.mypython, attributes = args.attributes)
+             AddJsonToTable(args.credential, args.subdb, args.table, args.box, args.object, args.myscript, args.mypython, args.workers, args.timeout, attributes = args.attributes)
         else:
             ## form json for all other objects in valid status and add to table
             # update status valid -> submit if no error or leep status --> and record errorMessage
-            AddJsonToTable(args.credential, args.subdb, args.table, args.box, args.object, args.myscript, args.mypython)
+            AddJsonToTable(args.credential, args.subdb, args.table, args.box, args.object, args.myscript, args.mypython, args.workers, args.timeout)
 
 
 # use this function to submit object metadata 
@@ -2892,6 +6903,7 @@ def AddMissingWorkingDir(CredentialFile, DataBase, Table, Alias, Box):
             # create working directories
             WorkingDir = GetWorkingDirectory(UID, WorkingDir = '/scratch2/groups/gsi/bis/EGA_Submissions')
             os.makedirs(WorkingDir)
+    conn.close()
     
   
 # use this function to edit status to ReEncrypt
@@ -3055,27 +7067,47 @@ def ReUploadRegisteredFiles(args):
         # change status submit --> SUBMITTED when re-upload of files for runs objects is done
         UpdateSubmittedStatus(args.credential, args.subdb, args.runstable, args.box)
 
+# use this function to migrate the schema of the metadata and submission databases
+def MigrateSchema(args):
+    '''
+    (list) -> None
+    Take a list of command line arguments and index the filter columns of
+    the tables in the metadata and submission databases
+    '''
+    
+    for DataBase in [args.metadatadb, args.subdb]:
+        MigrateDataBase(args.credential, DataBase, args.box, args.dryrun)
+
+
 # use this function to list files on the staging servers
 def FileInfoStagingServer(args):
     '''
     (list) -> None
     Take a list of command line arguments and populate tables with file info
-    including size and accessions Ids of files on the staging servers for given box
+    including size and accessions Ids of files on the staging servers for given boxes
     '''
 
-    # add info for all files on staging server for given box
-    AddFileInfoStagingServer(args.credential, args.metadatadb, args.subdb, args.analysestable, args.runstable, args.stagingtable, args.box)
-    # summarize data into footprint table
-    AddFootprintData(args.credential, args.subdb, args.stagingtable, args.footprinttable, args.box)
+    # crawl the staging servers of all boxes at once
+    Boxes = []
+    for i in args.boxes:
+        if i not in Boxes:
+            Boxes.append(i)
+    # add info for all files on staging server for given boxes and summarize data into footprint table
+    Deltas = AddFileInfoStagingServers(args.credential, args.metadatadb, args.subdb, args.analysestable, args.runstable, args.stagingtable, args.footprinttable, Boxes, args.maxconnections, args.maxperbox)
+    # report the files changed since the previous crawl
+    if args.diff:
+        PrintStagingDiff(Deltas)
     
 
 if __name__ == '__main__':
 
-    # create top-level parser
-    parent_parser = argparse.ArgumentParser(prog = 'Gaea.py', description='manages submission to EGA', add_help=False)
-    parent_parser.add_argument('-c', '--Credentials', dest='credential', help='file with database credentials', required=True)
-    parent_parser.add_argument('-m', '--MetadataDb', dest='metadatadb', default='EGA', help='Name of the database collection EGA metadata. Default is EGA')
-    parent_parser.add_argument('-s', '--SubDb', dest='subdb', default='EGASUB', help='Name of the database used to object information for submission to EGA. Default is EGASUB')
+    # create top-level parsers. commands working on several boxes take their own list of boxes
+    common_parser = argparse.ArgumentParser(prog = 'Gaea.py', description='manages submission to EGA', add_help=False)
+    common_parser.add_argument('-c', '--Credentials', dest='credential', help='file with database credentials', required=True)
+    common_parser.add_argument('-m', '--MetadataDb', dest='metadatadb', default='EGA', help='Name of the database collection EGA metadata. Default is EGA')
+    common_parser.add_argument('-s', '--SubDb', dest='subdb', default='EGASUB', help='Name of the database used to object information for submission to EGA. Default is EGASUB')
+    common_parser.add_argument('--Scheduler', dest='scheduler', default=os.environ.get('GAEA_SCHEDULER', 'sge'), choices=sorted(Schedulers.keys()), help='Scheduler launching the encryption and upload jobs. Default is GAEA_SCHEDULER or sge')
+    parent_parser = argparse.ArgumentParser(prog = 'Gaea.py', description='manages submission to EGA', add_help=False, parents = [common_parser])
     parent_parser.add_argument('-b', '--Box', dest='box', choices=['ega-box-12', 'ega-box-137', 'ega-box-1269'], help='Box where objects will be registered', required=True)
     
     # create main parser
@@ -3097,7 +7129,12 @@ if __name__ == '__main__':
                                                                  'https://ega-archive.org/submission-api/v1/enums/library_strategies',
                                                                  'https://ega-archive.org/submission-api/v1/enums/reference_chromosomes',
                                                                  'https://ega-archive.org/submission-api/v1/enums/reference_genomes',
-                                                                 'https://ega-archive.org/submission-api/v1/enums/study_types'], help='URL with enumerations', required=True)
+                                                                 'https://ega-archive.org/submission-api/v1/enums/study_types'], help='URL with enumerations')
+    CollectEnumParser.add_argument('--refresh', dest='refresh', action='store_true', help='Fetch all enumerations and update the enumeration cache')
+    CollectEnumParser.add_argument('--MyScript', dest='myscript', default= '/.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/Submission_Tools/Gaea.py', help='Path the EGA submission script. Default is /.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/Submission_Tools/Gaea.py')
+    CollectEnumParser.add_argument('--MyPython', dest='mypython', default='/.mounts/labs/PDE/Modules/sw/python/Python-3.6.4/bin/python3.6', help='Path the python version. Default is /.mounts/labs/PDE/Modules/sw/python/Python-3.6.4/bin/python3.6')
+    CollectEnumParser.add_argument('--EnumCache', dest='enumcache', help='File caching the EGA enumerations. Default is .ega_enumerations.json in the state directory')
+    CollectEnumParser.add_argument('--MaxAge', dest='maxage', type=int, help='Skip the refresh if the cache is younger than MaxAge seconds. Always refresh by default')
     CollectEnumParser.set_defaults(func=GrabEgaEnums)
 
     # form analyses to EGA       
@@ -3113,28 +7150,65 @@ if __name__ == '__main__':
     FormJsonParser.add_argument('--MyScript', dest='myscript', default= '/.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/Submission_Tools/Gaea.py', help='Path the EGA submission script. Default is /.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/Submission_Tools/Gaea.py')
     FormJsonParser.add_argument('--MyPython', dest='mypython', default='/.mounts/labs/PDE/Modules/sw/python/Python-3.6.4/bin/python3.6', help='Path the python version. Default is /.mounts/labs/PDE/Modules/sw/python/Python-3.6.4/bin/python3.6')
     FormJsonParser.add_argument('--Mem', dest='memory', default='10', help='Memory allocated to encrypting files. Default is 10G')
+    FormJsonParser.add_argument('--EncryptPerAlias', dest='encryptperalias', default=1, type=int, help='Maximum number of files of an alias encrypted at once. All files if 0. Default is 1')
+    FormJsonParser.add_argument('--EncryptMax', dest='encryptmax', default=0, type=int, help='Maximum number of files encrypted at once across aliases. No limit by default')
+    FormJsonParser.add_argument('--ArrayJobs', dest='arrayjobs', action='store_true', help='Submit the encryption and upload jobs of all aliases as one array job per step. Submit one job per file by default')
+    FormJsonParser.add_argument('--Queues', dest='queues', nargs='*', default=[], type=ParseQueue, help='Queues given as name=hours with their wallclock limit (0 for no limit). Jobs are sent to the queue with the shortest limit fitting their planned wallclock. Default queue and no wallclock limit by default')
+    FormJsonParser.add_argument('--PackSize', dest='packsize', default=0, type=int, help='Encrypt and upload files smaller than PackSize Mb one after the other in single jobs of at most PackSize Mb. One job per file by default')
+    FormJsonParser.add_argument('--Stream', dest='stream', action='store_true', help='Encrypt files straight to the staging server with lftp without writing encrypted files to scratch. Requires --UploadMode lftp. Encrypt to scratch and upload by default')
+    FormJsonParser.add_argument('--CheckJobs', dest='checkjobs', action='store_true', help='Launch jobs checking encryption and upload once the jobs of each alias are done. Checks are left to the Watch daemon by default')
     FormJsonParser.add_argument('--Max', dest='max', default=8, type=int, help='Maximum number of files to be uploaded at once. Default is 8')
     FormJsonParser.add_argument('--MaxFootPrint', dest='maxfootprint', default=15, type=int, help='Maximum footprint of non-registered files on the box\'s staging sever. Default is 15Tb')
     FormJsonParser.add_argument('--Remove', dest='remove', action='store_true', help='Delete encrypted and md5 files when analyses are successfully submitted. Do not delete by default')
+    FormJsonParser.add_argument('--Workers', dest='workers', default=1, type=int, help='Number of processes forming jsons. Default is 1')
+    FormJsonParser.add_argument('--Timeout', dest='timeout', default=0, type=int, help='Maximum time (in seconds) to form the json of an alias. No limit by default')
     FormJsonParser.set_defaults(func=CreateJson)
 
     # check encryption
-    CheckEncryptionParser = subparsers.add_parser('CheckEncryption', help='Check that encryption is done for a given alias', parents = [parent_parser])
+    CheckEncryptionParser = subparsers.add_parser('CheckEncryption', help='Check that encryption is done for a given alias or for all aliases of a box', parents = [parent_parser])
     CheckEncryptionParser.add_argument('-t', '--Table', dest='table', default='Analyses', help='Database table. Default is Analyses')
-    CheckEncryptionParser.add_argument('-a', '--Alias', dest='alias', help='Object alias', required=True)
+    CheckEncryptionParser.add_argument('-a', '--Alias', dest='alias', help='Object alias. All encrypting aliases of the box with finished jobs by default')
     CheckEncryptionParser.add_argument('-o', '--Object', dest='object', choices=['analyses', 'runs'], help='Object files to encrypt', required=True)
-    CheckEncryptionParser.add_argument('-j', '--Jobs', dest='jobnames', help='Colon-separated string of job names used for encryption and md5sums of all files under a given alias', required=True)
+    CheckEncryptionParser.add_argument('-j', '--Jobs', dest='jobnames', help='Colon-separated string of job names used for encryption and md5sums of all files under a given alias. Derived from the files of the alias by default')
+    CheckEncryptionParser.add_argument('--Held', dest='held', action='store_true', help='The jobs of the alias are done, as when checked by a job held on them. Jobs without exit code failed')
     CheckEncryptionParser.set_defaults(func=IsEncryptionDone)
     
+    # encrypt a single file and compute md5sums
+    EncryptFileParser = subparsers.add_parser('EncryptFile', help='Encrypt a file and write the md5sums of the original and encrypted files')
+    EncryptFileParser.add_argument('-i', '--Input', dest='input', help='Path to the file to encrypt', required=True)
+    EncryptFileParser.add_argument('-o', '--Output', dest='output', help='Path to the encrypted file without the .gpg extension. md5sums are written to Output.md5 and Output.gpg.md5', required=True)
+    EncryptFileParser.add_argument('-k', '--Keyring', dest='keyring', default='/.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/publickeys/public_keys.gpg', help='Path to the keys used for encryption. Default is /.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/publickeys/public_keys.gpg')
+    EncryptFileParser.set_defaults(func=EncryptFile)
+    
+    # stream a file to the staging server
+    StreamFileParser = subparsers.add_parser('StreamFile', help='Encrypt a file straight to the staging server and write the md5sums of the original and encrypted files', parents = [parent_parser])
+    StreamFileParser.add_argument('-i', '--Input', dest='input', help='Path to the file to encrypt', required=True)
+    StreamFileParser.add_argument('-o', '--Output', dest='output', help='Path to the encrypted file without the .gpg extension. md5sums are written to Output.md5 and Output.gpg.md5, the encrypted file is not written', required=True)
+    StreamFileParser.add_argument('-k', '--Keyring', dest='keyring', default='/.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/publickeys/public_keys.gpg', help='Path to the keys used for encryption. Default is /.mounts/labs/gsiprojects/gsi/Data_Transfer/Release/EGA/publickeys/public_keys.gpg')
+    StreamFileParser.add_argument('--StagePath', dest='stagepath', help='Directory on the staging server where files are uploaded', required=True)
+    StreamFileParser.set_defaults(func=StreamFile)
+    
     # check upload
-    CheckUploadParser = subparsers.add_parser('CheckUpload', help='Check that upload is done for a given alias', parents = [parent_parser])
+    CheckUploadParser = subparsers.add_parser('CheckUpload', help='Check that upload is done for a given alias or for all aliases of a box', parents = [parent_parser])
     CheckUploadParser.add_argument('-t', '--Table', dest='table', default='Analyses', help='Database table. Default is Analyses')
-    CheckUploadParser.add_argument('-a', '--Alias', dest='alias', help='Object alias', required=True)
-    CheckUploadParser.add_argument('-j', '--Jobs', dest='jobnames', help='Colon-separated string of job names used for uploading all files under a given alias', required=True)
+    CheckUploadParser.add_argument('-a', '--Alias', dest='alias', help='Object alias. All uploading aliases of the box with finished jobs by default')
+    CheckUploadParser.add_argument('-j', '--Jobs', dest='jobnames', help='Colon-separated string of job names used for uploading all files under a given alias. Derived from the files of the alias by default')
     CheckUploadParser.add_argument('-o', '--Object', dest='object', choices=['analyses', 'runs'], help='EGA object to register (runs or analyses', required=True)
     CheckUploadParser.add_argument('--Attributes', dest='attributes', default='AnalysesAttributes', help='DataBase table. Default is AnalysesAttributes')
+    CheckUploadParser.add_argument('--Held', dest='held', action='store_true', help='The jobs of the alias are done, as when checked by a job held on them. Jobs without exit code failed')
     CheckUploadParser.set_defaults(func=IsUploadDone)
     
+    # check encryption and upload when jobs finish
+    WatchParser = subparsers.add_parser('Watch', help='Check encryption and upload as soon as the jobs of aliases finish', parents = [common_parser])
+    WatchParser.add_argument('-b', '--Box', dest='boxes', nargs='+', choices=['ega-box-12', 'ega-box-137', 'ega-box-1269'], help='Boxes whose aliases are watched', required=True)
+    WatchParser.add_argument('-at', '--AnalysesTable', dest='analysestable', default='Analyses', help='Submission database table. Default is Analyses')
+    WatchParser.add_argument('-rt', '--RunsTable', dest='runstable', default='Runs', help='Submission database table. Default is Runs')
+    WatchParser.add_argument('--Attributes', dest='attributes', default='AnalysesAttributes', help='DataBase table. Default is AnalysesAttributes')
+    WatchParser.add_argument('--Interval', dest='interval', default=600, type=float, help='Maximum time (in seconds) between checks when no job notifies the watcher. Default is 600')
+    WatchParser.add_argument('--Port', dest='port', default=int(os.environ.get('GAEA_WATCHER_PORT', 0)), type=int, help='Port on which finished jobs notify the watcher. Default is GAEA_WATCHER_PORT or any free port')
+    WatchParser.add_argument('--Once', dest='once', action='store_true', help='Check once and exit. Watch until interrupted by default')
+    WatchParser.set_defaults(func=WatchJobs)
+    
     # register analyses to EGA       
     RegisterObjectParser = subparsers.add_parser('RegisterObject', help ='Submit Analyses json to EGA', parents = [parent_parser])
     RegisterObjectParser.add_argument('-t', '--Table', dest='table', help='Submission database table', required=True)
@@ -3143,11 +7217,15 @@ if __name__ == '__main__':
     RegisterObjectParser.set_defaults(func=SubmitMetadata)
 
     # list files on the staging servers
-    StagingServerParser = subparsers.add_parser('StagingServer', help ='List file info on the staging servers', parents = [parent_parser])
+    StagingServerParser = subparsers.add_parser('StagingServer', help ='List file info on the staging servers', parents = [common_parser])
+    StagingServerParser.add_argument('-b', '--Box', dest='boxes', nargs='+', choices=['ega-box-12', 'ega-box-137', 'ega-box-1269'], help='Boxes whose staging servers are crawled in the same run', required=True)
     StagingServerParser.add_argument('-rt', '--RunsTable', dest='runstable', default='Runs', help='Submission database table. Default is Runs')
     StagingServerParser.add_argument('-at', '--AnalysesTable', dest='analysestable', default='Analyses', help='Submission database table. Default is Analyses')
     StagingServerParser.add_argument('-st', '--StagingTable', dest='stagingtable', default='StagingServer', help='Submission database table. Default is StagingServer')
     StagingServerParser.add_argument('-ft', '--FootprintTable', dest='footprinttable', default='FootPrint', help='Submission database table. Default is FootPrint')
+    StagingServerParser.add_argument('--MaxConnections', dest='maxconnections', default=8, type=int, help='Maximum number of connections to the staging servers. Default is 8')
+    StagingServerParser.add_argument('--MaxPerBox', dest='maxperbox', default=4, type=int, help='Maximum number of connections to the staging server of a box. Default is 4')
+    StagingServerParser.add_argument('--Diff', '--diff', dest='diff', action='store_true', help='Print the files added, removed and resized since the previous crawl. Do not print by default')
     StagingServerParser.set_defaults(func=FileInfoStagingServer)
    
     # re-upload registered files that cannot be archived       
@@ -3160,7 +7238,17 @@ if __name__ == '__main__':
     ReUploadParser.add_argument('--MyPython', dest='mypython', default='/.mounts/labs/PDE/Modules/sw/python/Python-3.6.4/bin/python3.6', help='Path the python version. Default is /.mounts/labs/PDE/Modules/sw/python/Python-3.6.4/bin/python3.6')
     ReUploadParser.set_defaults(func=ReUploadRegisteredFiles)
 
+    # index the filter columns of the database tables
+    MigrateParser = subparsers.add_parser('Migrate', help ='Index the egaBox, Status and alias columns of the metadata and submission databases', parents = [parent_parser])
+    MigrateParser.add_argument('--DryRun', dest='dryrun', action='store_true', help='Print the schema changes without applying them. Apply changes by default')
+    MigrateParser.set_defaults(func=MigrateSchema)
+
     # get arguments from the command line
     args = main_parser.parse_args()
+    # jobs launched by this process use the same scheduler
+    if 'scheduler' in args:
+        SetScheduler(args.scheduler)
     # pass the args to the default function
-    args.func(args)
\ No newline at end of file
+    args.func(args)
+    # jobs run on the local machine must complete before exiting
+    WaitForJobs()
\ No newline at end of file
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Make Gaea importable from the tests, keep job files and SQLite stores in a
+temporary directory and replace the MySQL connection
+"""
+
+import contextlib
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Gaea
+
+
+@pytest.fixture(autouse=True)
+def JobDir(tmp_path, monkeypatch):
+    '''
+    Point GAEA_JOB_DIR and GAEA_STATE_DIR to temporary directories for each test
+    '''
+    
+    JobDir = tmp_path / 'jobs'
+    monkeypatch.setenv('GAEA_JOB_DIR', str(JobDir))
+    monkeypatch.setenv('GAEA_STATE_DIR', str(tmp_path / 'state'))
+    return JobDir
+
+
+class FakeConnection(object):
+    '''
+    Return Rows to queries and record the statements sent by StatusTransitions
+    instead of writing to MySQL
+    '''
+    
+    def __init__(self, Fail=False):
+        self.Batches, self.Commits, self.Rollbacks, self.Fail = [], 0, 0, Fail
+        self.Queries, self.Rows = [], []
+    
+    def cursor(self):
+        return self
+    
+    def execute(self, Cmd):
+        self.Queries.append(Cmd)
+    
+    def fetchall(self):
+        return list(self.Rows)
+    
+    def executemany(self, Cmd, Rows):
+        if self.Fail:
+            raise RuntimeError('lost connection')
+        self.Batches.append((Cmd, list(Rows)))
+    
+    def commit(self):
+        self.Commits += 1
+    
+    def rollback(self):
+        self.Rollbacks += 1
+
+
+@pytest.fixture
+def Connection(monkeypatch):
+    '''
+    Replace the connections to the database by a single FakeConnection
+    '''
+    
+    conn = FakeConnection()
+    
+    @contextlib.contextmanager
+    def DatabaseConnection(CredentialFile, DataBase):
+        yield conn
+    
+    monkeypatch.setattr(Gaea, 'DatabaseConnection', DatabaseConnection)
+    return conn
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the parsing and indexing of the SGE accounting files
+"""
+
+import Gaea
+
+
+# record of an OGS 2011.11 accounting file for a job submitted with -l h_rt=01:00:00
+Record = ('all.q:node0123.hpc.oicr.on.ca:users:gaea:Encrypt.alias1__file.bam:8523114:sge:0:'
+          '1600000000:1600000100:1600003700:0:0:3600:3500.5:20.1:123456.0:0:0:0:0:12345:0:0:0.0:0:0:0:0:1234:56:'
+          'gsi:defaultdepartment:NONE:1:0:3520.6:1234.5:0.5:'
+          '-U users -l h_rt=01:00:00,h_vmem=10g -P gsi:0.0:NONE:5368709120.000000:0:0')
+
+
+def test_category_with_colons():
+    Records = Gaea.ParseAccountingRecords(Record.encode('utf-8'))
+    assert Records == [('Encrypt.alias1__file.bam', 8523114, 0, 1600003700, 0, 0, 5368709120.0, 3600.0)]
+
+
+def test_failed_and_exit_status():
+    fields = Record.split(':')
+    fields[11], fields[12] = '100', '0'
+    Records = Gaea.ParseAccountingRecords(':'.join(fields).encode('utf-8'))
+    assert Records[0][4:6] == (100, 0)
+
+
+def test_comments_and_truncated_records():
+    data = '# Version: 2011.11\n{0}\n{1}'.format(Record, Record[:120]).encode('utf-8')
+    assert len(Gaea.ParseAccountingRecords(data)) == 1
+
+
+def test_lookup_reports_failed_jobs(tmp_path):
+    killed = Record.split(':')
+    # killed by the scheduler at the wallclock limit, with a more recent end time
+    killed[10], killed[11], killed[12] = '1600007300', '100', '0'
+    Accounting = tmp_path / 'accounting'
+    Accounting.write_text('{0}\n'.format(Record))
+    Index = Gaea.AccountingIndex(str(Accounting), str(tmp_path / 'accounting.sqlite'))
+    assert Index.Lookup(['Encrypt.alias1__file.bam'])['Encrypt.alias1__file.bam'] == (1600003700, 0, 5368709120.0, 3600.0)
+    # records appended to the file are indexed from the previous offset
+    with open(str(Accounting), 'a') as newfile:
+        newfile.write(':'.join(killed) + '\n')
+    assert Index.Lookup(['Encrypt.alias1__file.bam'])['Encrypt.alias1__file.bam'][:2] == (1600007300, 100)
+
+
+def test_files_ending_with_a_partial_record_are_not_read_again(tmp_path, monkeypatch):
+    Accounting = tmp_path / 'accounting'
+    Accounting.write_text('{0}\n{1}'.format(Record, Record[:120]))
+    Index = Gaea.AccountingIndex(str(Accounting), str(tmp_path / 'accounting.sqlite'))
+    assert Index.Update() == 1
+    with Index.Reading() as conn:
+        assert conn.execute('SELECT size, offset FROM files').fetchall() == [(len(Record) + 121, len(Record) + 1)]
+    Indexed, IndexAccountingFile = [], Index.IndexAccountingFile
+    monkeypatch.setattr(Index, 'IndexAccountingFile', lambda *args: Indexed.append(args[1]) or IndexAccountingFile(*args))
+    assert Index.Update() == 0
+    assert Indexed == []
+    # the partial record is read once it is complete
+    with open(str(Accounting), 'a') as newfile:
+        newfile.write(Record[120:] + '\n')
+    assert Index.Update() == 1
+    assert Indexed == [str(Accounting)]
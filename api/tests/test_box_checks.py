@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the checks of the encryption and upload of all aliases of a box
+"""
+
+import os
+import time
+import pytest
+import Gaea
+
+
+@pytest.fixture
+def Scheduler(tmp_path, monkeypatch):
+    scheduler = Gaea.LocalScheduler(Workers=1, Accounting=str(tmp_path / 'local.accounting'))
+    monkeypatch.setattr(Gaea, 'GetScheduler', lambda Name=None: scheduler)
+    monkeypatch.setattr(scheduler, 'ActiveJobs', lambda: set())
+    yield scheduler
+    scheduler.Executor.shutdown()
+
+
+def test_held_jobs_without_exit_code_failed(Scheduler):
+    for i in ['Encrypt.a__1', 'Encrypt.a__2']:
+        Gaea.RecordJobSubmission(i)
+    Gaea.WriteJobExit('Encrypt.a__1', '0')
+    AliasJobs = {'a': ['Encrypt.a__1', 'Encrypt.a__2'], 'b': []}
+    # the second job may still be running
+    assert Gaea.SortAliasesByJobs(AliasJobs) == ({'b': {}}, ['a'])
+    assert Gaea.SortAliasesByJobs(AliasJobs, Held=True) == ({'a': {'Encrypt.a__1': '0', 'Encrypt.a__2': '1'}, 'b': {}}, [])
+
+
+def test_jobs_are_done_when_their_sidecars_are_written(Scheduler, tmp_path):
+    Gaea.RecordJobSubmission('Encrypt.a__1')
+    Md5 = tmp_path / 'a.md5'
+    Md5.write_text('md5\n')
+    Sidecars = {'Encrypt.a__1': [str(Md5)]}
+    assert Gaea.SortAliasesByJobs({'a': ['Encrypt.a__1']}, Sidecars=Sidecars) == ({'a': {'Encrypt.a__1': '0'}}, [])
+    # files written before the submission are from a previous run
+    os.utime(str(Md5), (time.time() - 3600, time.time() - 3600))
+    assert Gaea.SortAliasesByJobs({'a': ['Encrypt.a__1']}, Sidecars=Sidecars) == ({}, ['a'])
+
+
+def test_legacy_jobs_finish_when_not_active(Scheduler, monkeypatch):
+    Scheduler.Account('Encrypt.a__1', int(time.time()), 0, 0, 10)
+    AliasJobs = {'a': ['Encrypt.a__1'], 'b': ['Encrypt.b__1']}
+    assert Gaea.SortAliasesByJobs(AliasJobs) == ({'a': {'Encrypt.a__1': '0'}, 'b': {'Encrypt.b__1': '1'}}, [])
+    monkeypatch.setattr(Scheduler, 'ActiveJobs', lambda: {'Encrypt.b__1'})
+    assert Gaea.SortAliasesByJobs(AliasJobs) == ({'a': {'Encrypt.a__1': '0'}}, ['b'])
+
+
+def test_aliases_with_an_active_check_job_are_left_to_it(Scheduler, monkeypatch):
+    Gaea.RecordJobSubmission('Encrypt.a__1')
+    Gaea.WriteJobExit('Encrypt.a__1', '0')
+    Gaea.RecordJobSubmission('CheckEncryption.a')
+    monkeypatch.setattr(Scheduler, 'ActiveJobs', lambda: {'CheckEncryption.a'})
+    assert Gaea.SortAliasesByJobs({'a': ['Encrypt.a__1']}, 'CheckEncryption') == ({}, [])
+    assert Gaea.SortAliasesByJobs({'a': ['Encrypt.a__1']}) == ({'a': {'Encrypt.a__1': '0'}}, [])
+
+
+def AddAlias(tmp_path, alias, fileName, Status):
+    '''
+    Return the files dictionary and working directory of alias with a single file of encryption Status
+    '''
+    
+    WorkingDir = tmp_path / alias
+    WorkingDir.mkdir()
+    files = {str(tmp_path / fileName): {'fileName': fileName, 'filePath': str(tmp_path / fileName), 'encryptionStatus': Status}}
+    return files, str(WorkingDir)
+
+
+def test_box_encryption_is_updated_in_a_single_transaction(Scheduler, Connection, tmp_path):
+    Rows = []
+    for alias, ExitCode in [('a1', '0'), ('a2', '1'), ('a3', None)]:
+        files, WorkingDir = AddAlias(tmp_path, alias, alias + '.bam', 'running')
+        Rows.append((alias, str(files), WorkingDir))
+        JobName = 'Encrypt.{0}__{0}.bam'.format(alias)
+        Gaea.RecordJobSubmission(JobName)
+        if ExitCode is not None:
+            Gaea.WriteJobExit(JobName, ExitCode)
+    # the first alias was encrypted with its md5sums
+    for i, j in [('.gpg', 'encrypted'), ('.md5', 'md5'), ('.gpg.md5', 'gpgmd5')]:
+        (tmp_path / 'a1' / ('a1.bam' + i)).write_text(j + '\n')
+    Connection.Rows = Rows
+    assert Gaea.CheckBoxEncryption('credentials', 'EGASUB', 'Runs', 'ega-box-12', 'runs') == [str(tmp_path / 'a3')]
+    assert len(Connection.Queries) == 1
+    assert Connection.Commits == 1 and len(Connection.Batches) == 1
+    Updates = Connection.Batches[0][1]
+    assert [(i[0], i[3]) for i in Updates] == [('upload', 'a1'), ('encrypt', 'a2')]
+    assert "'checksum': 'gpgmd5'" in Updates[0][2]
+    assert "'encryptionStatus': 'failed'" in Updates[1][2]
+
+
+def test_box_upload_is_updated_in_a_single_transaction(Scheduler, Connection, tmp_path, monkeypatch):
+    Rows = []
+    for alias, Status, ExitCode in [('a1', 'done', '0'), ('a2', 'done', '1'), ('a3', 'streaming', '1')]:
+        files, WorkingDir = AddAlias(tmp_path, alias, alias + '.bam', Status)
+        Rows.append((alias, str(files), WorkingDir, 'stage/' + alias))
+        JobName = 'Upload.{0}__{0}.bam'.format(alias)
+        Gaea.RecordJobSubmission(JobName)
+        Gaea.WriteJobExit(JobName, ExitCode)
+    Listed = []
+    monkeypatch.setattr(Gaea, 'ListStagePaths', lambda CredentialFile, Box, StagePaths, Expected: Listed.append(StagePaths) or {i: {} for i in StagePaths})
+    monkeypatch.setattr(Gaea, 'VerifyUploadedFiles', lambda alias, files, LogDir, Staged, LogFiles: True)
+    Connection.Rows = Rows
+    assert Gaea.CheckBoxUpload('credentials', 'EGASUB', 'Runs', 'ega-box-12', 'runs') == []
+    # stagepaths are listed once
+    assert Listed == [['stage/a1', 'stage/a2', 'stage/a3']]
+    assert Connection.Commits == 1 and len(Connection.Batches) == 2
+    Updates = {i[-2]: i[:-2] for Cmd, Batch in Connection.Batches for i in Batch}
+    assert Updates['a1'] == ('uploaded', 'None')
+    assert Updates['a2'] == ('upload', 'Upload failed')
+    # streamed files are encrypted again
+    assert Updates['a3'][:2] == ('encrypt', 'Streaming failed')
+    assert "'encryptionStatus': 'pending'" in Updates['a3'][2]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the extraction of contig names from indexes and bgzipped files
+"""
+
+import gzip
+import os
+import struct
+import zlib
+import Gaea
+
+
+def WriteBgzf(path, data, BlockSize=50):
+    '''
+    Compress data in BGZF blocks of BlockSize uncompressed bytes followed by the EOF block
+    '''
+    
+    with open(path, 'wb') as newfile:
+        for i in list(range(0, len(data), BlockSize)) + [len(data)]:
+            chunk = data[i:i+BlockSize]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            payload = compressor.compress(chunk) + compressor.flush()
+            header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            newfile.write(header + struct.pack('<H', len(header) + 2 + len(payload) + 8 - 1) + payload + struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+
+
+Vcf = b''.join([b'##fileformat=VCFv4.2\n', b'#CHROM\tPOS\tID\tREF\tALT\n'] +
+               [b'chr%d\t%d\t.\tA\tC\n' % (i % 3 + 1, i) for i in range(40)] + [b'chrX\t1\t.\tG\tT'])
+
+
+def test_index_contigs(tmp_path):
+    path = str(tmp_path / 'calls.vcf.gz')
+    with gzip.open(path, 'wb') as newfile:
+        newfile.write(b'##fileformat=VCFv4.2\n')
+    names = b'chr1\x00chr2\x00chrX\x00'
+    with gzip.open(path + '.tbi', 'wb') as newfile:
+        newfile.write(b'TBI\x01' + struct.pack('<8i', 3, 2, 1, 2, 0, ord('#'), 0, len(names)) + names)
+    assert Gaea.ReadIndexContigs(path) == ['chr1', 'chr2', 'chrX']
+    # indexes older than the file are ignored
+    os.utime(path + '.tbi', (0, 0))
+    assert Gaea.ReadIndexContigs(path) is None
+
+
+def test_csi_without_names_is_not_used(tmp_path):
+    path = str(tmp_path / 'calls.vcf.gz')
+    with gzip.open(path, 'wb') as newfile:
+        newfile.write(b'##fileformat=VCFv4.2\n')
+    with gzip.open(path + '.csi', 'wb') as newfile:
+        newfile.write(b'CSI\x01' + struct.pack('<3i', 14, 5, 0))
+    assert Gaea.ReadIndexContigs(path) is None
+
+
+def test_files_without_index(tmp_path):
+    assert Gaea.ReadIndexContigs(str(tmp_path / 'calls.vcf')) is None
+    assert Gaea.ReadIndexContigs(str(tmp_path / 'calls.vcf.gz')) is None
+
+
+def test_parallel_scan_matches_serial_scan(tmp_path):
+    path = str(tmp_path / 'calls.vcf.gz')
+    WriteBgzf(path, Vcf)
+    assert Gaea.IsBgzf(path)
+    Expected = Gaea.ScanVcfContigs(path)
+    assert Expected == {'chr1', 'chr2', 'chr3', 'chrX'}
+    # chunks of a few blocks split lines across chunks
+    for Workers in [1, 2]:
+        assert Gaea.ScanBgzfContigs(path, 'vcf', Workers, ChunkSize=100) == Expected
+
+
+def test_tsv_contigs(tmp_path):
+    path = str(tmp_path / 'regions.tsv.gz')
+    WriteBgzf(path, b'1\t10\t20\n\n2 \t5\t8\nX\t1\t2\n', BlockSize=7)
+    assert Gaea.ScanBgzfContigs(path, 'tsv', 1, ChunkSize=30) == {'1', '2', 'X'}
+
+
+def test_truncated_file_is_rejected(tmp_path):
+    path = str(tmp_path / 'calls.vcf.gz')
+    WriteBgzf(path, Vcf)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 10)
+    assert not Gaea.IsBgzf(str(tmp_path / 'missing.vcf.gz'))
+    try:
+        Gaea.ListBgzfChunks(path)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_scanned_contigs_are_saved_in_the_state_directory(tmp_path):
+    Data = tmp_path / 'data'
+    Data.mkdir()
+    path = str(Data / 'regions.tsv')
+    with open(path, 'w') as newfile:
+        newfile.write('1\t10\t20\n2\t5\t8\n')
+    Gaea.ExtractContigNamesFromTSV(path)
+    # nothing is written next to the submitted files
+    assert os.listdir(str(Data)) == ['regions.tsv']
+    assert Gaea.ReadSavedContigs(path, 'tsv') == ['1', '2']
+    assert Gaea.ReadSavedContigs(path, 'vcf') is None
+    # names of modified files are not used
+    with open(path, 'a') as newfile:
+        newfile.write('X\t1\t2\n')
+    assert Gaea.ReadSavedContigs(path, 'tsv') is None
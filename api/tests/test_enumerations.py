@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the cache of the EGA enumerations
+"""
+
+import os
+import pytest
+import Gaea
+
+
+Enums = {i.title().replace('_', ''): {'1': i} for i in Gaea.EnumNames}
+
+
+@pytest.fixture
+def Fetches(monkeypatch):
+    Calls = []
+    monkeypatch.setattr(Gaea, 'FetchEnumerations', lambda MyScript, MyPython: Calls.append(MyScript) or Enums)
+    return Calls
+
+
+def test_cache_is_kept_in_the_state_directory(Fetches, tmp_path):
+    assert Gaea.ListEnumerations('/release/Gaea.py', 'python3') == Enums
+    assert os.path.isfile(str(tmp_path / 'state' / '.ega_enumerations.json'))
+    # enumerations are fetched once
+    assert Gaea.ListEnumerations('/release/Gaea.py', 'python3') == Enums
+    assert len(Fetches) == 1
+
+
+def test_enumerations_are_fetched_if_the_cache_cannot_be_written(Fetches, tmp_path):
+    CacheFile = str(tmp_path / 'missing' / 'enumerations.json')
+    assert Gaea.ListEnumerations('/release/Gaea.py', 'python3', CacheFile) == Enums
+    assert Gaea.ListEnumerations('/release/Gaea.py', 'python3', CacheFile) == Enums
+    assert len(Fetches) == 2
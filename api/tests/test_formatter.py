@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the formatting of submission jsons
+"""
+
+import Gaea
+
+
+Enums = {'FileTypes': {'fastq': '1'}, 'DatasetTypes': {'Whole genome sequencing': '5', 'Exome sequencing': '6'}}
+
+
+def Run(**Fields):
+    D = {'alias': 'run1', 'sampleId': 'EGAN00001', 'runFileTypeId': 'fastq', 'experimentId': 'EGAX00001',
+         'egaBox': 'ega-box-12', 'StagePath': 'runs/run1',
+         'files': "{'/data/run1.fastq.gz': {'encryptedName': 'run1.fastq.gz.gpg', 'checksum': 'a', 'unencryptedChecksum': 'b'}}"}
+    D.update(Fields)
+    return D
+
+
+def test_run_json():
+    J = Gaea.JsonFormatter('runs', Enums).Format(Run())
+    assert J == {'alias': 'run1', 'sampleId': 'EGAN00001', 'runFileTypeId': '1', 'experimentId': 'EGAX00001', 'egaBox': 'ega-box-12',
+                 'files': [{'fileName': 'runs/run1/run1.fastq.gz.gpg', 'checksum': 'a', 'unencryptedChecksum': 'b', 'checksumMethod': 'md5'}]}
+
+
+def test_missing_required_field_gives_alias_only():
+    assert Gaea.JsonFormatter('runs', Enums).Format(Run(sampleId='NULL')) == {'alias': 'run1'}
+
+
+def test_batch_reports_the_reason_of_each_error():
+    Formatter = Gaea.JsonFormatter('runs', Enums)
+    Results = list(Formatter.FormatBatch([Run(), Run(alias='run2', runFileTypeId='bam'), Run(alias='run3', experimentId='exp3'), Run(alias='run4', files='{')]))
+    assert [(i[0], i[2]) for i in Results[1:3]] == [('run2', 'Invalid enumeration for runFileTypeId'), ('run3', 'Missing accession for experimentId')]
+    assert Results[0][1] is not None and Results[0][2] is None
+    # unexpected errors are returned instead of raised
+    assert Results[3][1] is None and Results[3][2].startswith('JSONDecodeError')
+
+
+def test_dataset_json_lists():
+    D = {'alias': 'ds1', 'datasetTypeIds': 'Exome sequencing', 'policyId': 'EGAP00001',
+         'title': 'title', 'description': 'description', 'runsReferences': 'EGAR1;EGAR2', 'analysisReferences': 'NULL',
+         'datasetLinks': '', 'attributes': "{'tag': 'a', 'value': 'b'}", 'egaBox': 'ega-box-12'}
+    J = Gaea.JsonFormatter('datasets', Enums).Format(D)
+    assert J['datasetTypeIds'] == ['6']
+    assert J['runsReferences'] == ['EGAR1', 'EGAR2']
+    assert J['analysisReferences'] == [] and J['datasetLinks'] == []
+    assert J['attributes'] == [{'tag': 'a', 'value': 'b'}]
+
+
+def test_chromosome_references_follow_the_genome():
+    Formatter = Gaea.JsonFormatter('analyses', {'ReferenceChromosomes': {'CM000663.2': '10', 'CM000685.2': '33'}})
+    References = Formatter.ChromosomeReferences({'genomeId': 'GRCh38'}, ['chr1', 'chrX', 'chrX', 'chrUn'])
+    assert sorted(References, key=lambda x: x['value']) == [{'value': '10', 'label': 'chr1'}, {'value': '33', 'label': 'chrX'}]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the exit codes of the jobs of packs and array jobs
+"""
+
+import time
+import pytest
+import Gaea
+
+
+@pytest.fixture
+def Scheduler(tmp_path, monkeypatch):
+    scheduler = Gaea.LocalScheduler(Workers=1, Accounting=str(tmp_path / 'local.accounting'))
+    monkeypatch.setattr(Gaea, 'GetScheduler', lambda Name=None: scheduler)
+    yield scheduler
+    scheduler.Executor.shutdown()
+
+
+def test_tasks_killed_before_saving_their_exit_code_fail_with_their_array(Scheduler, tmp_path):
+    Gaea.WriteArrayManifest('Encrypt.wave', [('Encrypt.a__1', 'a.sh', str(tmp_path)), ('Encrypt.a__2', 'b.sh', str(tmp_path))])
+    Gaea.RecordJobSubmission('Encrypt.wave')
+    assert Gaea.ReadJobParent('Encrypt.a__1') == 'Encrypt.wave'
+    (tmp_path / 'jobs' / 'Encrypt.a__1.exit').write_text('0\n')
+    # tasks of an array still running are not finished
+    assert Gaea.GetFinishedJobs(['Encrypt.a__1', 'Encrypt.a__2']) == {'Encrypt.a__1': '0'}
+    Scheduler.Account('Encrypt.wave', int(time.time()) + 1, 0, 0, 10)
+    assert Gaea.GetFinishedJobs(['Encrypt.a__1', 'Encrypt.a__2']) == {'Encrypt.a__1': '0', 'Encrypt.a__2': '1'}
+
+
+def test_arrays_are_not_finished_while_tasks_are_active(Scheduler, monkeypatch, tmp_path):
+    Gaea.WriteArrayManifest('Upload.wave', [('Upload.a__1', 'a.sh', str(tmp_path))])
+    Gaea.RecordJobSubmission('Upload.wave')
+    # the first tasks of an array are accounted while the others run
+    Scheduler.Account('Upload.wave', int(time.time()) + 1, 0, 0, 10)
+    monkeypatch.setattr(Scheduler, 'ActiveJobs', lambda: {'Upload.wave'})
+    assert Gaea.GetFinishedJobs(['Upload.a__1']) == {}
+
+
+def test_restored_wave_submits_no_empty_stage(Scheduler, monkeypatch):
+    Submitted = []
+    monkeypatch.setattr(Scheduler, 'SubmitArray', lambda ArrayName, Dispatcher, Size, *args: Submitted.append((ArrayName, Size)) or 0)
+    Wave = Gaea.JobWave('wave')
+    Wave.Add('Encrypt', 'Encrypt.a__1', 'a.sh', '.')
+    Marker = Wave.Mark()
+    Wave.Add('Encrypt', 'Encrypt.b__1', 'b.sh', '.')
+    Wave.Add('CheckEncryption', 'CheckEncryption.b', 'c.sh', '.')
+    Wave.Restore(Marker)
+    assert len(Wave) == 1
+    assert Wave.Submit() == 0
+    assert Submitted == [('Encrypt.wave', 1)]
+
+
+def test_encryption_jobs_of_earlier_runs_take_slots_of_the_cap(Scheduler, monkeypatch):
+    monkeypatch.setattr(Scheduler, 'ActiveJobs', lambda: {'Encrypt.a__1', 'EncryptPack.b.1', 'Encrypt.a__2', 'CheckEncryption.a', 'Upload.c__1'})
+    assert Gaea.GetEncryptionLanes(2) == ([['Encrypt.a__1', 'EncryptPack.b.1'], ['Encrypt.a__2']], -1)
+    assert Gaea.GetEncryptionLanes(4) == ([['Encrypt.a__1'], ['Encrypt.a__2'], ['EncryptPack.b.1'], []], 1)
+    assert Gaea.GetEncryptionLanes(0) == ([], 0)
+
+
+def test_encryption_arrays_take_all_slots(Scheduler, monkeypatch, tmp_path):
+    Gaea.WriteArrayManifest('Encrypt.box.1', [('Encrypt.a__1', 'a.sh', str(tmp_path))])
+    monkeypatch.setattr(Scheduler, 'ActiveJobs', lambda: {'Encrypt.box.1'})
+    assert Gaea.GetEncryptionLanes(2) == ([['Encrypt.box.1'], ['Encrypt.box.1']], 0)
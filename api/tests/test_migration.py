@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the indexing of the filter columns of the submission tables
+"""
+
+import contextlib
+import Gaea
+
+
+def test_prefix_fits_row_format_and_character_set():
+    assert Gaea.IndexPrefixLength('Compact', 'utf8mb4_general_ci') == 191
+    assert Gaea.IndexPrefixLength('Redundant', 'latin1_swedish_ci') == 767
+    assert Gaea.IndexPrefixLength('Dynamic', 'utf8mb4_unicode_ci') == 768
+    assert Gaea.IndexPrefixLength('Dynamic', 'utf8_general_ci') == 1024
+    # unknown collation is assumed to be 4 bytes per character
+    assert Gaea.IndexPrefixLength(None, None) == 191
+
+
+class FakeCursor(object):
+    '''
+    Answer the queries of PlanTableMigration for a table with TEXT columns
+    '''
+    
+    def __init__(self, RowFormat, Longest):
+        self.RowFormat, self.Longest, self.Rows = RowFormat, Longest, []
+    
+    def execute(self, Query, Params=None):
+        if Query.startswith('SHOW FULL COLUMNS'):
+            self.Rows = [('alias', 'text', 'utf8mb4_general_ci'), ('egaBox', 'text', 'utf8mb4_general_ci'),
+                         ('Status', 'varchar(100)', 'utf8mb4_general_ci'), ('files', 'mediumtext', 'utf8mb4_general_ci')]
+        elif Query.startswith('SHOW TABLE STATUS'):
+            self.Rows = [('Analyses', 'InnoDB', 10, self.RowFormat)]
+        elif Query.startswith('SHOW INDEX'):
+            self.Rows = []
+        else:
+            self.Rows = [(self.Longest.get(Query.split('(')[2].split(')')[0].split('.')[1], 0),)]
+    
+    def fetchall(self):
+        return self.Rows
+
+
+def PlanMigration(monkeypatch, RowFormat, Longest):
+    cursor = FakeCursor(RowFormat, Longest)
+    
+    class FakeConnection(object):
+        def cursor(self):
+            return cursor
+    
+    @contextlib.contextmanager
+    def DatabaseConnection(CredentialFile, DataBase):
+        yield FakeConnection()
+    
+    monkeypatch.setattr(Gaea, 'DatabaseConnection', DatabaseConnection)
+    return Gaea.PlanTableMigration('credentials', 'EGASUB', 'Analyses')
+
+
+def test_compact_table_indexes_alias_on_a_prefix(monkeypatch):
+    Clauses = PlanMigration(monkeypatch, 'Compact', {'alias': 50, 'egaBox': 11})
+    assert Clauses == ['MODIFY egaBox VARCHAR(100) NULL', 'MODIFY alias VARCHAR(255) NULL',
+                       'ADD INDEX gaea_box_status_alias (egaBox, Status, alias(191))',
+                       'ADD INDEX gaea_box_alias (egaBox, alias(191))']
+
+
+def test_dynamic_table_indexes_whole_columns(monkeypatch):
+    Clauses = PlanMigration(monkeypatch, 'Dynamic', {'alias': 50, 'egaBox': 11})
+    assert Clauses[-1] == 'ADD INDEX gaea_box_alias (egaBox, alias)'
+
+
+def test_long_values_are_kept_as_text(monkeypatch):
+    Clauses = PlanMigration(monkeypatch, 'Dynamic', {'alias': 300, 'egaBox': 11})
+    assert 'MODIFY alias VARCHAR(255) NULL' not in Clauses
+    assert Clauses[-1] == 'ADD INDEX gaea_box_alias (egaBox, alias(255))'
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the packing of small files and of the sizing of jobs
+"""
+
+import pytest
+import Gaea
+
+
+def test_small_files_are_packed_in_order():
+    assert Gaea.PackFiles([10, 20, 100, 30, 40, 50, 5], 60) == [[0, 1], [2], [3], [4], [5, 6]]
+
+
+def test_packing_is_disabled_without_pack_size():
+    assert Gaea.PackFiles([1, 2, 3], 0) == [[0], [1], [2]]
+
+
+@pytest.fixture
+def Scheduler(tmp_path, monkeypatch):
+    scheduler = Gaea.LocalScheduler(Workers=1, Accounting=str(tmp_path / 'local.accounting'))
+    monkeypatch.setattr(Gaea, 'GetScheduler', lambda Name=None: scheduler)
+    yield scheduler
+    scheduler.Executor.shutdown()
+
+
+def test_default_memory_until_enough_jobs_completed(Scheduler):
+    Planner = Gaea.ResourcePlanner('Encrypt', '10', {'short': 4, 'long': 48}, MinRuns=3)
+    Planner.Record({'Encrypt.a__{0}'.format(i): 1024**3 for i in range(3)})
+    Scheduler.Account('Encrypt.a__0', 0, 0, 2 * 1024**3, 600)
+    assert Planner.Plan(1024**3) == ('10', None, None)
+
+
+def test_jobs_are_sized_from_similar_jobs(Scheduler):
+    Planner = Gaea.ResourcePlanner('Encrypt', '10', {'short': 4, 'long': 48, 'unlimited': 0}, MinRuns=3)
+    Planner.Record({'Encrypt.a__{0}'.format(i): 1024**3 for i in range(4)})
+    for i in range(3):
+        Scheduler.Account('Encrypt.a__{0}'.format(i), 0, 0, (i + 1) * 1024**3, 1800)
+    # failed jobs are not used
+    Scheduler.Account('Encrypt.a__3', 0, 1, 9 * 1024**3, 10)
+    Mem, Time, Queue = Planner.Plan(2 * 1024**3)
+    # 3 Gb and a quarter more, twice the time of the slowest throughput
+    assert Mem == '4'
+    assert Time == 2 * 2 * 1800 + 900
+    assert Queue == 'short'
+    # jobs much larger than the known jobs get the default memory
+    assert Planner.Plan(100 * 1024**3) == ('10', None, None)
+
+
+def test_memory_never_exceeds_the_default(Scheduler):
+    Planner = Gaea.ResourcePlanner('Upload', '4', {'long': 48}, MinRuns=1)
+    Planner.Record({'Upload.a__0': 1024**3})
+    Scheduler.Account('Upload.a__0', 0, 0, 8 * 1024**3, 2**17)
+    # no queue fits jobs longer than 48 hours
+    assert Planner.Plan(1024**3) == ('4', 2 * 2**17 + 900, None)
+
+
+def test_no_wallclock_limit_without_queues_with_limits(Scheduler):
+    for Queues in [None, {'unlimited': 0}]:
+        Planner = Gaea.ResourcePlanner('Upload', '4', Queues, MinRuns=1)
+        Planner.Record({'Upload.a__0': 1024**3})
+        Scheduler.Account('Upload.a__0', 0, 0, 2 * 1024**3, 600)
+        assert Planner.Plan(1024**3) == ('3', None, None)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the listings of the staging servers
+"""
+
+import calendar
+import ftplib
+import os
+import time
+import Gaea
+
+
+def test_cache_shares_recent_listings():
+    Cache = Gaea.StagingListingCache(TTL=60)
+    Calls = []
+    List = lambda: Calls.append(1) or ['a.gpg', 'a.md5']
+    assert Cache.Get('ega-box-12', 'dir', List) == ['a.gpg', 'a.md5']
+    assert Cache.Get('ega-box-12', 'dir', List) == ['a.gpg', 'a.md5']
+    assert len(Calls) == 1
+    # listings missing expected files are listed again
+    Cache.Get('ega-box-12', 'dir', List, ['b.gpg'])
+    assert len(Calls) == 2
+
+
+def test_prune_removes_expired_listings_and_lock_files():
+    Cache = Gaea.StagingListingCache(TTL=60)
+    Cache.Get('ega-box-12', 'old', lambda: ['a.gpg'])
+    Cache.Get('ega-box-12', 'new', lambda: ['b.gpg'])
+    with Cache.Writing() as conn:
+        conn.execute('UPDATE listings SET listed = ? WHERE stagepath = ?', (time.time() - 120, 'old'))
+    Old = [os.path.join(Cache.LockDir, i) for i in os.listdir(Cache.LockDir)]
+    for i in Old:
+        os.utime(i, (time.time() - 120, time.time() - 120))
+    assert Cache.Prune() == 1
+    with Cache.Reading() as conn:
+        assert [i[0] for i in conn.execute('SELECT stagepath FROM listings')] == ['new']
+    assert os.listdir(Cache.LockDir) == []
+    # pruned lock files are made again
+    assert Cache.Get('ega-box-12', 'old', lambda: ['a.gpg']) == ['a.gpg']
+    assert len(os.listdir(Cache.LockDir)) == 1
+
+
+def test_prune_keeps_held_lock_files():
+    Cache = Gaea.StagingListingCache(TTL=60)
+    Cache.Get('ega-box-12', 'dir', lambda: [])
+    LockFile = os.path.join(Cache.LockDir, os.listdir(Cache.LockDir)[0])
+    os.utime(LockFile, (time.time() - 120, time.time() - 120))
+    with open(LockFile, 'a') as lock:
+        Gaea.fcntl.flock(lock, Gaea.fcntl.LOCK_EX)
+        Cache.Prune()
+    assert os.path.isfile(LockFile)
+
+
+def test_list_time_with_year():
+    assert Gaea.StagingCrawler.ParseListTime('Mar', '7', '2019') == calendar.timegm((2019, 3, 7, 0, 0, 0))
+
+
+def test_list_time_without_year_is_within_the_last_year():
+    Now = calendar.timegm((2021, 2, 10, 12, 0, 0))
+    assert Gaea.StagingCrawler.ParseListTime('Feb', '9', '08:30', Now) == calendar.timegm((2021, 2, 9, 8, 30, 0))
+    # dates after today are from the previous year
+    assert Gaea.StagingCrawler.ParseListTime('Dec', '24', '23:59', Now) == calendar.timegm((2020, 12, 24, 23, 59, 0))
+
+
+class FakeFTP(object):
+    '''
+    Serve LIST lines for a server without MLSD
+    '''
+    
+    def mlsd(self, Directory, Facts):
+        raise ftplib.error_perm('500 Unknown command')
+    
+    def retrlines(self, Command, Callback):
+        for line in ['drwxr-xr-x 2 ftp ftp 4096 Jan 1 2020 runs',
+                     '-rw-r--r-- 1 ftp ftp 1024 Mar 7 2019 a file.gpg',
+                     'drwxr-xr-x 2 ftp ftp 4096 Jan 1 2020 .']:
+            Callback(line)
+
+
+def test_list_falls_back_to_list_lines():
+    Crawler = Gaea.StagingCrawler('user', 'password', 'localhost:2121')
+    assert (Crawler.Host, Crawler.Port) == ('localhost', 2121)
+    Crawler.FTP = FakeFTP()
+    Start = time.time()
+    assert Crawler.List('/dir') == (['/dir/runs'], {'/dir/a file.gpg': (1024, calendar.timegm((2019, 3, 7, 0, 0, 0)))})
+    assert Crawler.MLSD is False
+    assert Crawler.Listed['dir'] >= Start
+
+
+def test_snapshot_update_returns_the_difference_with_the_last_crawl():
+    Snapshot = Gaea.StagingSnapshot()
+    Delta = Snapshot.Update('ega-box-1', {'/runs/a.gpg': (10, 100), '/runs/b.gpg': (20, 100)}, {'': 1.0, 'runs': 2.0})
+    assert Delta == {'added': {'/runs/a.gpg': 10, '/runs/b.gpg': 20}, 'removed': {}, 'resized': {}}
+    Delta = Snapshot.Update('ega-box-1', {'/runs/a.gpg': (15, 200), '/runs/b.gpg': (20, 300), '/c.gpg': (5, 300)}, {'': 3.0, 'runs': 4.0})
+    assert Delta == {'added': {'/c.gpg': 5}, 'removed': {}, 'resized': {'/runs/a.gpg': (10, 15)}}
+    # files touched without changing size are updated too
+    assert Snapshot.Load('ega-box-1') == {'/runs/a.gpg': (15, 200), '/runs/b.gpg': (20, 300), '/c.gpg': (5, 300)}
+    Delta = Snapshot.Update('ega-box-1', {'/c.gpg': (5, 300)}, {'': 5.0})
+    assert Delta == {'added': {}, 'removed': {'/runs/a.gpg': 15, '/runs/b.gpg': 20}, 'resized': {}}
+    assert Snapshot.Load('ega-box-1') == {'/c.gpg': (5, 300)}
+    # other boxes are left alone
+    assert Snapshot.Load('ega-box-2') == {}
+
+
+def test_snapshot_lists_directories_of_the_last_crawl():
+    Snapshot = Gaea.StagingSnapshot()
+    Snapshot.Update('ega-box-1', {'/runs/a.gpg': (10, 100), '/c.gpg': (5, 100)}, {'': 1.0, 'runs': 2.0})
+    assert Snapshot.List('ega-box-1', '/runs/') == (2.0, ['a.gpg'])
+    assert Snapshot.List('ega-box-1', '') == (1.0, ['c.gpg'])
+    assert Snapshot.List('ega-box-2', 'runs') is None
+    # directories not listed in the last crawl are not trusted
+    Snapshot.Update('ega-box-1', {'/c.gpg': (5, 100)}, {'': 3.0})
+    assert Snapshot.List('ega-box-1', 'runs') is None
+    assert Snapshot.List('ega-box-1', '') == (3.0, ['c.gpg'])
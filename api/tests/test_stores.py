@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the SQLite stores shared by the submission processes and the jobs
+"""
+
+import os
+import Gaea
+
+
+def test_stores_are_saved_in_the_state_directory(tmp_path):
+    Ledger = Gaea.ChecksumLedger()
+    assert Ledger.StoreFile == str(tmp_path / 'state' / 'checksums.sqlite')
+    Cache = Gaea.StagingListingCache(TTL=60)
+    assert Cache.StoreFile == str(tmp_path / 'state' / 'listings.sqlite')
+    assert os.path.isdir(Cache.LockDir)
+
+
+def test_variable_overrides_the_state_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('GAEA_STAGING_SNAPSHOT', str(tmp_path / 'snapshot.sqlite'))
+    assert Gaea.StagingSnapshot().StoreFile == str(tmp_path / 'snapshot.sqlite')
+
+
+def test_ledger_forgets_modified_files(tmp_path):
+    File = tmp_path / 'file.txt'
+    File.write_text('ACGT')
+    Ledger = Gaea.ChecksumLedger()
+    Ledger.Record(str(File), os.stat(str(File)), 'a' * 32)
+    assert Ledger.Lookup([str(File)]) == {str(File): 'a' * 32}
+    File.write_text('ACGTN')
+    assert Ledger.Lookup([str(File)]) == {}
+
+
+def test_open_returns_none_if_the_store_cannot_be_opened(tmp_path, monkeypatch):
+    monkeypatch.setenv('GAEA_CHECKSUM_LEDGER', str(tmp_path / 'missing' / 'checksums.sqlite'))
+    assert Gaea.ChecksumLedger.Open() is None
+
+
+def test_planner_without_store_uses_default_memory(tmp_path):
+    Planner = Gaea.ResourcePlanner('Encrypt', '10', PlanFile=str(tmp_path / 'missing' / 'resources.sqlite'))
+    assert Planner.StoreFile is None
+    Planner.Record({'Encrypt.alias__file': 100})
+    assert Planner.LoadRuns() == []
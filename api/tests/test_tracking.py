@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the tracking of the encryption of each file of an alias
+"""
+
+import os
+import Gaea
+
+
+def Encrypt(tmp_path, Name, Content):
+    '''
+    Write the original file Name and its encrypted file and md5sums as a finished
+    encryption job does and return the path and the entry of the files dictionary
+    '''
+    
+    Data, WorkingDir = tmp_path / 'data', tmp_path / 'work'
+    Data.mkdir(exist_ok=True)
+    WorkingDir.mkdir(exist_ok=True)
+    path = str(Data / Name)
+    with open(path, 'w') as newfile:
+        newfile.write(Content)
+    Md5, EncryptedMd5 = 'md5-{0}'.format(Content), 'gpgmd5-{0}'.format(Content)
+    (WorkingDir / (Name + '.gpg')).write_text('encrypted')
+    (WorkingDir / (Name + '.md5')).write_text(Md5 + '\n')
+    (WorkingDir / (Name + '.gpg.md5')).write_text(EncryptedMd5 + '\n')
+    Gaea.ChecksumLedger().Record(path, os.stat(path), Md5)
+    Checksums = {'encryptedName': Name + '.gpg', 'unencryptedChecksum': Md5, 'checksum': EncryptedMd5}
+    return path, Gaea.SetEncryptionStatus({'fileName': Name, 'filePath': path}, 'done', Checksums)
+
+
+def test_intact_done_files_are_kept(tmp_path):
+    Intact, IntactInfo = Encrypt(tmp_path, 'a.bam', 'a')
+    Modified, ModifiedInfo = Encrypt(tmp_path, 'b.bam', 'b')
+    Missing, MissingInfo = Encrypt(tmp_path, 'c.bam', 'c')
+    Pending = str(tmp_path / 'data' / 'd.bam')
+    files = {Intact: IntactInfo, Modified: ModifiedInfo, Missing: MissingInfo,
+             Pending: Gaea.SetEncryptionStatus({'fileName': 'd.bam', 'filePath': Pending}, 'pending')}
+    # original file changed since it was encrypted
+    with open(Modified, 'a') as newfile:
+        newfile.write('more data')
+    # encrypted file removed from the working directory
+    os.remove(str(tmp_path / 'work' / 'c.bam.gpg'))
+    assert Gaea.ListEncryptedFiles(files, str(tmp_path / 'work')) == [Intact]
+
+
+def test_only_failed_files_are_marked_failed(tmp_path):
+    First, FirstInfo = Encrypt(tmp_path, 'a.bam', 'a')
+    Second, SecondInfo = Encrypt(tmp_path, 'b.bam', 'b')
+    Third, ThirdInfo = Encrypt(tmp_path, 'c.bam', 'c')
+    files = {First: FirstInfo,
+             Second: Gaea.SetEncryptionStatus(SecondInfo, 'running'),
+             Third: Gaea.SetEncryptionStatus(ThirdInfo, 'running')}
+    Verified = {First: {'encryptedName': 'a.bam.gpg', 'unencryptedChecksum': 'md5-a', 'checksum': 'gpgmd5-a'},
+                Second: {'encryptedName': 'b.bam.gpg', 'unencryptedChecksum': 'md5-b', 'checksum': 'gpgmd5-b'}}
+    # the first file was encrypted by a previous run, the third job failed
+    ExitCodes = {'Encrypt.alias__b.bam': '0', 'Encrypt.alias__c.bam': '1'}
+    Done, Tracked = Gaea.TrackEncryptedFiles('alias', files, Verified, ExitCodes)
+    assert Done is False
+    assert {i: Tracked[i]['encryptionStatus'] for i in Tracked} == {First: 'done', Second: 'done', Third: 'failed'}
+    assert Tracked[Second]['checksum'] == 'gpgmd5-b'
+    assert 'checksum' not in Tracked[Third]
+    # all files are done once the failed file is encrypted again
+    Verified[Third] = {'encryptedName': 'c.bam.gpg', 'unencryptedChecksum': 'md5-c', 'checksum': 'gpgmd5-c'}
+    ExitCodes['Encrypt.alias__c.bam'] = '0'
+    assert Gaea.TrackEncryptedFiles('alias', files, Verified, ExitCodes)[0] is True
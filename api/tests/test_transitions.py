@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the batching of status transitions
+"""
+
+import pytest
+import Gaea
+
+
+def test_updates_are_grouped_by_columns_and_batched(Connection):
+    Transitions = Gaea.StatusTransitions('credentials', 'EGASUB', 'Analyses', 'ega-box-12', BatchSize=2)
+    for i in range(3):
+        Transitions.Add('alias{0}'.format(i), Status='upload', errorMessages=None)
+    Transitions.Add('alias3', Status='encrypt')
+    assert len(Transitions) == 4
+    assert Transitions.Flush() == 4
+    assert Connection.Commits == 1
+    assert [len(i[1]) for i in Connection.Batches] == [2, 1, 1]
+    Cmd, Rows = Connection.Batches[0]
+    assert Cmd == 'UPDATE Analyses SET Analyses.Status=%s, Analyses.errorMessages=%s WHERE Analyses.alias=%s AND Analyses.egaBox=%s'
+    assert Rows[0] == ('upload', 'NULL', 'alias0', 'ega-box-12')
+    # updates are sent once
+    assert len(Transitions) == 0 and Transitions.Flush() == 0
+
+
+def test_failed_flush_is_rolled_back(Connection):
+    Connection.Fail = True
+    Transitions = Gaea.StatusTransitions('credentials', 'EGASUB', 'Runs', 'ega-box-12')
+    Transitions.Add('alias', Status='uploaded')
+    with pytest.raises(RuntimeError):
+        Transitions.Flush()
+    assert Connection.Rollbacks == 1 and Connection.Commits == 0
+    assert len(Transitions) == 1